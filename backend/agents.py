@@ -5,15 +5,24 @@
 
 from __future__ import annotations
 
+import asyncio
+import json
 import os
-from typing import Literal
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Literal
 
-from fastmcp import FastMCP
 from dotenv import load_dotenv
-from pydantic_ai import Agent, ModelMessage, ModelRequest, ModelResponse, RunContext
-from pydantic_ai.models.openai import OpenAIChatModel
-from pydantic_ai.providers.openai import OpenAIProvider
-from pydantic_ai.toolsets.fastmcp import FastMCPToolset
+
+if TYPE_CHECKING:
+    from fastmcp import FastMCP
+    from pydantic_ai import Agent, ModelMessage
+    from pydantic_ai.toolsets import AbstractToolset
+
+    from mcp_servers import MCPServerPool
 
 load_dotenv()  # 从 .env 文件加载环境变量
 
@@ -23,31 +32,34 @@ OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', '')
 GAODE_API_KEY = os.getenv('GAODE_API_KEY', '')
 print(f"ZHIPU_API_KEY: {ZHIPU_API_KEY}")
 print(f"GAODE_API_KEY: {GAODE_API_KEY}")
+
+# 工具调用的默认超时 (秒)
+TOOL_TIMEOUT = float(os.getenv('TOOL_TIMEOUT', '15'))
+# 天气查询结果缓存时间 (秒)
+WEATHER_CACHE_TTL = float(os.getenv('WEATHER_CACHE_TTL', '600'))
+# 工具结果缓存的最大条目数 (所有工具共用, 按最近使用淘汰)
+TOOL_CACHE_SIZE = int(os.getenv('TOOL_CACHE_SIZE', '1024'))
+# 本地 MCP 工具直接以函数调用 (false 时经由 MCP 客户端/服务端调用, 用于调试 MCP 行为)
+MCP_LOCAL_FAST_PATH = os.getenv('MCP_LOCAL_FAST_PATH', 'true').lower() == 'true'
+# 外部 MCP 服务器配置文件 (见 mcp_servers.py), 留空则不启用
+MCP_SERVERS_CONFIG = os.getenv('MCP_SERVERS_CONFIG', '')
+
 # ============================================
 # 配置智谱 AI 模型
 # ============================================
 
-zhipu_model_str = 'glm-4-flashx'
-# zhipu_model_str = 'glm-4.6'
-
-# mcp
-fastmcp_server = FastMCP('my_server')
-@fastmcp_server.tool()
-async def add(a: int, b: int) -> int:
-    # 计算两个整数的和
-    return a + b
+# 模型名称 -> 实际调用的模型
+# pydantic-ai / openai / fastmcp 导入耗时较长, Agent 在首次使用时才构建 (见 get_agent)
+MODEL_NAMES: dict[str, str] = {
+    'zhipu': 'glm-4-flashx',
+    # 'zhipu': 'glm-4.6',
+}
+DEFAULT_MODEL = 'zhipu'
 
+# 生成会话标题等后台辅助任务使用的轻量模型 (不带工具)
+TITLE_MODEL = os.getenv('TITLE_MODEL', 'glm-4-flash')
 
-model = OpenAIChatModel(
-    zhipu_model_str,
-    provider=OpenAIProvider(
-        base_url=OPENAI_BASE_URL, api_key=ZHIPU_API_KEY
-    ),
-)
-zhipu_agent = Agent(
-    model,
-    toolsets=[FastMCPToolset(fastmcp_server)],
-    system_prompt="""你是一个友好、专业的 AI 助手。
+SYSTEM_PROMPT = """你是一个友好、专业的 AI 助手。
 
 ## 核心职责
 1. 准确理解用户意图，提供有价值的回答
@@ -95,24 +107,307 @@ zhipu_agent = Agent(
 
 记住：工具开发者已经优化了输出格式，你的任务是准确传达，而不是重新包装。
 """
-)
+
+
+# mcp
+async def add(a: int, b: int) -> int:
+    """计算两个整数的和"""
+    return a + b
+
+
+# 本地 MCP 工具: 注册到本地 MCP 服务器; Agent 默认直接调用这些函数, 不经过 MCP 的序列化和消息往返
+LOCAL_MCP_TOOLS = [add]
+
+
+def build_mcp_server() -> FastMCP:
+    """创建本地 MCP 服务器"""
+    from fastmcp import FastMCP
+
+    fastmcp_server = FastMCP('my_server')
+    for tool in LOCAL_MCP_TOOLS:
+        fastmcp_server.tool(tool)
+
+    return fastmcp_server
+
+
+_mcp_pool: MCPServerPool | None = None
+_mcp_pool_loaded = False
+_mcp_pool_lock = threading.Lock()
+
+
+def get_mcp_pool() -> MCPServerPool | None:
+    """外部 MCP 服务器连接池, 未配置 MCP_SERVERS_CONFIG 或配置无效时返回 None
+
+    首次调用时加载配置 (会导入 pydantic-ai), 连接由 MCPServerPool.start 在应用启动后建立
+    """
+    global _mcp_pool, _mcp_pool_loaded
+    if not MCP_SERVERS_CONFIG or _mcp_pool_loaded:
+        return _mcp_pool
+    with _mcp_pool_lock:
+        if not _mcp_pool_loaded:
+            from mcp_servers import MCPServerPool
+
+            try:
+                _mcp_pool = MCPServerPool.from_config(MCP_SERVERS_CONFIG)
+                print(f"🔌 [MCP] 已加载 {len(_mcp_pool.toolsets)} 个外部服务器配置: {MCP_SERVERS_CONFIG}")
+            except Exception as e:
+                print(f"❌ [MCP] 加载配置 {MCP_SERVERS_CONFIG} 失败, 不启用外部服务器: {e}")
+            _mcp_pool_loaded = True
+    return _mcp_pool
+
+
+async def close_mcp_pool():
+    """关闭外部 MCP 服务器会话 (未启动时无操作)"""
+    if _mcp_pool is not None:
+        await _mcp_pool.stop()
+
+
+# ============================================
+# 工具执行层
+# ============================================
+# 模型在一轮中返回的多个工具调用由 pydantic-ai 并发执行 (见 _agent_graph.process_function_tools,
+# 任一工具声明 sequential 时才会串行), 这里在每个调用外层加上:
+# - 超时: 超时后向模型返回说明, 不阻塞同一轮的其他调用
+# - 合并: 可缓存的工具 (cache 不为 None) 参数相同的进行中调用 (如重复查询同一城市) 只执行一次;
+#   其他工具 (包括外部 MCP 工具) 可能有副作用, 每次调用都单独执行
+# - 缓存: 纯函数工具按参数永久缓存 (LRU), 有 I/O 的工具按参数缓存 ttl 秒
+# - 统计: 各工具的调用次数、命中率、耗时, 见 /api/metrics/tools
+
+@dataclass(frozen=True)
+class ToolPolicy:
+    """单个工具的执行策略"""
+
+    timeout: float = TOOL_TIMEOUT
+    # pure: 结果只取决于参数, 永久缓存; ttl: 有 I/O 的工具, 缓存 ttl 秒; None: 不缓存
+    cache: Literal['pure', 'ttl'] | None = None
+    ttl: float = 0.0
+    # 判断结果是否可以缓存 (如工具以文本返回的错误信息不应缓存)
+    cache_if: Callable[[Any], bool] | None = None
+
+
+TOOL_POLICIES: dict[str, ToolPolicy] = {
+    'add': ToolPolicy(timeout=5, cache='pure'),
+    # 成功的查询结果以 📍 开头, 其余为错误说明
+    'get_weather': ToolPolicy(
+        cache='ttl', ttl=WEATHER_CACHE_TTL, cache_if=lambda result: str(result).startswith('📍')
+    ),
+}
+DEFAULT_TOOL_POLICY = ToolPolicy()
+
+
+@dataclass
+class ToolStats:
+    """单个工具的调用统计"""
+
+    calls: int = 0
+    # 命中缓存的次数
+    hits: int = 0
+    # 与进行中的相同调用合并的次数
+    shared: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    # 实际执行的次数及耗时 (不含缓存命中)
+    executions: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+    def record_execution(self, elapsed_ms: float):
+        self.executions += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def as_dict(self) -> dict:
+        return {
+            'calls': self.calls,
+            'hits': self.hits,
+            'shared': self.shared,
+            'hit_rate': round((self.hits + self.shared) / self.calls, 3) if self.calls else 0,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'executions': self.executions,
+            'avg_ms': round(self.total_ms / self.executions, 1) if self.executions else 0,
+            'max_ms': round(self.max_ms, 1),
+        }
+
+
+class ToolExecutor:
+    """工具调用的超时、合并、缓存与统计 (在事件循环中使用)"""
+
+    def __init__(self, policies: dict[str, ToolPolicy], cache_size: int = TOOL_CACHE_SIZE):
+        self.policies = policies
+        self.cache_size = cache_size
+        self.stats: dict[str, ToolStats] = {}
+        # 缓存键 -> (过期时间, 结果), 按最近使用排序
+        self._cache: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def cache_key(name: str, args: dict[str, Any]) -> str:
+        return name + ':' + json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)
+
+    async def run(self, name: str, args: dict[str, Any], call: Callable[[], Awaitable[Any]]) -> Any:
+        """执行一次工具调用; call 为实际调用工具的协程函数"""
+        policy = self.policies.get(name, DEFAULT_TOOL_POLICY)
+        stats = self.stats.setdefault(name, ToolStats())
+        stats.calls += 1
+        key = self.cache_key(name, args)
+
+        if policy.cache is not None:
+            cached = self._cache.get(key)
+            if cached is not None:
+                expires, result = cached
+                if expires > time.monotonic():
+                    self._cache.move_to_end(key)
+                    stats.hits += 1
+                    return result
+                del self._cache[key]
+
+        if policy.cache is None:
+            # 不可缓存的工具可能有副作用 (如外部 MCP 工具), 参数相同也各自执行
+            return await self._execute(name, key, policy, stats, call)
+
+        task = self._inflight.get(key)
+        if task is not None:
+            stats.shared += 1
+        else:
+            task = self._inflight[key] = asyncio.create_task(self._execute(name, key, policy, stats, call))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # 调用方被取消时不影响合并到同一任务的其他调用
+        return await asyncio.shield(task)
+
+    async def _execute(
+        self, name: str, key: str, policy: ToolPolicy, stats: ToolStats, call: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(call(), policy.timeout)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            print(f"⏱️  [工具] {name} 超时 ({policy.timeout:g} 秒)")
+            return f'工具 {name} 执行超时 ({policy.timeout:g} 秒), 请稍后重试。'
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.record_execution((time.perf_counter() - start) * 1000)
+
+        if policy.cache is not None and (policy.cache_if is None or policy.cache_if(result)):
+            expires = time.monotonic() + policy.ttl if policy.cache == 'ttl' else float('inf')
+            self._cache[key] = (expires, result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def snapshot(self) -> dict:
+        return {
+            'cached_results': len(self._cache),
+            'in_flight': len(self._inflight),
+            'tools': {name: stats.as_dict() for name, stats in self.stats.items()},
+        }
+
+
+# 所有 Agent 共用, 缓存结果可跨会话复用
+tool_executor = ToolExecutor(TOOL_POLICIES)
+
+
+def _executing_toolset(wrapped: AbstractToolset) -> AbstractToolset:
+    """包装工具集, 使其中每个工具调用都经过 tool_executor"""
+    from pydantic_ai.toolsets import WrapperToolset
+
+    @dataclass
+    class ExecutingToolset(WrapperToolset):
+        async def call_tool(self, name, tool_args, ctx, tool):
+            return await tool_executor.run(
+                name, tool_args, lambda: self.wrapped.call_tool(name, tool_args, ctx, tool)
+            )
+
+    return ExecutingToolset(wrapped)
+
+
+def _build_agent(model_name: str) -> Agent:
+    """构建 Agent 及其工具集"""
+    from pydantic_ai import Agent
+    from pydantic_ai.models.openai import OpenAIChatModel
+    from pydantic_ai.providers.openai import OpenAIProvider
+    from pydantic_ai.toolsets import CombinedToolset, FunctionToolset
+    from pydantic_ai.toolsets.fastmcp import FastMCPToolset
+
+    model = OpenAIChatModel(
+        model_name,
+        provider=OpenAIProvider(
+            base_url=OPENAI_BASE_URL, api_key=ZHIPU_API_KEY
+        ),
+    )
+    if MCP_LOCAL_FAST_PATH:
+        toolsets: list[AbstractToolset] = [FunctionToolset([*LOCAL_MCP_TOOLS, get_weather])]
+    else:
+        toolsets = [FastMCPToolset(build_mcp_server()), FunctionToolset([get_weather])]
+    pool = get_mcp_pool()
+    if pool is not None:
+        toolsets.extend(pool.toolsets)
+    agent = Agent(
+        model,
+        toolsets=[_executing_toolset(CombinedToolset(toolsets))],
+        system_prompt=SYSTEM_PROMPT,
+    )
+    return agent
+
+
+def _build_plain_agent(model_name: str) -> Agent:
+    """构建不带工具和系统提示词的 Agent (后台辅助任务使用, 请求更短更便宜)"""
+    from pydantic_ai import Agent
+    from pydantic_ai.models.openai import OpenAIChatModel
+    from pydantic_ai.providers.openai import OpenAIProvider
+
+    model = OpenAIChatModel(
+        model_name,
+        provider=OpenAIProvider(
+            base_url=OPENAI_BASE_URL, api_key=ZHIPU_API_KEY
+        ),
+    )
+    return Agent(model)
+
+
+_agents: dict[str, Agent] = {}
+_agents_lock = threading.Lock()
 
 
 # ============================================
 # Agent 获取函数
 # ============================================
 
-def get_agent(model: str = 'zhipu') -> Agent:
+def get_agent(model: str = DEFAULT_MODEL) -> Agent:
     """根据模型名称获取 Agent
     
+    首次调用时构建并缓存, 之后直接复用。可在线程中调用以便启动时预热。
+    
     Args:
-        model: 模型名称,默认使用智谱 (目前只支持 zhipu)
+        model: 模型名称,默认使用智谱 (目前只支持 zhipu, 未知名称回退到默认模型)
         
     Returns:
         Agent 实例
     """
-    # 目前只实现了智谱
-    return zhipu_agent
+    model_name = MODEL_NAMES.get(model, MODEL_NAMES[DEFAULT_MODEL])
+    agent = _agents.get(model_name)
+    if agent is None:
+        with _agents_lock:
+            agent = _agents.get(model_name)
+            if agent is None:
+                agent = _agents[model_name] = _build_agent(model_name)
+    return agent
+
+
+def get_title_agent() -> Agent:
+    """获取生成会话标题用的轻量 Agent (TITLE_MODEL, 不带工具), 首次调用时构建"""
+    key = f'plain:{TITLE_MODEL}'
+    agent = _agents.get(key)
+    if agent is None:
+        with _agents_lock:
+            agent = _agents.get(key)
+            if agent is None:
+                agent = _agents[key] = _build_plain_agent(TITLE_MODEL)
+    return agent
 
 
 # ============================================
@@ -128,7 +423,7 @@ def to_chat_message(m: ModelMessage) -> dict:
     Returns:
         字典格式的消息
     """
-    from pydantic_ai import UserPromptPart, TextPart
+    from pydantic_ai import ModelRequest, ModelResponse, UserPromptPart, TextPart
     from datetime import datetime, timezone
     
     # 如果 parts 列表为空,返回默认值
@@ -172,8 +467,7 @@ def to_chat_message(m: ModelMessage) -> dict:
 # 工具函数定义
 # ============================================
 
-@zhipu_agent.tool
-async def get_weather(ctx: RunContext[None], city: str) -> str:
+async def get_weather(city: str) -> str:
     """获取指定城市的天气信息
     
     当用户询问天气时调用此工具。
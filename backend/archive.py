@@ -0,0 +1,263 @@
+"""会话导出 / 导入、归档与删除回收
+
+- 导出: GET /api/sessions/export 以 NDJSON 流式输出会话记录 (每行一个会话及其全部消息),
+  可按会话 ID 或创建时间范围筛选, compress=gzip 时输出 .ndjson.gz 文件; 记录由 SQLite 直接生成 JSON,
+  按批读取, 导出大量会话时内存占用不随会话数增长
+- 导入: POST /api/sessions/import 接收同样格式的 NDJSON (可为 gzip 压缩), 边读边按批写入
+- 归档: 超过 ARCHIVE_AFTER_DAYS 天未更新的会话由后台任务移到归档库 (<数据库名>.archive.db),
+  每个会话压缩为一行。主库的 messages / chat_messages 及其索引只保留活跃会话, 更容易常驻页缓存;
+  会话列表 (GET /api/sessions) 照常列出已归档的会话 (archived 为 true), 访问其历史记录、继续对话等时自动移回主库。
+  默认关闭 (ARCHIVE_AFTER_DAYS=0)
+- 删除回收: 删除会话 (单个或批量) 只删除会话行并记录墓碑, 消息由后台每次删除 RECLAIM_BATCH_SIZE 行,
+  批次之间让出数据库线程和写锁; 回收完成后增量 vacuum 归还空闲页 (数据库启用 auto_vacuum=INCREMENTAL 时)
+- 归档和删除回收以后台优先级 (scheduling.Priority.BATCH) 访问数据库, 对话的查询不必排在批次之后
+
+导出记录的格式:
+
+    {"session": {"id", "title", "mode", "tenant_id", "created_at", "updated_at"},
+     "chat_messages": [{"role", "content", "content_type", "image_url", "created_at"}, ...],
+     "messages": [{"message_list": [...], "created_at"}, ...],
+     "tags": ["标签名", ...]}
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+import zlib
+from collections.abc import AsyncIterator
+
+from database import Database
+from scheduling import Priority, prioritized
+
+# 会话超过多少天未更新后归档, 0 表示不自动归档 (默认; 需要时显式开启)
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', '0'))
+
+# 归档任务的运行间隔 (秒)
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '3600'))
+
+# 每个事务归档的会话数, 批次之间让出数据库线程给其他请求
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '100'))
+
+# 导入时每批写入的会话数
+IMPORT_BATCH_SIZE = 100
+
+# 单行记录的最大字节数, 超出视为无效输入
+IMPORT_MAX_LINE_BYTES = int(os.getenv('IMPORT_MAX_LINE_BYTES', str(32 * 1024 * 1024)))
+
+# 每批回收的消息行数 (一个短事务)
+RECLAIM_BATCH_SIZE = int(os.getenv('RECLAIM_BATCH_SIZE', '1000'))
+
+# 回收批次之间的间隔 (秒), 让其他请求使用数据库线程和写锁
+RECLAIM_PAUSE = float(os.getenv('RECLAIM_PAUSE', '0.01'))
+
+# 检查其他 worker 留下的墓碑的间隔 (秒)
+RECLAIM_INTERVAL = 300
+
+# 每次增量 vacuum 归还的页数
+VACUUM_STEP_PAGES = 256
+
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+# ============================================
+# 导出 / 导入的流式编码
+# ============================================
+
+async def export_lines(
+    db: Database,
+    session_ids: list[str] | None,
+    since: str | None,
+    until: str | None,
+    include_archived: bool = True
+) -> AsyncIterator[bytes]:
+    """NDJSON: 每批会话合并为一个分块"""
+    async for records in db.iter_session_records(session_ids, since, until, include_archived):
+        yield ('\n'.join(records) + '\n').encode('utf-8')
+
+
+async def gzip_stream(chunks: AsyncIterator[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    """把分块流压缩为一个 gzip 文件 (不逐块刷新, 只在压缩器有输出时发送)"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush(zlib.Z_FINISH)
+
+
+async def read_lines(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """按行读取请求体, 以 gzip 魔数开头时边读边解压"""
+    decompressor = None
+    first = True
+    pending = b''
+    async for chunk in body:
+        if first and chunk:
+            first = False
+            if chunk.startswith(_GZIP_MAGIC):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        if b'\n' not in chunk:
+            pending += chunk
+            if len(pending) > IMPORT_MAX_LINE_BYTES:
+                raise ValueError(f'单行记录超过 {IMPORT_MAX_LINE_BYTES} 字节')
+            continue
+        *lines, rest = chunk.split(b'\n')
+        lines[0] = pending + lines[0]
+        pending = rest
+        for line in lines:
+            if line.strip():
+                yield line
+    if decompressor is not None:
+        pending += decompressor.flush()
+    if pending.strip():
+        yield pending
+
+
+async def import_records(db: Database, lines: AsyncIterator[bytes], overwrite: bool = False) -> dict:
+    """按批导入 NDJSON 记录, 返回导入、跳过 (已存在) 和无效的数量"""
+    totals = {'imported': 0, 'skipped': 0, 'invalid': 0}
+    batch: list[str] = []
+
+    async def flush():
+        imported, skipped, invalid = await db.import_session_records(batch, overwrite)
+        totals['imported'] += imported
+        totals['skipped'] += skipped
+        totals['invalid'] += invalid
+        batch.clear()
+
+    async for line in lines:
+        try:
+            batch.append(line.decode('utf-8'))
+        except UnicodeDecodeError:
+            totals['invalid'] += 1
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+    return totals
+
+
+# ============================================
+# 归档任务
+# ============================================
+
+class SessionArchiver:
+    """定期把长期未更新的会话移入归档库"""
+
+    def __init__(
+        self,
+        db: Database,
+        reclaimer: DeletionReclaimer | None = None,
+        idle_days: float = ARCHIVE_AFTER_DAYS,
+        interval: float = ARCHIVE_INTERVAL
+    ):
+        self.db = db
+        self.reclaimer = reclaimer
+        self.idle_days = idle_days
+        self.interval = interval
+        self.archived = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self.idle_days > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self) -> int:
+        """归档全部符合条件的会话, 返回数量"""
+        start = time.perf_counter()
+        total = 0
+        while True:
+            moved = await self.db.archive_sessions(self.idle_days, ARCHIVE_BATCH_SIZE)
+            total += moved
+            if moved < ARCHIVE_BATCH_SIZE:
+                break
+        if total:
+            self.archived += total
+            print(f'🗄️ [归档] 已归档 {total} 个超过 {self.idle_days:g} 天未更新的会话 ({(time.perf_counter() - start) * 1000:.0f}ms)')
+            if self.reclaimer is not None:
+                self.reclaimer.wake()
+        return total
+
+    @prioritized(Priority.BATCH)
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f'❌ [归档] 归档会话失败: {e}')
+            await asyncio.sleep(self.interval)
+
+
+# ============================================
+# 删除回收
+# ============================================
+
+class DeletionReclaimer:
+    """后台分批删除墓碑会话的消息, 完成后增量 vacuum"""
+
+    def __init__(self, db: Database, batch_size: int = RECLAIM_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.reclaimed_rows = 0
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            # 启动时先处理上次退出前未回收完的墓碑
+            self._wake.set()
+            self._task = asyncio.create_task(self._loop())
+
+    def wake(self):
+        """有新的墓碑时调用"""
+        self._wake.set()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self) -> int:
+        """回收全部墓碑, 返回删除的消息行数"""
+        start = time.perf_counter()
+        rows = 0
+        while (deleted := await self.db.reclaim_deleted(self.batch_size)) is not None:
+            rows += deleted
+            await asyncio.sleep(RECLAIM_PAUSE)
+        if not rows:
+            return 0
+        self.reclaimed_rows += rows
+        while await self.db.incremental_vacuum(VACUUM_STEP_PAGES):
+            await asyncio.sleep(RECLAIM_PAUSE)
+        print(f'🧹 [回收] 已删除 {rows} 行已删除会话的消息 ({(time.perf_counter() - start) * 1000:.0f}ms)')
+        return rows
+
+    @prioritized(Priority.BATCH)
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), RECLAIM_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f'❌ [回收] 回收已删除会话失败: {e}')
@@ -0,0 +1,375 @@
+"""前端静态资源
+
+嵌入模式的插件脚本由宿主页面引用, 每次打开页面都会请求:
+
+- /embedded/popup.js: 固定地址, 使用 ETag 协商缓存 (no-cache), 未变化时返回 304
+- /embedded/popup.<hash>.js: 带内容哈希的地址, 内容不会变化, 浏览器可永久缓存 (immutable)
+- /embedded/loader.js: 加载器, 只渲染悬浮按钮, 首次交互时才加载完整插件
+- /api/assets: 资源清单, 返回各文件当前的哈希地址, 供宿主页面直接引用
+
+脚本在加载时压缩 (去除注释和缩进), 并预先生成 gzip / br 版本, 请求时按 Accept-Encoding
+直接返回, 不再逐次压缩。文件修改后 (按 mtime 检测) 自动重新生成, 开发时无需重启。
+
+部署到 CDN 或 nginx (gzip_static) 时, 可预先构建到目录:
+
+    cd backend
+    python assets.py build ../frontend/embedded/dist
+
+修改脚本或压缩规则后, 检查压缩后的脚本仍能通过语法检查 (需要 node, build 时也会执行):
+
+    python assets.py check
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖
+    brotli = None
+
+# 哈希地址的缓存时间: 一年, 且声明内容不可变
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# 固定地址每次使用前需向服务器确认
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+# 哈希取前 12 位十六进制字符
+HASH_LENGTH = 12
+
+# 是否压缩脚本 (调试插件时可关闭以返回原始文件)
+ASSETS_MINIFY = os.getenv('ASSETS_MINIFY', 'true').lower() == 'true'
+
+# 预压缩的文件类型
+PRECOMPRESS_SUFFIXES = ('.js', '.css', '.html', '.svg', '.json')
+
+# 引用其他资源哈希文件名的模板: 文件名 -> {占位符: 被引用的文件名}
+TEMPLATES: dict[str, dict[str, str]] = {
+    'loader.js': {'__POPUP_FILE__': 'popup.js'},
+}
+
+
+# ============================================
+# 脚本压缩
+# ============================================
+
+# 其后的 / 是正则表达式而不是除号 (++ / -- 之后除外, 见 _starts_regex)
+_REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+# 以这些关键字结尾时 / 是正则表达式; 须为完整的单词且不是属性名 (origin / 2、a.in / 2 是除法)
+_REGEX_KEYWORDS = re.compile(r'(?<![\w$.])(?:return|typeof|case|do|else|in|of|void|throw|new|delete)$')
+_SPACES = re.compile(r'[ \t]+')
+
+
+def _starts_regex(prev: str) -> bool:
+    """prev 为 / 之前的最后一段非空白代码, 判断 / 是否开始一个正则表达式"""
+    if not prev:
+        return True
+    # 后置自增 / 自减之后是除号 (i++ / 2)
+    if prev.endswith(('++', '--')):
+        return False
+    return prev[-1] in _REGEX_PRECEDERS or _REGEX_KEYWORDS.search(prev) is not None
+
+
+def minify_js(source: str) -> str:
+    """保守的脚本压缩: 去除注释、缩进、行尾空白和空行, 合并连续空格
+
+    保留换行, 不改变自动分号插入 (ASI) 的结果; 字符串、模板字符串和正则表达式原样保留
+    """
+    out: list[str] = []
+    code: list[str] = []
+    i, n = 0, len(source)
+    # 模板字符串中 ${...} 的嵌套: 记录每层插值开始时的花括号深度
+    template_stack: list[int] = []
+    depth = 0
+
+    def flush_code():
+        if not code:
+            return
+        text = ''.join(code)
+        code.clear()
+        lines = [_SPACES.sub(' ', line) for line in text.split('\n')]
+        # 与字符串等字面量相接的一侧最多保留一个空格, 避免标识符与字面量粘连 (如变成带标签的模板字符串)
+        last = len(lines) - 1
+        lines = [
+            line.strip() if 0 < k < last else line.rstrip() if k == 0 and last else line.lstrip() if k == last and last else line
+            for k, line in enumerate(lines)
+        ]
+        joined = re.sub(r'\n{2,}', '\n', '\n'.join(lines))
+        if joined.startswith('\n') and (not out or out[-1].endswith('\n')):
+            joined = joined[1:]
+        out.append(joined)
+
+    def last_significant() -> str:
+        for chunk in (''.join(code), *reversed(out)):
+            stripped = chunk.rstrip()
+            if stripped:
+                return stripped
+        return ''
+
+    def read_template(start: int) -> int:
+        """读取模板字符串 (从 ` 开始), 遇到 ${ 时返回, 交由外层按代码处理"""
+        j = start
+        while j < n:
+            ch = source[j]
+            if ch == '\\':
+                j += 2
+                continue
+            if ch == '`':
+                return j + 1
+            if ch == '$' and j + 1 < n and source[j + 1] == '{':
+                return j + 2
+            j += 1
+        return n
+
+    while i < n:
+        ch = source[i]
+        nxt = source[i + 1] if i + 1 < n else ''
+        if ch == '/' and nxt == '/':
+            end = source.find('\n', i)
+            i = n if end == -1 else end
+            continue
+        if ch == '/' and nxt == '*':
+            end = source.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+            code.append(' ')
+            continue
+        if ch in '\'"':
+            j = i + 1
+            while j < n and source[j] != ch:
+                j += 2 if source[j] == '\\' else 1
+            flush_code()
+            out.append(source[i:j + 1])
+            i = j + 1
+            continue
+        if ch == '`' or (ch == '}' and template_stack and depth == template_stack[-1]):
+            if ch == '}':
+                template_stack.pop()
+            j = read_template(i + 1)
+            flush_code()
+            out.append(source[i:j])
+            if source[j - 2:j] == '${':
+                template_stack.append(depth)
+            i = j
+            continue
+        if ch == '/':
+            prev = last_significant()
+            if _starts_regex(prev):
+                j = i + 1
+                in_class = False
+                while j < n and source[j] != '\n':
+                    c = source[j]
+                    if c == '\\':
+                        j += 2
+                        continue
+                    if c == '[':
+                        in_class = True
+                    elif c == ']':
+                        in_class = False
+                    elif c == '/' and not in_class:
+                        break
+                    j += 1
+                j += 1
+                while j < n and (source[j].isalnum() or source[j] == '_'):
+                    j += 1
+                flush_code()
+                out.append(source[i:j])
+                i = j
+                continue
+        if ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+        code.append(ch)
+        i += 1
+    flush_code()
+    return ''.join(out).strip() + '\n'
+
+
+# ============================================
+# 资源缓存
+# ============================================
+
+@dataclass
+class Asset:
+    """一个静态文件 (压缩后) 及其内容哈希和预压缩版本"""
+
+    path: Path
+    content: bytes
+    digest: str
+    media_type: str
+    # 判断是否需要重新生成的版本标识 (文件 mtime 及所引用资源的哈希)
+    source_key: tuple
+    encoded: dict[str, bytes] = field(default_factory=dict)
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.digest}"'
+
+    def hashed_name(self) -> str:
+        """popup.js -> popup.<hash>.js"""
+        return f'{self.path.stem}.{self.digest}{self.path.suffix}'
+
+    def variant(self, encoding: str | None) -> tuple[bytes, str]:
+        """返回指定编码的内容及其 ETag (不同编码的内容不同, ETag 也需区分)"""
+        if encoding in self.encoded:
+            return self.encoded[encoding], f'"{self.digest}-{encoding}"'
+        return self.content, self.etag
+
+
+@dataclass
+class AssetRegistry:
+    """目录下静态文件的内容哈希缓存"""
+
+    root: Path
+    minify: bool = ASSETS_MINIFY
+    _assets: dict[str, Asset] = field(default_factory=dict)
+
+    def get(self, name: str) -> tuple[Asset, bool] | None:
+        """按文件名或哈希文件名查找, 返回 (资源, 是否为哈希地址)
+
+        哈希与当前内容不一致 (旧版本地址) 时返回 None
+        """
+        asset = self._load(name)
+        if asset is not None:
+            return asset, False
+        base, _, suffix = name.rpartition('.')
+        stem, _, digest = base.rpartition('.')
+        if not stem or not digest:
+            return None
+        asset = self._load(f'{stem}.{suffix}')
+        if asset is None or asset.digest != digest:
+            return None
+        return asset, True
+
+    def manifest(self, names: list[str]) -> dict[str, str]:
+        """文件名 -> 哈希文件名"""
+        result = {}
+        for name in names:
+            asset = self._load(name)
+            if asset is not None:
+                result[name] = asset.hashed_name()
+        return result
+
+    def encodings(self) -> tuple[str, ...]:
+        return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    def _load(self, name: str) -> Asset | None:
+        path = (self.root / name).resolve()
+        if path.parent != self.root.resolve() or not path.is_file():
+            return None
+        dependencies = {
+            placeholder: self._load(dependency)
+            for placeholder, dependency in TEMPLATES.get(name, {}).items()
+        }
+        source_key = (
+            path.stat().st_mtime_ns,
+            self.minify,
+            *(dep.digest for dep in dependencies.values() if dep is not None),
+        )
+        asset = self._assets.get(name)
+        if asset is None or asset.source_key != source_key:
+            content = path.read_bytes()
+            if path.suffix == '.js':
+                text = content.decode('utf-8')
+                for placeholder, dep in dependencies.items():
+                    if dep is not None:
+                        text = text.replace(placeholder, dep.hashed_name())
+                if self.minify:
+                    text = minify_js(text)
+                content = text.encode('utf-8')
+            asset = Asset(
+                path=path,
+                content=content,
+                digest=hashlib.sha256(content).hexdigest()[:HASH_LENGTH],
+                media_type=mimetypes.guess_type(path.name)[0] or 'application/octet-stream',
+                source_key=source_key,
+            )
+            if path.suffix in PRECOMPRESS_SUFFIXES:
+                asset.encoded['gzip'] = gzip.compress(content, compresslevel=9, mtime=0)
+                if brotli is not None:
+                    asset.encoded['br'] = brotli.compress(content, mode=brotli.MODE_TEXT, quality=11)
+            self._assets[name] = asset
+        return asset
+
+
+# ============================================
+# 预构建 (CDN / nginx gzip_static)
+# ============================================
+
+def check(source: Path) -> list[str]:
+    """压缩目录下的脚本并用 node --check 检查语法, 返回未通过的文件名 (未安装 node 时跳过)"""
+    node = shutil.which('node')
+    if node is None:
+        print('⚠️  未找到 node, 跳过压缩后脚本的语法检查')
+        return []
+    registry = AssetRegistry(source, minify=True)
+    failed: list[str] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in sorted(source.glob('*.js')):
+            asset = registry._load(path.name)
+            if asset is None:
+                continue
+            target = Path(tmp) / path.name
+            target.write_bytes(asset.content)
+            result = subprocess.run([node, '--check', str(target)], capture_output=True, text=True)
+            if result.returncode == 0:
+                print(f'✅ {path.name}: 压缩后语法检查通过')
+            else:
+                failed.append(path.name)
+                print(f'❌ {path.name}: 压缩后语法错误 (可设置 ASSETS_MINIFY=false 返回原始文件)')
+                print(result.stderr.strip())
+    return failed
+
+
+def build(source: Path, out: Path) -> dict[str, str]:
+    """将目录下的脚本压缩后写入 out: 哈希文件名及其 .gz / .br 版本, 以及 manifest.json"""
+    registry = AssetRegistry(source, minify=True)
+    out.mkdir(parents=True, exist_ok=True)
+    manifest: dict[str, str] = {}
+    for path in sorted(source.glob('*.js')):
+        asset = registry._load(path.name)
+        if asset is None:
+            continue
+        hashed = asset.hashed_name()
+        (out / hashed).write_bytes(asset.content)
+        for encoding, data in asset.encoded.items():
+            (out / f'{hashed}.{"br" if encoding == "br" else "gz"}').write_bytes(data)
+        manifest[path.name] = hashed
+        sizes = ', '.join(f'{encoding} {len(data)}' for encoding, data in asset.encoded.items())
+        print(f'📦 {path.name}: {path.stat().st_size} -> {len(asset.content)} 字节 ({sizes}) -> {hashed}')
+    (out / 'manifest.json').write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='构建嵌入模式静态资源')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build_parser = sub.add_parser('build', help='压缩并预压缩脚本')
+    build_parser.add_argument('out', type=Path, help='输出目录')
+    check_parser = sub.add_parser('check', help='检查压缩后的脚本能否通过语法检查 (需要 node)')
+    default_source = Path(__file__).parent.parent / 'frontend' / 'embedded'
+    for command_parser in (build_parser, check_parser):
+        command_parser.add_argument('--source', type=Path, default=default_source, help='源目录')
+    args = parser.parse_args(argv)
+    if check(args.source):
+        return 1
+    if args.command == 'build':
+        build(args.source, args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
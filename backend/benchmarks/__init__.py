@@ -0,0 +1,6 @@
+"""性能基准测试
+
+在 backend 目录下以模块方式运行, 例如:
+
+    python -m benchmarks.bench_database --scale medium
+"""
@@ -0,0 +1,129 @@
+"""响应压缩基准测试
+
+测量不同编码和压缩级别的 CPU 耗时与压缩率:
+
+- 普通响应: 大体量对话历史 JSON, 整体压缩
+- 流式响应: 一次回答的全部 NDJSON 帧, 每帧压缩后同步刷新 (与 CompressionMiddleware 一致)
+
+用法 (在 backend 目录下):
+
+    python -m benchmarks.bench_compression
+    python -m benchmarks.bench_compression --messages 5000 --frames 1000 --iterations 10
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+import compression
+from serialization import dumps, encode_frame
+
+
+def history_payload(n_messages: int) -> bytes:
+    return dumps({
+        'session_id': 'bench',
+        'messages': [
+            {
+                'id': i,
+                'role': 'user' if i % 2 == 0 else 'assistant',
+                'content': f'第 {i} 条消息: ' + '这是一段用于测试压缩率的 **Markdown** 文本, 包含 `代码` 和列表。\n' * 6,
+                'content_type': 'text',
+                'image_url': None,
+                'timestamp': '2025-01-01 12:00:00',
+            }
+            for i in range(n_messages)
+        ],
+    })
+
+
+def stream_frames(n_frames: int) -> list[bytes]:
+    """content 帧携带截至当前的完整文本"""
+    text = ''
+    frames = [encode_frame({'type': 'start', 'stream_id': 'bench', 'seq': 0})]
+    for seq in range(1, n_frames + 1):
+        text += f'第{seq}段 **markdown** 内容, 模型逐步生成的回答。'
+        frames.append(encode_frame({'type': 'content', 'content': text, 'seq': seq}))
+    frames.append(encode_frame({'type': 'end', 'seq': n_frames + 1}))
+    return frames
+
+
+def codecs(args: argparse.Namespace) -> list[tuple[str, int, Callable[[int, bool], compression.Encoder]]]:
+    result: list[tuple[str, int, Callable[[int, bool], compression.Encoder]]] = [
+        ('gzip', level, compression.GzipEncoder) for level in args.gzip_levels
+    ]
+    if compression.brotli is not None:
+        result += [('br', quality, compression.BrotliEncoder) for quality in args.brotli_qualities]
+    return result
+
+
+def measure(chunks: list[bytes], make: Callable[[], compression.Encoder], iterations: int) -> tuple[int, float]:
+    """返回 (压缩后字节数, 平均 CPU 耗时秒)"""
+    out_size = 0
+    total = 0.0
+    for _ in range(iterations):
+        start = time.process_time()
+        encoder = make()
+        out_size = sum(len(encoder.compress(chunk)) for chunk in chunks) + len(encoder.finish())
+        total += time.process_time() - start
+    return out_size, total / iterations
+
+
+def print_rows(title: str, rows: list[dict[str, Any]]):
+    print(f'\n== {title} ==')
+    print(f'{"encoding":<10}{"level":>6}{"in KB":>10}{"out KB":>10}{"ratio":>8}{"cpu ms":>10}{"MB/s":>9}')
+    for row in rows:
+        print(
+            f'{row["encoding"]:<10}{row["level"]:>6}{row["in_kb"]:>10.1f}{row["out_kb"]:>10.1f}'
+            f'{row["ratio"]:>8.2f}{row["cpu_ms"]:>10.2f}{row["mb_per_s"]:>9.1f}'
+        )
+
+
+def run(chunks: list[bytes], streaming: bool, args: argparse.Namespace) -> list[dict[str, Any]]:
+    in_size = sum(len(chunk) for chunk in chunks)
+    rows = []
+    for name, level, encoder_cls in codecs(args):
+        out_size, cpu = measure(chunks, lambda: encoder_cls(level, streaming), args.iterations)
+        rows.append({
+            'encoding': name,
+            'level': level,
+            'in_kb': in_size / 1024,
+            'out_kb': out_size / 1024,
+            'ratio': in_size / out_size,
+            'cpu_ms': cpu * 1000,
+            'mb_per_s': in_size / 1024 / 1024 / cpu if cpu else float('inf'),
+        })
+    return rows
+
+
+def main(args: argparse.Namespace) -> int:
+    print(f'可用编码: {", ".join(compression.available_encodings())}')
+    history = run([history_payload(args.messages)], False, args)
+    print_rows(f'对话历史整体压缩 ({args.messages} 条消息)', history)
+    frames = stream_frames(args.frames)
+    streamed = run(frames, True, args)
+    print_rows(f'NDJSON 流逐帧同步刷新 ({len(frames)} 帧)', streamed)
+    if args.json:
+        Path(args.json).write_text(json.dumps({'history': history, 'stream': streamed}, indent=2))
+        print(f'\n结果已写入 {args.json}')
+    return 0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='响应压缩基准测试')
+    parser.add_argument('--messages', type=int, default=2_000, help='对话历史的消息数')
+    parser.add_argument('--frames', type=int, default=500, help='流式回答的帧数')
+    parser.add_argument('--iterations', type=int, default=5, help='每种编码的重复次数')
+    parser.add_argument('--gzip-levels', type=int, nargs='+', default=[1, 5, 6, 9])
+    parser.add_argument('--brotli-qualities', type=int, nargs='+', default=[4, 5, 11])
+    parser.add_argument('--json', help='将结果写入 JSON 文件')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,459 @@
+"""Database 微基准测试
+
+针对 `Database` 的每个公开方法, 在合成数据库 (1k~1M 条消息, 10~10k 个会话) 上测量:
+
+- 单次调用延迟分布 (p50/p95/p99/max)
+- 并发 asyncio 负载下线程池的排队等待时间
+- 关键查询的 EXPLAIN QUERY PLAN, 用于发现 init_db.sql 中的索引回退
+
+用法 (在 backend 目录下):
+
+    python -m benchmarks.bench_database --scale small
+    python -m benchmarks.bench_database --scale large --concurrency 32
+    python -m benchmarks.bench_database --explain-only
+
+发现查询计划回退 (关键查询退化为全表扫描) 时以非零状态码退出, 可直接用于 CI。
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from pydantic_ai import ModelMessagesTypeAdapter, ModelRequest, ModelResponse, TextPart, UserPromptPart
+
+from archive import RECLAIM_BATCH_SIZE
+from database import (
+    _CHAT_MESSAGES_SQL,
+    _MESSAGES_SQL,
+    _RECLAIM_SQL,
+    _SESSION_SQL,
+    _WEB_CACHE_SQL,
+    Database,
+    _filter_sessions,
+    _sessions_json_sql,
+    _sessions_sql,
+)
+
+# 规模预设: (消息数, 会话数)
+SCALES: dict[str, tuple[int, int]] = {
+    'small': (1_000, 10),
+    'medium': (10_000, 100),
+    'large': (100_000, 1_000),
+    'xlarge': (1_000_000, 10_000),
+}
+
+# 批量写入合成数据时每批的行数
+INSERT_BATCH = 5_000
+
+# 合成会话随机分配的租户, 计划检查按第一个租户列出会话
+TENANTS = ('default', 'site-a', 'site-b')
+
+# 合成会话的标签 (init_db.sql 预置) 及每个标签的分配比例; 计划检查按较少命中的标签筛选
+TAGS = {'工作': 0.5, '学习': 0.2, '创作': 0.05}
+
+
+# ============================================
+# 查询计划检查
+# ============================================
+
+@dataclass
+class PlanCheck:
+    """一条需要检查执行计划的查询"""
+    name: str
+    sql: str
+    params: tuple[Any, ...]
+    # 计划中必须出现的索引名 (任意一个即可), 为空表示不检查
+    expect_any: tuple[str, ...] = ()
+    # 计划中必须全部出现的索引名 (如 UNION ALL 的每个分支)
+    expect_all: tuple[str, ...] = ()
+    # 计划中不允许出现的表扫描 (表名或查询中的别名)
+    forbid_scan: tuple[str, ...] = ()
+
+
+def sessions_check(
+    name: str, tenant_id: str, tag: str | None = None, mode: str | None = None, **expect: Any
+) -> PlanCheck:
+    """get_sessions 的计划检查, 条件与参数由 database._filter_sessions 生成"""
+    where, args = _filter_sessions(tag, mode, None, None, tenant_id)
+    return PlanCheck(name, _sessions_sql(where), (*args, 50), **expect)
+
+
+def plan_checks(session_id: str, tenant_id: str) -> list[PlanCheck]:
+    """计划检查列表; SQL 直接取自 database.py, 与实际执行的查询一致"""
+    tenant_where, tenant_args = _filter_sessions(None, None, None, None, tenant_id)
+    tag_where, tag_args = _filter_sessions('创作', None, None, None, tenant_id)
+    return [
+        PlanCheck(
+            'get_messages',
+            _MESSAGES_SQL,
+            (session_id,),
+            expect_all=('idx_messages_session', 'sqlite_autoindex_sessions_1'),
+            forbid_scan=('messages', 'sessions'),
+        ),
+        PlanCheck(
+            'get_chat_messages',
+            _CHAT_MESSAGES_SQL,
+            (session_id,),
+            expect_all=('idx_chat_messages_session', 'sqlite_autoindex_sessions_1'),
+            forbid_scan=('chat_messages', 'sessions'),
+        ),
+        sessions_check(
+            'get_sessions', tenant_id,
+            expect_any=('idx_sessions_tenant_updated',),
+            forbid_scan=('s',),
+        ),
+        sessions_check(
+            'get_sessions.mode', tenant_id, mode='embedded',
+            expect_any=('idx_sessions_tenant_updated', 'idx_sessions_mode_updated'),
+            forbid_scan=('s',),
+        ),
+        # 按标签筛选时从标签索引取会话, 不能退化为逐个检查租户的全部会话
+        sessions_check(
+            'get_sessions.tag', tenant_id, tag='创作',
+            expect_all=('idx_session_tags_tag', 'sqlite_autoindex_sessions_1'),
+            forbid_scan=('s', 'st'),
+        ),
+        sessions_check(
+            'get_sessions.tag_mode', tenant_id, tag='创作', mode='embedded',
+            expect_all=('idx_session_tags_tag', 'sqlite_autoindex_sessions_1'),
+            forbid_scan=('s', 'st'),
+        ),
+        # 活跃会话与归档会话两个分支各自使用 (租户, 更新时间) 索引
+        PlanCheck(
+            'get_sessions_json',
+            _sessions_json_sql(tenant_where, True),
+            (*tenant_args, 50, *tenant_args, 50, 50),
+            expect_all=('idx_sessions_tenant_updated', 'idx_archived_sessions_tenant_updated'),
+            forbid_scan=('s',),
+        ),
+        PlanCheck(
+            'get_sessions_json.tag',
+            _sessions_json_sql(tag_where, False),
+            (*tag_args, 50),
+            expect_all=('idx_session_tags_tag', 'sqlite_autoindex_sessions_1'),
+            forbid_scan=('s', 'st'),
+        ),
+        PlanCheck(
+            'get_session',
+            _SESSION_SQL,
+            (session_id,),
+            expect_any=('sqlite_autoindex_sessions_1',),
+            forbid_scan=('sessions',),
+        ),
+        # 删除会话只写墓碑, 后台回收按会话分批删除消息, 子查询必须使用 session_id 索引
+        PlanCheck(
+            'reclaim_deleted.chat_messages',
+            _RECLAIM_SQL[0],
+            (session_id, RECLAIM_BATCH_SIZE),
+            expect_any=('idx_chat_messages_session',),
+            forbid_scan=('chat_messages',),
+        ),
+        PlanCheck(
+            'reclaim_deleted.messages',
+            _RECLAIM_SQL[1],
+            (session_id, RECLAIM_BATCH_SIZE),
+            expect_any=('idx_messages_session',),
+            forbid_scan=('messages',),
+        ),
+        PlanCheck(
+            'get_web_cache',
+            _WEB_CACHE_SQL,
+            ('https://example.com/0',),
+            expect_any=('sqlite_autoindex_web_cache_1',),
+            forbid_scan=('web_cache',),
+        ),
+    ]
+
+
+def explain(db: Database, check: PlanCheck) -> tuple[list[str], list[str]]:
+    """返回 (计划明细, 发现的问题); 在数据库线程中执行"""
+    rows = db.con.execute(f'EXPLAIN QUERY PLAN {check.sql}', check.params).fetchall()
+    details = [row[3] for row in rows]
+    problems: list[str] = []
+    if check.expect_any and not any(idx in d for d in details for idx in check.expect_any):
+        problems.append(f'未使用索引 {" / ".join(check.expect_any)}')
+    for idx in check.expect_all:
+        if not any(idx in d for d in details):
+            problems.append(f'未使用索引 {idx}')
+    for table in check.forbid_scan:
+        # SQLite 对全表扫描输出 "SCAN <表名或别名>", 使用索引时为 "SEARCH" 或 "SCAN ... USING INDEX"
+        if any((d == f'SCAN {table}' or d.startswith(f'SCAN {table} ')) and 'USING' not in d for d in details):
+            problems.append(f'全表扫描 {table}')
+    return details, problems
+
+
+# ============================================
+# 合成数据
+# ============================================
+
+def sample_message_list() -> bytes:
+    """一轮对话的 pydantic-ai 消息 JSON, 与 chat_stream 写入的格式一致"""
+    return ModelMessagesTypeAdapter.dump_json([
+        ModelRequest(parts=[UserPromptPart('今天北京天气怎么样?')]),
+        ModelResponse(parts=[TextPart('📍 北京的天气：晴, 20°C, 湿度 45%。' * 4)]),
+    ])
+
+
+def populate(db: Database, n_messages: int, n_sessions: int) -> list[str]:
+    """批量生成会话、标签关联、消息和聊天消息; 在数据库线程中执行"""
+    rng = random.Random(42)
+    con = db.con
+    session_ids = [str(uuid.uuid4()) for _ in range(n_sessions)]
+    con.executemany(
+        "INSERT INTO sessions (id, title, mode, tenant_id, updated_at) VALUES (?, ?, ?, ?, datetime('now', ?))",
+        [
+            (
+                sid, f'会话 {i}', rng.choice(('standalone', 'embedded')), rng.choice(TENANTS),
+                f'-{rng.randrange(86400 * 90)} seconds'
+            )
+            for i, sid in enumerate(session_ids)
+        ],
+    )
+
+    con.executemany(
+        'INSERT INTO session_tags (session_id, tag_id) SELECT ?, id FROM tags WHERE name = ?',
+        [(sid, tag) for sid in session_ids for tag, ratio in TAGS.items() if rng.random() < ratio],
+    )
+
+    payload = sample_message_list().decode()
+    for start in range(0, n_messages, INSERT_BATCH):
+        count = min(INSERT_BATCH, n_messages - start)
+        # 消息按轮次交错写入不同会话, 与真实负载的物理分布相近
+        sids = [session_ids[(start + i) % n_sessions] for i in range(count)]
+        con.executemany(
+            'INSERT INTO messages (session_id, message_list) VALUES (?, ?)',
+            [(sid, payload) for sid in sids],
+        )
+        con.executemany(
+            'INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)',
+            [(sid, 'user' if (start + i) % 2 == 0 else 'assistant', '你好' * 20) for i, sid in enumerate(sids)],
+        )
+    con.commit()
+    con.execute('ANALYZE')
+    return session_ids
+
+
+# ============================================
+# 计时
+# ============================================
+
+@dataclass
+class Stats:
+    """一组延迟样本 (秒)"""
+    samples: list[float] = field(default_factory=list)
+
+    def add(self, value: float):
+        self.samples.append(value)
+
+    def summary(self) -> dict[str, float]:
+        if not self.samples:
+            return {}
+        ordered = sorted(self.samples)
+
+        def pct(p: float) -> float:
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+        return {
+            'n': len(ordered),
+            'mean_ms': statistics.fmean(ordered) * 1000,
+            'p50_ms': pct(0.50) * 1000,
+            'p95_ms': pct(0.95) * 1000,
+            'p99_ms': pct(0.99) * 1000,
+            'max_ms': ordered[-1] * 1000,
+        }
+
+
+async def timed(stats: Stats, coro: Awaitable[Any]) -> Any:
+    start = time.perf_counter()
+    result = await coro
+    stats.add(time.perf_counter() - start)
+    return result
+
+
+async def queue_probe(db: Database, stats: Stats, stop: asyncio.Event, interval: float = 0.005):
+    """周期性向数据库线程池提交空任务, 测量从提交到开始执行的排队时间"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        submitted = time.perf_counter()
+        started = await loop.run_in_executor(db._executor, time.perf_counter)
+        stats.add(started - submitted)
+        await asyncio.sleep(interval)
+
+
+# ============================================
+# 基准场景
+# ============================================
+
+def bench_cases(db: Database, session_ids: list[str], rng: random.Random) -> dict[str, Callable[[], Awaitable[Any]]]:
+    """方法名 -> 无参协程工厂"""
+    payload = sample_message_list()
+    counter = iter(range(10**9))
+
+    return {
+        'add_messages': lambda: db.add_messages(rng.choice(session_ids), payload),
+        'get_messages': lambda: db.get_messages(rng.choice(session_ids)),
+        'get_chat_messages': lambda: db.get_chat_messages(rng.choice(session_ids)),
+        'get_sessions': lambda: db.get_sessions(50, tenant_id=TENANTS[0]),
+        'get_sessions_json': lambda: db.get_sessions_json(50, tenant_id=TENANTS[0]),
+        'get_sessions_json.tag': lambda: db.get_sessions_json(50, tag='创作', tenant_id=TENANTS[0]),
+        'save_web_cache': lambda: db.save_web_cache(
+            f'https://example.com/{next(counter)}', '示例页面', '正文内容 ' * 1000
+        ),
+    }
+
+
+async def run_sequential(cases: dict[str, Callable[[], Awaitable[Any]]], iterations: int) -> dict[str, Stats]:
+    results: dict[str, Stats] = {}
+    for name, factory in cases.items():
+        stats = results.setdefault(name, Stats())
+        for _ in range(iterations):
+            await timed(stats, factory())
+    return results
+
+
+async def run_concurrent(
+    db: Database,
+    cases: dict[str, Callable[[], Awaitable[Any]]],
+    concurrency: int,
+    iterations: int,
+) -> tuple[dict[str, Stats], Stats]:
+    """多个协程混合调用各方法, 同时采样线程池排队时间"""
+    results = {name: Stats() for name in cases}
+    queue_stats = Stats()
+    names = list(cases)
+    stop = asyncio.Event()
+
+    async def worker(seed: int):
+        rng = random.Random(seed)
+        for _ in range(iterations):
+            name = rng.choice(names)
+            await timed(results[name], cases[name]())
+
+    probe = asyncio.create_task(queue_probe(db, queue_stats, stop))
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    stop.set()
+    await probe
+    return results, queue_stats
+
+
+async def bench_delete(db: Database, session_ids: list[str], samples: int) -> tuple[Stats, Stats]:
+    """删除会话 (只写墓碑) 及后台回收消息 (每次 RECLAIM_BATCH_SIZE 行); 会消耗会话, 放在最后执行"""
+    delete_stats, reclaim_stats = Stats(), Stats()
+    for sid in session_ids[:samples]:
+        await timed(delete_stats, db.delete_session(sid))
+    while True:
+        start = time.perf_counter()
+        if await db.reclaim_deleted(RECLAIM_BATCH_SIZE) is None:
+            break
+        reclaim_stats.add(time.perf_counter() - start)
+    return delete_stats, reclaim_stats
+
+
+# ============================================
+# 输出
+# ============================================
+
+def print_table(title: str, rows: dict[str, dict[str, float]]):
+    print(f'\n== {title} ==')
+    print(f'{"method":<34}{"n":>7}{"mean":>10}{"p50":>10}{"p95":>10}{"p99":>10}{"max":>10}  (ms)')
+    for name, s in rows.items():
+        if not s:
+            continue
+        print(
+            f'{name:<34}{s["n"]:>7}{s["mean_ms"]:>10.3f}{s["p50_ms"]:>10.3f}'
+            f'{s["p95_ms"]:>10.3f}{s["p99_ms"]:>10.3f}{s["max_ms"]:>10.3f}'
+        )
+
+
+async def main(args: argparse.Namespace) -> int:
+    n_messages, n_sessions = SCALES[args.scale]
+    if args.messages:
+        n_messages = args.messages
+    if args.sessions:
+        n_sessions = args.sessions
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = Path(args.db) if args.db else Path(tmp) / 'bench.db'
+        async with Database.connect(db_file) as db:
+            start = time.perf_counter()
+            session_ids = await db._asyncify(populate, db, n_messages, n_sessions)
+            print(
+                f'合成数据: {n_messages} 条消息 / {n_sessions} 个会话, '
+                f'耗时 {time.perf_counter() - start:.2f}s ({db_file})'
+            )
+
+            report: dict[str, Any] = {'scale': {'messages': n_messages, 'sessions': n_sessions}, 'plans': {}}
+            regressions = 0
+            print('\n== EXPLAIN QUERY PLAN ==')
+            for check in plan_checks(session_ids[0], TENANTS[0]):
+                details, problems = await db._asyncify(explain, db, check)
+                regressions += bool(problems)
+                report['plans'][check.name] = {'plan': details, 'problems': problems}
+                print(f'{"❌" if problems else "✅"} {check.name}: {" | ".join(details)}')
+                for problem in problems:
+                    print(f'     {problem}')
+
+            if not args.explain_only:
+                rng = random.Random(7)
+                cases = bench_cases(db, session_ids, rng)
+
+                sequential = await run_sequential(cases, args.iterations)
+                print_table('顺序调用', {k: v.summary() for k, v in sequential.items()})
+
+                concurrent, queue_stats = await run_concurrent(db, cases, args.concurrency, args.iterations)
+                print_table(
+                    f'并发调用 (concurrency={args.concurrency})',
+                    {k: v.summary() for k, v in concurrent.items()} | {'executor_queue_wait': queue_stats.summary()},
+                )
+
+                delete_stats, reclaim_stats = await bench_delete(
+                    db, session_ids, min(args.delete_samples, len(session_ids))
+                )
+                print_table('删除与回收', {
+                    'delete_session': delete_stats.summary(), 'reclaim_deleted': reclaim_stats.summary()
+                })
+
+                report['sequential'] = {k: v.summary() for k, v in sequential.items()}
+                report['concurrent'] = {k: v.summary() for k, v in concurrent.items()}
+                report['executor_queue_wait'] = queue_stats.summary()
+                report['delete_session'] = delete_stats.summary()
+                report['reclaim_deleted'] = reclaim_stats.summary()
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f'\n结果已写入 {args.json}')
+
+    if regressions:
+        print(f'\n❌ 发现 {regressions} 条查询计划回退')
+        return 1
+    return 0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Database 微基准测试')
+    parser.add_argument('--scale', choices=SCALES, default='small', help='数据规模预设')
+    parser.add_argument('--messages', type=int, help='覆盖预设的消息数')
+    parser.add_argument('--sessions', type=int, help='覆盖预设的会话数')
+    parser.add_argument('--iterations', type=int, default=200, help='每个方法 / 每个并发协程的调用次数')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发协程数')
+    parser.add_argument('--delete-samples', type=int, default=5, help='删除与回收采样的会话数')
+    parser.add_argument('--db', help='数据库文件路径 (默认使用临时文件)')
+    parser.add_argument('--json', help='将结果写入 JSON 文件')
+    parser.add_argument('--explain-only', action='store_true', help='只检查查询计划')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
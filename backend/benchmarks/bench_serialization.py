@@ -0,0 +1,159 @@
+"""JSON 序列化基准测试
+
+比较流式帧编码和大体量对话历史响应在不同序列化路径下的耗时:
+
+- 帧编码: 原先的 json.dumps(...).encode() 与 serialization.encode_frame (stdlib / orjson)
+- 对话历史: 逐行构造 dict + FastAPI jsonable_encoder + 标准库渲染 (原先的路径),
+  dict + FastJSONResponse, 以及 SQLite json 函数直接生成 (get_chat_history_json)
+
+用法 (在 backend 目录下):
+
+    python -m benchmarks.bench_serialization
+    python -m benchmarks.bench_serialization --messages 1000 10000 100000 --iterations 20
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+import uuid
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+import serialization
+from benchmarks.bench_database import Stats, print_table
+from database import Database
+
+
+def legacy_frame(frame: dict[str, Any]) -> bytes:
+    return json.dumps(frame).encode('utf-8') + b'\n'
+
+
+def frame_encoders() -> dict[str, Callable[[dict[str, Any]], bytes]]:
+    encoders: dict[str, Callable[[dict[str, Any]], bytes]] = {
+        'json.dumps (legacy)': legacy_frame,
+        'encode_frame[stdlib]': lambda frame: serialization._stdlib_dumps(frame) + b'\n',
+    }
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        encoders['encode_frame[orjson]'] = lambda frame: orjson.dumps(frame) + b'\n'
+    return encoders
+
+
+def bench_frames(n_frames: int, iterations: int) -> dict[str, Stats]:
+    """模拟一次回答的全部 content 帧 (每帧携带截至当前的完整文本)"""
+    text = ''
+    frames = []
+    for seq in range(n_frames):
+        text += f'第{seq}段 **markdown** 内容 '
+        frames.append({'type': 'content', 'content': text, 'seq': seq})
+    results: dict[str, Stats] = {}
+    for name, encode in frame_encoders().items():
+        stats = results[name] = Stats()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            for frame in frames:
+                encode(frame)
+            stats.add(time.perf_counter() - start)
+    return results
+
+
+def populate_history(db: Database, n_messages: int) -> str:
+    session_id = str(uuid.uuid4())
+    con = db.con
+    con.execute('INSERT INTO sessions (id, title) VALUES (?, ?)', (session_id, '基准测试'))
+    con.executemany(
+        'INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)',
+        [
+            (session_id, 'user' if i % 2 == 0 else 'assistant', f'消息 {i}: ' + '你好, "world"\n' * 10)
+            for i in range(n_messages)
+        ],
+    )
+    con.commit()
+    return session_id
+
+
+async def bench_history(db: Database, session_id: str, iterations: int) -> tuple[dict[str, Stats], int]:
+    async def legacy() -> bytes:
+        messages = await db.get_chat_messages(session_id)
+        content = jsonable_encoder({'session_id': session_id, 'messages': messages})
+        return JSONResponse(content).body
+
+    async def fast_response() -> bytes:
+        messages = await db.get_chat_messages(session_id)
+        content = jsonable_encoder({'session_id': session_id, 'messages': messages})
+        return serialization.FastJSONResponse(content).body
+
+    async def sqlite_json() -> bytes:
+        return serialization.RawJSONResponse(await db.get_chat_history_json(session_id)).body
+
+    paths = {
+        'dict + jsonable_encoder + json': legacy,
+        f'dict + FastJSONResponse[{serialization.BACKEND}]': fast_response,
+        'get_chat_history_json': sqlite_json,
+    }
+    expected = json.loads(await legacy())
+    results: dict[str, Stats] = {}
+    size = 0
+    for name, path in paths.items():
+        body = await path()
+        if json.loads(body) != expected:
+            raise AssertionError(f'{name} 的输出与原实现不一致')
+        size = len(body)
+        stats = results[name] = Stats()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            await path()
+            stats.add(time.perf_counter() - start)
+    return results, size
+
+
+async def main(args: argparse.Namespace) -> int:
+    print(f'序列化实现: {serialization.BACKEND}')
+    frames = bench_frames(args.frames, args.iterations)
+    print_table(f'帧编码 ({args.frames} 帧 / 次)', {k: v.summary() for k, v in frames.items()})
+
+    report: dict[str, Any] = {
+        'backend': serialization.BACKEND,
+        'frames': {k: v.summary() for k, v in frames.items()},
+        'history': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        async with Database.connect(Path(tmp) / 'bench.db') as db:
+            for n_messages in args.messages:
+                session_id = await db._asyncify(populate_history, db, n_messages)
+                history, size = await bench_history(db, session_id, args.iterations)
+                print_table(
+                    f'对话历史 ({n_messages} 条消息, {size / 1024:.0f} KB)',
+                    {k: v.summary() for k, v in history.items()},
+                )
+                report['history'][n_messages] = {k: v.summary() for k, v in history.items()}
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f'\n结果已写入 {args.json}')
+    return 0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='JSON 序列化基准测试')
+    parser.add_argument('--messages', type=int, nargs='+', default=[1_000, 10_000, 50_000], help='对话历史的消息数')
+    parser.add_argument('--frames', type=int, default=500, help='每次回答的帧数')
+    parser.add_argument('--iterations', type=int, default=20, help='每种路径的重复次数')
+    parser.add_argument('--json', help='将结果写入 JSON 文件')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,208 @@
+"""响应压缩
+
+根据 Accept-Encoding 协商 br (安装了 brotli 时) 或 gzip:
+
+- 普通响应: 完整响应体不小于 COMPRESSION_MIN_SIZE 时整体压缩
+- 流式响应 (NDJSON / SSE): 每个分块压缩后立即同步刷新 (gzip Z_SYNC_FLUSH / brotli flush),
+  客户端收到的每一帧都能立即解压, 不会被压缩器缓冲而延迟。content 帧携带截至当前的完整文本,
+  与前一帧高度重复, 流式压缩的收益很大
+
+已设置 Content-Encoding 的响应 (如预压缩的静态文件) 和图片等不可压缩的类型原样透传。
+"""
+
+from __future__ import annotations
+
+import os
+import zlib
+from typing import Protocol
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖
+    brotli = None
+
+# 是否启用压缩
+COMPRESSION_ENABLED = os.getenv('COMPRESSION', 'true').lower() == 'true'
+
+# 普通响应的最小压缩大小 (字节), 更小的响应压缩收益不抵开销
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+
+# 压缩级别 (见 benchmarks/bench_compression.py): 流式响应的相邻帧高度重复,
+# gzip 6 的压缩率比 5 高近一倍而 CPU 只多约 25%, 因此两者默认相同; brotli 流式使用较低质量
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+GZIP_STREAM_LEVEL = int(os.getenv('GZIP_STREAM_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+BROTLI_STREAM_QUALITY = int(os.getenv('BROTLI_STREAM_QUALITY', '4'))
+
+# 可压缩的内容类型
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'image/svg+xml',
+)
+
+
+class Encoder(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    def finish(self) -> bytes: ...
+
+
+class GzipEncoder:
+    """gzip 编码; streaming 为 True 时每次 compress 都同步刷新"""
+
+    def __init__(self, level: int, streaming: bool):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._streaming = streaming
+
+    def compress(self, data: bytes) -> bytes:
+        out = self._obj.compress(data)
+        if self._streaming:
+            out += self._obj.flush(zlib.Z_SYNC_FLUSH)
+        return out
+
+    def finish(self) -> bytes:
+        return self._obj.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder:
+    """brotli 编码; streaming 为 True 时每次 compress 都刷新"""
+
+    def __init__(self, quality: int, streaming: bool):
+        self._obj = brotli.Compressor(mode=brotli.MODE_TEXT, quality=quality)
+        self._streaming = streaming
+
+    def compress(self, data: bytes) -> bytes:
+        out = self._obj.process(data)
+        if self._streaming:
+            out += self._obj.flush()
+        return out
+
+    def finish(self) -> bytes:
+        return self._obj.finish()
+
+
+def available_encodings() -> tuple[str, ...]:
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def make_encoder(encoding: str, streaming: bool) -> Encoder:
+    if encoding == 'br':
+        return BrotliEncoder(BROTLI_STREAM_QUALITY if streaming else BROTLI_QUALITY, streaming)
+    return GzipEncoder(GZIP_STREAM_LEVEL if streaming else GZIP_LEVEL, streaming)
+
+
+def negotiate(accept_encoding: str) -> str | None:
+    """按 Accept-Encoding 的 q 值选择编码, 同等权重时优先 br"""
+    offered: dict[str, float] = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[name] = q
+    best, best_q = None, 0.0
+    for encoding in available_encodings():
+        q = offered.get(encoding, offered.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressionMiddleware:
+    """gzip / brotli 压缩中间件 (纯 ASGI 实现, 不缓冲流式响应)"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or not COMPRESSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressedResponder(self.app, encoding, self.minimum_size)(scope, receive, send)
+
+
+class _CompressedResponder:
+    """处理单个响应: 根据第一个响应体分块决定整体压缩、流式压缩或透传"""
+
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send: Send
+        self.start_message: Message | None = None
+        self.encoder: Encoder | None = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_wrapper)
+
+    async def send_wrapper(self, message: Message):
+        message_type = message['type']
+        if message_type == 'http.response.start':
+            headers = Headers(raw=message['headers'])
+            content_type = headers.get('content-type', '')
+            self.passthrough = (
+                'content-encoding' in headers
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+            )
+            if self.passthrough:
+                await self.send(message)
+            else:
+                # 等到第一个响应体分块才能判断是否为流式响应
+                self.start_message = message
+            return
+
+        if message_type != 'http.response.body' or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            if not more_body and len(body) < self.minimum_size:
+                # 响应体过小, 不压缩
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+            self.encoder = make_encoder(self.encoding, streaming=more_body)
+            headers = MutableHeaders(raw=start['headers'])
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            if more_body:
+                del headers['Content-Length']
+            else:
+                body = self.encoder.compress(body) + self.encoder.finish()
+                headers['Content-Length'] = str(len(body))
+                await self.send(start)
+                await self.send({'type': 'http.response.body', 'body': body})
+                return
+            await self.send(start)
+
+        assert self.encoder is not None
+        chunk = self.encoder.compress(body) if body else b''
+        if not more_body:
+            chunk += self.encoder.finish()
+        if chunk or not more_body:
+            await self.send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
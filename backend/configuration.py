@@ -0,0 +1,119 @@
+"""运行时配置缓存
+
+user_config 表的内存快照: 启动时加载一次, 之后请求路径上的配置 (默认模型、是否流式输出、
+输出合并策略、自动标题) 直接读取快照, 不访问数据库。
+
+- 版本: 表上的触发器维护 resource_versions 中的 'config' 版本, 快照记录加载时的版本
+- 写入: save 可携带期望版本 (HTTP If-Match), 版本不一致时拒绝, 避免覆盖其他客户端的修改;
+  写入后立即重新加载本进程的快照, 并通过 InvalidationBus 的 config 通道通知其他 worker 重新加载
+- 订阅: on_change 注册的回调在每次快照替换后调用 (如 streams.apply_flush_config 预先解析合并策略)
+"""
+
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Callable, Mapping
+from types import MappingProxyType
+
+from coordination import InvalidationBus
+from database import Database
+
+# 失效通知通道
+CONFIG_CHANNEL = 'config'
+
+# 只在服务端使用、不通过 API 读取的配置分类 (如 API Key)
+PRIVATE_CATEGORIES = frozenset({'api'})
+
+_TRUE_VALUES = frozenset({'true', '1', 'yes', 'on'})
+
+# 快照变化回调: 参数为新的配置快照
+ChangeListener = Callable[[Mapping[str, str]], None]
+
+
+class ConfigStore:
+    """user_config 的进程内快照"""
+
+    db: Database
+    bus: InvalidationBus
+
+    def __init__(self):
+        self.version = 0
+        self.reloads = 0
+        self._values: Mapping[str, str] = MappingProxyType({})
+        self._categories: dict[str, str] = {}
+        self._listeners: list[ChangeListener] = []
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+
+    async def start(self, db: Database, bus: InvalidationBus):
+        """加载快照并订阅其他 worker 的修改"""
+        self.db = db
+        self.bus = bus
+        bus.subscribe(CONFIG_CHANNEL, self._on_invalidated)
+        await self.reload()
+
+    def on_change(self, listener: ChangeListener):
+        """注册快照变化回调 (已加载时立即以当前快照调用一次)"""
+        self._listeners.append(listener)
+        if self.reloads:
+            listener(self._values)
+
+    # ============================================
+    # 读取 (不访问数据库)
+    # ============================================
+
+    def get(self, key: str, default: str | None = None) -> str | None:
+        return self._values.get(key, default)
+
+    def get_bool(self, key: str, default: bool = False) -> bool:
+        value = self._values.get(key)
+        return default if value is None else value.strip().lower() in _TRUE_VALUES
+
+    def is_public(self, key: str) -> bool:
+        return key in self._values and self._categories.get(key) not in PRIVATE_CATEGORIES
+
+    def public(self) -> dict[str, str]:
+        """可通过 API 返回的配置"""
+        return {key: value for key, value in self._values.items() if self.is_public(key)}
+
+    # ============================================
+    # 写入与重新加载
+    # ============================================
+
+    async def save(
+        self, key: str, value: str, category: str | None = None, expected_version: int | None = None
+    ) -> int | None:
+        """保存配置并刷新快照, 返回新版本; expected_version 与当前版本不一致时不写入, 返回 None"""
+        version = await self.db.save_config(key, value, category, expected_version)
+        if version is None:
+            return None
+        await self.reload()
+        await self.bus.publish(CONFIG_CHANNEL, key)
+        return version
+
+    async def reload(self):
+        """从数据库重新加载快照 (版本未变化时保持原快照)"""
+        async with self._lock:
+            version, rows = await self.db.get_config_snapshot()
+            if self.reloads and version == self.version:
+                return
+            self._values = MappingProxyType({key: value for key, value, _ in rows})
+            self._categories = {key: category for key, _, category in rows}
+            self.version = version
+            self.reloads += 1
+        for listener in self._listeners:
+            try:
+                listener(self._values)
+            except Exception as e:
+                print(f'❌ [配置] 应用配置失败: {e}')
+
+    def _on_invalidated(self, _key: str | None):
+        task = asyncio.create_task(self._reload_quietly())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reload_quietly(self):
+        try:
+            await self.reload()
+        except Exception as e:
+            print(f'❌ [配置] 重新加载配置失败: {e}')
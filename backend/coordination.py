@@ -0,0 +1,83 @@
+"""多进程协调
+
+多 worker 部署时每个进程都有自己的内存缓存, 通过 SQLite 中的
+cache_invalidations 表广播失效事件: 写入方插入一条通知并立即在本进程内分发,
+其他 worker 周期性轮询新通知并分发给订阅者。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import uuid
+from collections import defaultdict
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+from database import Database
+
+# 轮询间隔 (秒)
+POLL_INTERVAL = float(os.getenv('INVALIDATION_POLL_INTERVAL', '0.5'))
+
+# 每隔多少次轮询清理一次旧通知
+PRUNE_EVERY = 120
+
+# 订阅回调: 参数为失效的键, None 表示整个通道失效
+Subscriber = Callable[[str | None], None]
+
+
+@dataclass
+class InvalidationBus:
+    """跨 worker 的缓存失效通知"""
+
+    db: Database
+    interval: float = POLL_INTERVAL
+    origin: str = field(default_factory=lambda: f'{os.getpid()}-{uuid.uuid4().hex[:8]}')
+    _subscribers: dict[str, list[Subscriber]] = field(default_factory=lambda: defaultdict(list))
+    _last_id: int = 0
+    _task: asyncio.Task | None = None
+
+    def subscribe(self, channel: str, callback: Subscriber):
+        """订阅指定通道的失效事件"""
+        self._subscribers[channel].append(callback)
+
+    async def publish(self, channel: str, key: str | None = None):
+        """发布失效事件: 本进程立即生效, 其他 worker 在下次轮询时生效"""
+        self._dispatch(channel, key)
+        await self.db.add_invalidation(channel, key, self.origin)
+
+    async def start(self):
+        """从当前最新通知开始监听 (不回放历史通知)"""
+        self._last_id = await self.db.get_last_invalidation_id()
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _poll(self):
+        polls = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                for row_id, channel, key, origin in await self.db.get_invalidations(self._last_id):
+                    self._last_id = row_id
+                    if origin != self.origin:
+                        self._dispatch(channel, key)
+                polls += 1
+                if polls % PRUNE_EVERY == 0:
+                    await self.db.prune_invalidations()
+            except Exception as e:
+                print(f'❌ [缓存同步] 轮询失败: {e}')
+
+    def _dispatch(self, channel: str, key: str | None):
+        for callback in self._subscribers.get(channel, ()):
+            try:
+                callback(key)
+            except Exception as e:
+                print(f'❌ [缓存同步] 处理 {channel}:{key} 失败: {e}')
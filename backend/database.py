@@ -7,66 +7,441 @@ from __future__ import annotations
 
 import asyncio
 import json
+import os
 import sqlite3
+import zlib
 from collections.abc import AsyncIterator, Callable
-from concurrent.futures.thread import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from functools import partial
 from pathlib import Path
-from typing import Any, TypeVar
+from typing import TYPE_CHECKING, Any, TypeVar
 
-from pydantic_ai import ModelMessage, ModelMessagesTypeAdapter
 from typing_extensions import LiteralString, ParamSpec
 
+from scheduling import DB_BATCH_CONCURRENCY, DB_MEDIA_CONCURRENCY, Priority, PriorityExecutor
+
+if TYPE_CHECKING:
+    from pydantic_ai import ModelMessage
+
 P = ParamSpec('P')
 R = TypeVar('R')
 
+# sqlite3 行工厂: (cursor, 原始行元组) -> 返回值
+RowFactory = Callable[[sqlite3.Cursor, tuple], Any]
+
+# 数据库结构版本, 修改 init_db.sql 后需递增
+# 记录在 PRAGMA user_version 中, 版本一致时启动跳过初始化脚本
+SCHEMA_VERSION = 10
+
+# 新版本在已有的表上增加的列 (CREATE TABLE IF NOT EXISTS 不会修改已存在的表), 执行初始化脚本前补齐
+_ADDED_COLUMNS: dict[str, list[tuple[str, str]]] = {
+    'sessions': [('tenant_id', "TEXT NOT NULL DEFAULT 'default'")],
+}
+
+# 默认租户: 本站自身 (不使用 API Key 的请求), 升级前的会话都属于该租户
+DEFAULT_TENANT_ID = 'default'
+
+# 写锁等待时间 (毫秒), 多进程部署时其他 worker 持有写锁会在此时间内重试而不是立即报错
+BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+
+# 预编译语句缓存大小: 本模块的 SQL 都是固定字符串 (约 40 条), 留出余量保证全部命中缓存
+STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '256'))
+
+# 大结果集分批读取时每批的行数
+FETCH_BATCH_SIZE = 500
+
+# 导出时每批读取的会话数 (每个会话附带全部消息)
+EXPORT_BATCH_SIZE = 50
+
+# 归档数据库: 与主数据库同目录, 如 chat.db -> chat.archive.db
+ARCHIVE_SUFFIX = '.archive'
+
+# 归档库结构 (ATTACH 为 archive); 会话的完整记录 (与导出格式相同) 以 zlib 压缩后存为一行,
+# 列表需要的字段 (含租户) 另存为列, 会话列表不必解压记录
+ARCHIVE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archive.archived_sessions (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    mode TEXT,
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    payload BLOB NOT NULL,
+    tenant_id TEXT NOT NULL DEFAULT 'default'
+);
+CREATE INDEX IF NOT EXISTS archive.idx_archived_sessions_updated ON archived_sessions(updated_at DESC);
+'''
+
+# 归档库的租户索引 (旧的归档库补齐 tenant_id 列之后创建)
+ARCHIVE_TENANT_INDEX = '''CREATE INDEX IF NOT EXISTS archive.idx_archived_sessions_tenant_updated
+ON archived_sessions(tenant_id, updated_at DESC)'''
+
+# 一个会话的导出记录, 由 SQLite 直接生成 JSON (会话表别名为 s)
+_SESSION_RECORD: LiteralString = '''json_object(
+    'session', json_object(
+        'id', s.id, 'title', s.title, 'mode', s.mode, 'tenant_id', s.tenant_id,
+        'created_at', s.created_at, 'updated_at', s.updated_at),
+    'chat_messages', json(COALESCE((
+        SELECT json_group_array(json_object(
+            'role', role, 'content', content, 'content_type', content_type,
+            'image_url', image_url, 'created_at', created_at))
+        FROM (SELECT * FROM chat_messages WHERE session_id = s.id ORDER BY id)
+    ), '[]')),
+    'messages', json(COALESCE((
+        SELECT json_group_array(json_object(
+            'message_list', json(CAST(message_list AS TEXT)), 'created_at', created_at))
+        FROM (SELECT * FROM messages WHERE session_id = s.id ORDER BY id)
+    ), '[]')),
+    'tags', json(COALESCE((
+        SELECT json_group_array(t.name) FROM session_tags st JOIN tags t ON t.id = st.tag_id WHERE st.session_id = s.id
+    ), '[]'))
+)'''
+
+# 导出 (?1 会话 ID 的 JSON 数组或 NULL, ?2 / ?3 创建时间范围, ?4 / ?5 上一批最后的 (created_at, id), ?6 批大小)
+_EXPORT_HOT_SQL: LiteralString = 'SELECT ' + _SESSION_RECORD + ''', s.created_at, s.id
+FROM sessions s
+WHERE (?1 IS NULL OR s.id IN (SELECT value FROM json_each(?1)))
+  AND (?2 IS NULL OR s.created_at >= ?2) AND (?3 IS NULL OR s.created_at < ?3)
+  AND (s.created_at, s.id) > (?4, ?5)
+ORDER BY s.created_at, s.id LIMIT ?6'''
+
+_EXPORT_ARCHIVED_SQL: LiteralString = '''SELECT a.payload, a.created_at, a.id
+FROM archive.archived_sessions a
+WHERE (?1 IS NULL OR a.id IN (SELECT value FROM json_each(?1)))
+  AND (?2 IS NULL OR a.created_at >= ?2) AND (?3 IS NULL OR a.created_at < ?3)
+  AND (a.created_at, a.id) > (?4, ?5)
+ORDER BY a.created_at, a.id LIMIT ?6'''
+
+# 会话列表的一项 (会话表别名为 s), tags 为标签 ID 列表
+_SESSION_ITEM: LiteralString = '''json_object(
+    'id', s.id, 'title', s.title, 'mode', s.mode, 'created_at', s.created_at, 'updated_at', s.updated_at,
+    'tags', json(COALESCE((SELECT json_group_array(tag_id) FROM session_tags WHERE session_id = s.id), '[]')),
+    'archived', json('false'))'''
+
+# 会话列表中已归档的一项 (归档表别名为 s); 标签保存在压缩的记录中, 恢复后才可见
+_ARCHIVED_SESSION_ITEM: LiteralString = '''json_object(
+    'id', s.id, 'title', s.title, 'mode', s.mode, 'created_at', s.created_at, 'updated_at', s.updated_at,
+    'tags', json('[]'), 'archived', json('true'))'''
+
+# 批量删除: 同时满足 ?1 会话 ID 的 JSON 数组、?2 标签名、?3 超过天数未更新 (为 NULL 的条件不限制)
+_MATCH_SESSIONS_SQL: LiteralString = '''SELECT s.id FROM sessions s
+WHERE (?1 IS NULL OR s.id IN (SELECT value FROM json_each(?1)))
+  AND (?2 IS NULL OR s.id IN (
+      SELECT st.session_id FROM session_tags st JOIN tags t ON t.id = st.tag_id WHERE t.name = ?2))
+  AND (?3 IS NULL OR s.updated_at < datetime('now', '-' || ?3 || ' days'))'''
+
+# 归档候选: 超过 ?1 天未更新的会话, 最多 ?2 个
+_ARCHIVE_CANDIDATES_SQL: LiteralString = 'SELECT ' + _SESSION_RECORD + ''', s.id, s.title, s.mode, s.created_at, s.updated_at, s.tenant_id
+FROM sessions s
+WHERE s.updated_at < datetime('now', '-' || ?1 || ' days')
+ORDER BY s.updated_at LIMIT ?2'''
+
+# 会话的 AI 上下文 / 格式化消息 (?1 会话 ID); 会话已删除 (消息尚未回收) 时不返回
+_MESSAGES_SQL: LiteralString = '''SELECT message_list FROM messages
+WHERE session_id = ?1 AND EXISTS (SELECT 1 FROM sessions WHERE id = ?1) ORDER BY id'''
+
+_CHAT_MESSAGES_SQL: LiteralString = '''SELECT id, role, content, content_type, image_url, created_at FROM chat_messages
+WHERE session_id = ?1 AND EXISTS (SELECT 1 FROM sessions WHERE id = ?1) ORDER BY id'''
+
+_SESSION_SQL: LiteralString = 'SELECT id, title, mode, created_at, updated_at FROM sessions WHERE id = ?'
+
+# 未过期的网页缓存 (?1 URL)
+_WEB_CACHE_SQL: LiteralString = '''SELECT url, title, content, summary, json_data, created_at
+FROM web_cache
+WHERE url = ? AND (expires_at IS NULL OR expires_at > datetime('now'))'''
+
+# 回收墓碑会话的消息: 每条删除 ?1 会话的至多 ?2 行 (-1 表示不限), 先删格式化消息
+_RECLAIM_SQL: tuple[LiteralString, ...] = (
+    'DELETE FROM chat_messages WHERE id IN (SELECT id FROM chat_messages WHERE session_id = ? LIMIT ?)',
+    'DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE session_id = ? LIMIT ?)',
+)
+
+
+# ============================================
+# 行工厂: 在数据库线程中直接把元组映射为返回值
+# ============================================
+
+def _chat_message_row(_cursor: sqlite3.Cursor, row: tuple) -> dict:
+    return {
+        'id': row[0],
+        'role': row[1],
+        'content': row[2],
+        'content_type': row[3],
+        'image_url': row[4],
+        'timestamp': row[5]
+    }
+
+
+def _session_row(_cursor: sqlite3.Cursor, row: tuple) -> dict:
+    return {
+        'id': row[0],
+        'title': row[1],
+        'mode': row[2],
+        'created_at': row[3],
+        'updated_at': row[4]
+    }
+
+
+def _draw_history_row(_cursor: sqlite3.Cursor, row: tuple) -> dict:
+    return {
+        'id': row[0],
+        'prompt': row[1],
+        'image_url': row[2],
+        'model': row[3],
+        'parameters': row[4],
+        'created_at': row[5]
+    }
+
+
+def _web_cache_row(_cursor: sqlite3.Cursor, row: tuple) -> dict:
+    return {
+        'url': row[0],
+        'title': row[1],
+        'content': row[2],
+        'summary': row[3],
+        'json_data': row[4],
+        'created_at': row[5]
+    }
+
+
+def _tag_row(_cursor: sqlite3.Cursor, row: tuple) -> dict:
+    return {
+        'id': row[0],
+        'name': row[1],
+        'color': row[2],
+        'created_at': row[3],
+        'session_count': row[4]
+    }
+
+
+def _tenant_row(_cursor: sqlite3.Cursor, row: tuple) -> dict:
+    return {
+        'id': row[0],
+        'name': row[1],
+        'key_hash': row[2],
+        'allowed_origins': json.loads(row[3] or '[]'),
+        'rate_limit': row[4],
+        'max_concurrency': row[5],
+        'created_at': row[6]
+    }
+
+
+def _tenant_usage_row(_cursor: sqlite3.Cursor, row: tuple) -> dict:
+    return {
+        'tenant_id': row[0],
+        'date': row[1],
+        'model': row[2],
+        'requests': row[3],
+        'rejected': row[4],
+        'errors': row[5],
+        'tokens_input': row[6],
+        'tokens_output': row[7]
+    }
+
+
+def _scalar_row(_cursor: sqlite3.Cursor, row: tuple) -> Any:
+    return row[0]
+
+
+def _archived_record_row(_cursor: sqlite3.Cursor, row: tuple) -> tuple:
+    return zlib.decompress(row[0]).decode('utf-8'), row[1], row[2]
+
+
+def _archived_session_row(_cursor: sqlite3.Cursor, row: tuple) -> dict:
+    return {
+        'id': row[0],
+        'title': row[1],
+        'mode': row[2],
+        'created_at': row[3],
+        'updated_at': row[4],
+        'archived_at': row[5]
+    }
+
+
+def _is_data_error(e: sqlite3.Error) -> bool:
+    """是否为记录内容导致的错误 (违反约束、JSON 格式错误等); 锁冲突、磁盘错误等不属于此类"""
+    if isinstance(e, sqlite3.IntegrityError):
+        return True
+    # json_extract / json_each 解析失败时为一般错误 SQLITE_ERROR, 锁冲突为 SQLITE_BUSY / SQLITE_LOCKED
+    return isinstance(e, sqlite3.OperationalError) and getattr(e, 'sqlite_errorcode', None) == sqlite3.SQLITE_ERROR
+
+
+def _filter_sessions(
+    tag: str | None,
+    mode: str | None,
+    since: str | None,
+    until: str | None,
+    tenant_id: str | None = None
+) -> tuple[LiteralString, list[Any]]:
+    """会话列表的筛选条件和排序 (会话表别名为 s): 标签名、模式、更新时间范围 [since, until)、租户, 按更新时间倒序
+
+    只拼接用到的条件, 使查询计划能使用对应的索引: 只按模式筛选时使用 idx_sessions_mode_updated,
+    按租户列出时使用 idx_sessions_tenant_updated。按标签筛选时从 idx_session_tags_tag 取该标签的会话再按主键读取、排序:
+    会话表上的条件和排序列加一元 + 号, 使规划器不能改用租户或更新时间索引逐个会话检查标签 (标签较少命中时需要扫描租户的全部会话)
+    """
+    sql: LiteralString = ''
+    conditions: list[LiteralString] = []
+    args: list[Any] = []
+    col: LiteralString = 's.'
+    # 参数顺序与 SQL 中的占位符一致: 先 JOIN 的标签, 再 WHERE 条件
+    if tag is not None:
+        sql = ' JOIN session_tags st ON st.session_id = s.id AND st.tag_id = (SELECT id FROM tags WHERE name = ?)'
+        args.append(tag)
+        col = '+s.'
+    if tenant_id is not None:
+        conditions.append(col + 'tenant_id = ?')
+        args.append(tenant_id)
+    if mode is not None:
+        conditions.append(col + 'mode = ?')
+        args.append(mode)
+    if since is not None:
+        conditions.append(col + 'updated_at >= ?')
+        args.append(since)
+    if until is not None:
+        conditions.append(col + 'updated_at < ?')
+        args.append(until)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    return sql + ' ORDER BY ' + col + 'updated_at DESC', args
+
+
+def _sessions_sql(where: LiteralString) -> LiteralString:
+    """会话列表 (get_sessions); where 为 _filter_sessions 的条件和排序, 参数为其参数和数量上限"""
+    return 'SELECT s.id, s.title, s.mode, s.created_at, s.updated_at FROM sessions s' + where + ' LIMIT ?'
+
+
+def _sessions_json_sql(where: LiteralString, include_archived: bool) -> LiteralString:
+    """会话列表 JSON (get_sessions_json)
+
+    where 为 _filter_sessions 的条件和排序 (包含归档会话时不能按标签筛选)。
+    参数: 只列出活跃会话时为 where 的参数和数量上限;
+    包含归档会话时两边各取前 limit 个再合并 (各自使用 (租户, 更新时间) 索引), 参数为 where 的参数、上限各两遍, 再加合并后的上限
+    """
+    if not include_archived:
+        return '''SELECT json_object('sessions', json(COALESCE((
+               SELECT json_group_array(json(item)) FROM (
+                   SELECT ''' + _SESSION_ITEM + ''' AS item FROM sessions s''' + where + ''' LIMIT ?)
+           ), '[]')))'''
+    return '''SELECT json_object('sessions', json(COALESCE((
+           SELECT json_group_array(json(item)) FROM (
+               SELECT item, updated_at FROM (
+                   SELECT ''' + _SESSION_ITEM + ''' AS item, s.updated_at FROM sessions s''' + where + ''' LIMIT ?)
+               UNION ALL
+               SELECT item, updated_at FROM (
+                   SELECT ''' + _ARCHIVED_SESSION_ITEM + ''' AS item, s.updated_at
+                   FROM archive.archived_sessions s''' + where + ''' LIMIT ?)
+               ORDER BY updated_at DESC LIMIT ?)
+       ), '[]')))'''
+
 
 @dataclass
 class Database:
     """数据库操作类
     
-    SQLite 是同步的,使用线程池实现异步操作
+    SQLite 是同步的,使用单个线程实现异步操作 (排队的操作按调用方的优先级执行, 见 scheduling.py)
     """
     
     con: sqlite3.Connection
     _loop: asyncio.AbstractEventLoop
-    _executor: ThreadPoolExecutor
+    _executor: PriorityExecutor
 
     @classmethod
     @asynccontextmanager
     async def connect(cls, file: Path) -> AsyncIterator[Database]:
         """连接数据库"""
         loop = asyncio.get_event_loop()
-        executor = ThreadPoolExecutor(max_workers=1)
+        executor = PriorityExecutor('db', caps={
+            Priority.MEDIA: DB_MEDIA_CONCURRENCY,
+            Priority.BATCH: DB_BATCH_CONCURRENCY,
+        })
         con = await loop.run_in_executor(executor, cls._connect, file)
         slf = cls(con, loop, executor)
         try:
             yield slf
         finally:
             await slf._asyncify(con.close)
+            executor.shutdown(wait=False)
 
     @staticmethod
     def _connect(file: Path) -> sqlite3.Connection:
         """建立数据库连接并初始化"""
-        con = sqlite3.connect(str(file))
+        con = sqlite3.connect(
+            str(file),
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        
+        # 多个 worker 共享同一数据库文件, 遇到写锁时等待而非立即失败
+        con.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
         
         # 启用外键约束
         con.execute('PRAGMA foreign_keys=ON')
         
-        # 启用 WAL 模式提升性能
+        user_version = con.execute('PRAGMA user_version').fetchone()[0]
+        if user_version == 0:
+            # 新建的数据库启用增量 vacuum, 删除会话后可逐步归还空闲页 (须在建表和切换 WAL 之前设置;
+            # 已有的数据库需手动执行一次 VACUUM 才能切换)
+            con.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        
+        # 启用 WAL 模式提升性能 (读写互不阻塞, 写入之间仍需串行)
         con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
         
-        # 读取并执行初始化 SQL
+        # 读取并执行初始化 SQL (结构已是最新版本时跳过)
         init_sql_file = Path(__file__).parent / 'init_db.sql'
-        if init_sql_file.exists():
+        if user_version < SCHEMA_VERSION and init_sql_file.exists():
+            # 脚本中的索引可能引用新增的列, 先为已有的表补齐
+            for table, columns in _ADDED_COLUMNS.items():
+                existing = {row[1] for row in con.execute(f'PRAGMA table_info({table})')}
+                for name, definition in columns:
+                    if existing and name not in existing:
+                        con.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
             init_sql = init_sql_file.read_text()
             con.executescript(init_sql)
+            con.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        
+        con.commit()
         
+        # 附加归档数据库 (长期未访问的会话移到这里, 主库的表和索引保持小而常驻缓存)
+        archive_file = file.with_name(f'{file.stem}{ARCHIVE_SUFFIX}{file.suffix}')
+        con.execute('ATTACH DATABASE ? AS archive', (str(archive_file),))
+        con.execute('PRAGMA archive.auto_vacuum=INCREMENTAL')
+        con.execute('PRAGMA archive.journal_mode=WAL')
+        con.executescript(ARCHIVE_SCHEMA)
+        Database._migrate_archive(con)
         con.commit()
         return con
 
+    @staticmethod
+    def _migrate_archive(con: sqlite3.Connection):
+        """旧的归档库补齐 tenant_id 列 (从压缩的记录中读取, 没有租户的记录归档于升级之前, 属于默认租户)"""
+        existing = {row[1] for row in con.execute('PRAGMA archive.table_info(archived_sessions)')}
+        if 'tenant_id' not in existing:
+            con.execute(f"ALTER TABLE archive.archived_sessions ADD COLUMN tenant_id TEXT NOT NULL DEFAULT '{DEFAULT_TENANT_ID}'")
+            rows = con.execute('SELECT id, payload FROM archive.archived_sessions').fetchall()
+            con.executemany(
+                'UPDATE archive.archived_sessions SET tenant_id = ? WHERE id = ?',
+                [(tenant_id, id_) for id_, payload in rows
+                 if (tenant_id := json.loads(zlib.decompress(payload)).get('session', {}).get('tenant_id'))
+                 and tenant_id != DEFAULT_TENANT_ID]
+            )
+        con.execute(ARCHIVE_TENANT_INDEX)
+
+    async def prewarm(self):
+        """预热连接: 将常用表和索引页读入页缓存"""
+        await self._asyncify(self._prewarm)
+
+    def _prewarm(self):
+        for sql in (
+            'SELECT count(*) FROM sessions',
+            'SELECT id, title, mode, created_at, updated_at FROM sessions ORDER BY updated_at DESC LIMIT 50',
+            'SELECT count(*) FROM messages INDEXED BY idx_messages_session',
+            'SELECT count(*) FROM chat_messages INDEXED BY idx_chat_messages_session',
+            'SELECT key, value FROM user_config',
+        ):
+            self.con.execute(sql).fetchall()
+
     # ============================================
     # 消息相关操作
     # ============================================
@@ -82,15 +457,17 @@ class Database:
 
     async def get_messages(self, session_id: str) -> list[ModelMessage]:
         """获取会话的所有消息"""
-        c = await self._asyncify(
-            self._execute, 
-            'SELECT message_list FROM messages WHERE session_id = ? ORDER BY id',
-            session_id
-        )
-        rows = await self._asyncify(c.fetchall)
+        from pydantic_ai import ModelMessagesTypeAdapter
+
         messages: list[ModelMessage] = []
-        for row in rows:
-            messages.extend(ModelMessagesTypeAdapter.validate_json(row[0]))
+        # 分批读取, 解析上一批时数据库线程可以处理其他查询
+        async for rows in self._iterate(
+            _MESSAGES_SQL,
+            session_id,
+            row_factory=_scalar_row
+        ):
+            for message_list in rows:
+                messages.extend(ModelMessagesTypeAdapter.validate_json(message_list))
         return messages
 
     # ============================================
@@ -115,131 +492,714 @@ class Database:
 
     async def get_chat_messages(self, session_id: str) -> list[dict]:
         """获取会话的所有格式化消息"""
-        c = await self._asyncify(
-            self._execute,
-            'SELECT id, role, content, content_type, image_url, created_at FROM chat_messages WHERE session_id = ? ORDER BY id',
-            session_id
-        )
-        rows = await self._asyncify(c.fetchall)
-        return [
-            {
-                'id': row[0],
-                'role': row[1],
-                'content': row[2],
-                'content_type': row[3],
-                'image_url': row[4],
-                'timestamp': row[5]
-            }
-            for row in rows
-        ]
+        return await self._query(
+            _CHAT_MESSAGES_SQL,
+            session_id,
+            row_factory=_chat_message_row
+        )
+
+    async def get_chat_history_json(self, session_id: str) -> str:
+        """获取会话的对话历史, 直接由 SQLite 生成 JSON
+
+        结构与 {'session_id': ..., 'messages': get_chat_messages(...)} 相同,
+        消息较多时省去逐行构造 dict 和再次序列化的开销
+        """
+        return await self._query_one(
+            '''SELECT json_object(
+                   'session_id', ?1,
+                   'messages', json(COALESCE((
+                       SELECT json_group_array(json_object(
+                           'id', id, 'role', role, 'content', content, 'content_type', content_type,
+                           'image_url', image_url, 'timestamp', created_at))
+                       FROM (SELECT * FROM chat_messages
+                             WHERE session_id = ?1 AND EXISTS (SELECT 1 FROM sessions WHERE id = ?1) ORDER BY id)
+                   ), '[]')))''',
+            session_id,
+            row_factory=_scalar_row
+        )
+
+    async def add_chat_turn(
+        self, session_id: str, message: str, response: str, new_messages: bytes
+    ) -> tuple[int, int]:
+        """在一个事务中保存一轮完整的对话 (AI 上下文、两条聊天消息、会话更新时间)
+
+        返回写入前后的历史版本; 两者之间没有其他写入, 调用方可据此判断缓存的上下文是否仍然完整
+        """
+        return await self._asyncify(self._add_chat_turn, session_id, message, response, new_messages)
+
+    def _add_chat_turn(self, session_id: str, message: str, response: str, new_messages: bytes) -> tuple[int, int]:
+        if self.con.in_transaction:
+            self.con.commit()
+        # 立即取得写锁, 读取的写入前版本不会被其他 worker 插入的写入改变
+        self.con.execute('BEGIN IMMEDIATE')
+        try:
+            before = self._history_version(session_id)
+            self.con.execute('INSERT INTO messages (session_id, message_list) VALUES (?, ?)', (session_id, new_messages))
+            self.con.executemany(
+                "INSERT INTO chat_messages (session_id, role, content, content_type) VALUES (?, ?, ?, 'text')",
+                [(session_id, 'user', message), (session_id, 'assistant', response)]
+            )
+            self.con.execute('UPDATE sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (session_id,))
+            after = self._history_version(session_id)
+            self.con.commit()
+        except BaseException:
+            self.con.rollback()
+            raise
+        return before, after
+
+    def _history_version(self, session_id: str) -> int:
+        row = self.con.execute(
+            'SELECT version FROM resource_versions WHERE resource = ?', (f'history:{session_id}',)
+        ).fetchone()
+        return row[0] if row else 0
+
+    async def get_chat_history_compact(self, session_id: str, limit: int) -> str:
+        """最近 limit 条聊天消息的精简 JSON: {'session_id', 'messages': [[role, content, content_type, image_url], ...]}
+
+        用于嵌入插件打开前的预取, 按时间正序; 只读取最后 limit 行 (按 ID 倒序走会话索引)
+        """
+        return await self._query_one(
+            '''SELECT json_object(
+                   'session_id', ?1,
+                   'messages', json(COALESCE((
+                       SELECT json_group_array(json_array(role, content, content_type, image_url))
+                       FROM (SELECT * FROM (
+                                 SELECT id, role, content, content_type, image_url FROM chat_messages
+                                 WHERE session_id = ?1 AND EXISTS (SELECT 1 FROM sessions WHERE id = ?1)
+                                 ORDER BY id DESC LIMIT ?2)
+                             ORDER BY id)
+                   ), '[]')))''',
+            session_id, limit,
+            row_factory=_scalar_row
+        )
 
     # ============================================
     # 会话管理操作
     # ============================================
 
-    async def create_session(self, session_id: str, title: str, mode: str = 'standalone'):
+    async def create_session(
+        self, session_id: str, title: str, mode: str = 'standalone', tenant_id: str = DEFAULT_TENANT_ID
+    ):
         """创建新会话"""
         await self._asyncify(
             self._execute,
-            'INSERT INTO sessions (id, title, mode) VALUES (?, ?, ?);',
-            session_id, title, mode,
+            'INSERT INTO sessions (id, title, mode, tenant_id) VALUES (?, ?, ?, ?);',
+            session_id, title, mode, tenant_id,
             commit=True
         )
 
-    async def get_sessions(self, limit: int = 50) -> list[dict]:
-        """获取会话列表"""
-        c = await self._asyncify(
-            self._execute,
-            'SELECT id, title, mode, created_at, updated_at FROM sessions ORDER BY updated_at DESC LIMIT ?',
-            limit
-        )
-        rows = await self._asyncify(c.fetchall)
-        return [
-            {
-                'id': row[0],
-                'title': row[1],
-                'mode': row[2],
-                'created_at': row[3],
-                'updated_at': row[4]
-            }
-            for row in rows
-        ]
+    async def get_sessions(
+        self,
+        limit: int = 50,
+        tag: str | None = None,
+        mode: str | None = None,
+        since: str | None = None,
+        until: str | None = None,
+        tenant_id: str | None = None
+    ) -> list[dict]:
+        """获取会话列表 (筛选条件见 _filter_sessions)"""
+        where, args = _filter_sessions(tag, mode, since, until, tenant_id)
+        return await self._query(
+            _sessions_sql(where),
+            *args, limit,
+            row_factory=_session_row
+        )
+
+    async def get_sessions_json(
+        self,
+        limit: int = 50,
+        tag: str | None = None,
+        mode: str | None = None,
+        since: str | None = None,
+        until: str | None = None,
+        tenant_id: str | None = None
+    ) -> str:
+        """获取会话列表, 直接由 SQLite 生成 JSON ({'sessions': [...]}, 每项附带标签 ID 列表)
+
+        已归档的会话与活跃会话按更新时间合并列出 (archived 为 true, 访问时自动移回主库);
+        按标签筛选时只列出活跃会话 (归档会话的标签在压缩的记录中)
+        """
+        where, args = _filter_sessions(tag, mode, since, until, tenant_id)
+        if tag is not None:
+            return await self._query_one(_sessions_json_sql(where, False), *args, limit, row_factory=_scalar_row)
+        return await self._query_one(
+            _sessions_json_sql(where, True),
+            *args, limit, *args, limit, limit,
+            row_factory=_scalar_row
+        )
 
     async def get_session(self, session_id: str) -> dict | None:
         """获取单个会话信息"""
-        c = await self._asyncify(
-            self._execute,
-            'SELECT id, title, mode, created_at, updated_at FROM sessions WHERE id = ?',
-            session_id
-        )
-        row = await self._asyncify(c.fetchone)
-        if row:
-            return {
-                'id': row[0],
-                'title': row[1],
-                'mode': row[2],
-                'created_at': row[3],
-                'updated_at': row[4]
-            }
-        return None
-
-    async def update_session(self, session_id: str, title: str | None = None):
-        """更新会话信息"""
+        return await self._query_one(
+            _SESSION_SQL,
+            session_id,
+            row_factory=_session_row
+        )
+
+    async def update_session(
+        self, session_id: str, title: str | None = None, expected_title: str | None = None
+    ) -> bool:
+        """更新会话信息, 返回是否更新; 提供 expected_title 时只在当前标题与之相同时修改标题 (避免覆盖用户的修改)"""
         if title:
-            await self._asyncify(
+            cur = await self._asyncify(
                 self._execute,
-                'UPDATE sessions SET title = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-                title, session_id,
+                '''UPDATE sessions SET title = ?, updated_at = CURRENT_TIMESTAMP
+                   WHERE id = ? AND (?3 IS NULL OR title = ?3)''',
+                title, session_id, expected_title,
                 commit=True
             )
         else:
-            await self._asyncify(
+            cur = await self._asyncify(
                 self._execute,
                 'UPDATE sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?',
                 session_id,
                 commit=True
             )
+        return cur.rowcount > 0
+
+    async def get_session_titles(self, session_ids: list[str]) -> dict[str, str]:
+        """批量获取会话标题 (不存在的会话不包含在结果中)"""
+        return dict(await self._query(
+            'SELECT id, title FROM sessions WHERE id IN (SELECT value FROM json_each(?))',
+            json.dumps(session_ids)
+        ))
+
+    async def get_session_tenant(self, session_id: str) -> str | None:
+        """获取会话所属的租户 (包括已归档的会话), 会话不存在时返回 None"""
+        return await self._asyncify(self._get_session_tenant, session_id)
+
+    def _get_session_tenant(self, session_id: str) -> str | None:
+        row = self.con.execute('SELECT tenant_id FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        if row is not None:
+            return row[0]
+        row = self.con.execute('SELECT tenant_id FROM archive.archived_sessions WHERE id = ?', (session_id,)).fetchone()
+        return row[0] if row is not None else None
 
     async def delete_session(self, session_id: str):
-        """删除会话及其消息"""
-        await self._asyncify(
+        """删除会话 (包括已归档的会话); 消息由后台分批回收, 见 delete_sessions"""
+        await self.delete_sessions(session_ids=[session_id])
+
+    # ============================================
+    # 批量删除 (墓碑 + 后台分批回收)
+    # ============================================
+
+    async def delete_sessions(
+        self,
+        session_ids: list[str] | None = None,
+        tag: str | None = None,
+        older_than_days: float | None = None
+    ) -> tuple[int, int]:
+        """删除同时满足各条件的会话, 返回 (主库删除数, 归档库删除数)
+
+        只删除会话行并记录墓碑, 立即生效; 消息量可能很大, 由 reclaim_deleted 在后台分批删除,
+        不会长时间占用数据库线程和写锁。按标签筛选时只匹配主库中的会话
+        """
+        return await self._asyncify(self._delete_sessions, session_ids, tag, older_than_days)
+
+    def _delete_sessions(
+        self, session_ids: list[str] | None, tag: str | None, older_than_days: float | None
+    ) -> tuple[int, int]:
+        ids = json.dumps(session_ids) if session_ids is not None else None
+        matched = [row[0] for row in self.con.execute(_MATCH_SESSIONS_SQL, (ids, tag, older_than_days))]
+        deleted = self._tombstone_sessions(matched)
+        archived = self.con.execute(
+            '''DELETE FROM archive.archived_sessions
+               WHERE (?1 IS NULL OR id IN (SELECT value FROM json_each(?1)))
+                 AND ?2 IS NULL
+                 AND (?3 IS NULL OR updated_at < datetime('now', '-' || ?3 || ' days'))''',
+            (ids, tag, older_than_days)
+        ).rowcount
+        self.con.commit()
+        return deleted, archived
+
+    def _tombstone_sessions(self, session_ids: list[str]) -> int:
+        """删除会话行但保留其消息, 记录墓碑供后台回收 (提交当前事务)"""
+        if not session_ids:
+            return 0
+        if self.con.in_transaction:
+            self.con.commit()
+        # 外键开关只能在事务外切换; 关闭期间删除会话不会级联删除消息
+        self.con.execute('PRAGMA foreign_keys=OFF')
+        try:
+            ids = json.dumps(session_ids)
+            self.con.execute(
+                '''INSERT OR IGNORE INTO session_tombstones (session_id)
+                   SELECT id FROM sessions WHERE id IN (SELECT value FROM json_each(?))''',
+                (ids,)
+            )
+            # 标签关联行数很少, 随会话立即删除, 标签统计不包含已删除的会话
+            self.con.execute('DELETE FROM session_tags WHERE session_id IN (SELECT value FROM json_each(?))', (ids,))
+            deleted = self.con.execute(
+                'DELETE FROM sessions WHERE id IN (SELECT value FROM json_each(?))', (ids,)
+            ).rowcount
+            self.con.commit()
+        finally:
+            if self.con.in_transaction:
+                self.con.rollback()
+            self.con.execute('PRAGMA foreign_keys=ON')
+        return deleted
+
+    async def reclaim_deleted(self, batch_size: int) -> int | None:
+        """删除最早一个墓碑会话的至多 batch_size 行消息 (一个短事务), 没有待回收的会话时返回 None"""
+        return await self._asyncify(self._reclaim_deleted, batch_size)
+
+    def _reclaim_deleted(self, batch_size: int) -> int | None:
+        row = self.con.execute('SELECT session_id FROM session_tombstones ORDER BY deleted_at LIMIT 1').fetchone()
+        if row is None:
+            return None
+        deleted = self._reclaim_session(row[0], batch_size)
+        self.con.commit()
+        return deleted
+
+    def _reclaim_session(self, session_id: str, batch_size: int | None) -> int:
+        """删除会话的消息 (batch_size 为 None 时全部删除), 删完后移除墓碑; 不提交"""
+        limit = -1 if batch_size is None else batch_size
+        deleted = 0
+        for sql in _RECLAIM_SQL:
+            deleted += self.con.execute(sql, (session_id, limit if limit < 0 else limit - deleted)).rowcount
+            if 0 <= limit <= deleted:
+                return deleted
+        self.con.execute('DELETE FROM session_tags WHERE session_id = ?', (session_id,))
+        self.con.execute('DELETE FROM session_tombstones WHERE session_id = ?', (session_id,))
+        return deleted
+
+    async def incremental_vacuum(self, pages: int) -> int | None:
+        """把至多 pages 个空闲页归还给文件系统, 返回剩余空闲页数; 未启用 auto_vacuum=INCREMENTAL 时返回 None"""
+        return await self._asyncify(self._incremental_vacuum, pages)
+
+    def _incremental_vacuum(self, pages: int) -> int | None:
+        if self.con.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return None
+        # 该 PRAGMA 每执行一步只归还一页, execute 只执行一步, executescript 会执行到结束
+        self.con.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+        return self.con.execute('PRAGMA freelist_count').fetchone()[0]
+
+    # ============================================
+    # 导出 / 导入 / 归档
+    # ============================================
+
+    async def iter_session_records(
+        self,
+        session_ids: list[str] | None = None,
+        since: str | None = None,
+        until: str | None = None,
+        include_archived: bool = True
+    ) -> AsyncIterator[list[str]]:
+        """分批导出会话记录 (每条为一个 JSON 文本), 按创建时间排序
+
+        session_ids 为空时导出全部; since / until 按创建时间筛选 (until 不含)
+        """
+        ids = json.dumps(session_ids) if session_ids else None
+        for sql, row_factory in (
+            (_EXPORT_HOT_SQL, None),
+            (_EXPORT_ARCHIVED_SQL, _archived_record_row),
+        ):
+            if row_factory is not None and not include_archived:
+                break
+            after = ('', '')
+            while True:
+                # 按 (created_at, id) 分页, 每批一次线程池调用
+                rows = await self._query(
+                    sql, ids, since, until, after[0], after[1], EXPORT_BATCH_SIZE, row_factory=row_factory
+                )
+                if rows:
+                    yield [row[0] for row in rows]
+                    after = rows[-1][1], rows[-1][2]
+                if len(rows) < EXPORT_BATCH_SIZE:
+                    break
+
+    async def import_session_records(self, records: list[str], overwrite: bool = False) -> tuple[int, int, int]:
+        """导入一批会话记录 (导出格式), 返回 (导入数, 已存在而跳过数, 无效数)"""
+        return await self._asyncify(self._import_session_records, records, overwrite)
+
+    def _import_session_records(self, records: list[str], overwrite: bool) -> tuple[int, int, int]:
+        imported = skipped = invalid = 0
+        if self.con.in_transaction:
+            self.con.commit()
+        # 整批在一个事务中写入, 每条记录一个保存点, 无效记录只回滚自身。
+        # 立即取得写锁: 先读后写的延迟事务在其他 worker 提交后写入会失败 (SQLITE_BUSY_SNAPSHOT, busy_timeout 不重试)
+        self.con.execute('BEGIN IMMEDIATE')
+        try:
+            for record in records:
+                self.con.execute('SAVEPOINT import_record')
+                try:
+                    result = self._import_record(record, overwrite)
+                except sqlite3.Error as e:
+                    if not _is_data_error(e):
+                        raise
+                    self.con.execute('ROLLBACK TO import_record')
+                    result = None
+                self.con.execute('RELEASE import_record')
+                if result is None:
+                    invalid += 1
+                elif result:
+                    imported += 1
+                else:
+                    skipped += 1
+            self.con.commit()
+        except BaseException:
+            self.con.rollback()
+            raise
+        return imported, skipped, invalid
+
+    def _import_record(self, record: str, overwrite: bool, archived_check: bool = True) -> bool | None:
+        """写入一条会话记录 (不提交); 会话已存在 (archived_check 时包括归档库) 且不覆盖时返回 False,
+        记录无效时返回 None
+        """
+        session_id = self.con.execute("SELECT json_extract(?, '$.session.id')", (record,)).fetchone()[0]
+        if not isinstance(session_id, str) or not session_id:
+            return None
+        if self.con.execute('SELECT 1 FROM session_tombstones WHERE session_id = ?', (session_id,)).fetchone():
+            # 同一 ID 的旧消息尚未回收, 先删除, 避免混入新导入的会话
+            self._reclaim_session(session_id, None)
+        if overwrite:
+            self.con.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+            self.con.execute('DELETE FROM archive.archived_sessions WHERE id = ?', (session_id,))
+        elif archived_check and self.con.execute(
+            'SELECT 1 FROM archive.archived_sessions WHERE id = ?', (session_id,)
+        ).fetchone():
+            return False
+        cur = self.con.execute(
+            '''INSERT INTO sessions (id, title, mode, tenant_id, created_at, updated_at)
+               SELECT ?2, COALESCE(json_extract(?1, '$.session.title'), '导入的会话'),
+                      COALESCE(json_extract(?1, '$.session.mode'), 'standalone'),
+                      COALESCE(json_extract(?1, '$.session.tenant_id'), ?3),
+                      COALESCE(json_extract(?1, '$.session.created_at'), CURRENT_TIMESTAMP),
+                      COALESCE(json_extract(?1, '$.session.updated_at'), CURRENT_TIMESTAMP)
+               WHERE true
+               ON CONFLICT (id) DO NOTHING''',
+            (record, session_id, DEFAULT_TENANT_ID)
+        )
+        if cur.rowcount == 0:
+            return False
+        self.con.execute(
+            '''INSERT INTO chat_messages (session_id, role, content, content_type, image_url, created_at)
+               SELECT ?2, json_extract(value, '$.role'), json_extract(value, '$.content'),
+                      COALESCE(json_extract(value, '$.content_type'), 'text'), json_extract(value, '$.image_url'),
+                      COALESCE(json_extract(value, '$.created_at'), CURRENT_TIMESTAMP)
+               FROM json_each(?1, '$.chat_messages') ORDER BY key''',
+            (record, session_id)
+        )
+        self.con.execute(
+            '''INSERT INTO messages (session_id, message_list, created_at)
+               SELECT ?2, json_extract(value, '$.message_list'),
+                      COALESCE(json_extract(value, '$.created_at'), CURRENT_TIMESTAMP)
+               FROM json_each(?1, '$.messages') ORDER BY key''',
+            (record, session_id)
+        )
+        # 标签按名称关联, 不存在的标签自动创建
+        self.con.execute(
+            '''INSERT INTO tags (name) SELECT value FROM json_each(?, '$.tags') WHERE type = 'text'
+               ON CONFLICT (name) DO NOTHING''',
+            (record,)
+        )
+        self.con.execute(
+            '''INSERT OR IGNORE INTO session_tags (session_id, tag_id)
+               SELECT ?2, t.id FROM json_each(?1, '$.tags') j JOIN tags t ON t.name = j.value''',
+            (record, session_id)
+        )
+        return True
+
+    async def archive_sessions(self, idle_days: float, limit: int) -> int:
+        """把超过 idle_days 天未更新的会话 (最多 limit 个) 移入归档库, 返回移动的数量"""
+        return await self._asyncify(self._archive_sessions, idle_days, limit)
+
+    def _archive_sessions(self, idle_days: float, limit: int) -> int:
+        rows = self.con.execute(_ARCHIVE_CANDIDATES_SQL, (idle_days, limit)).fetchall()
+        if not rows:
+            return 0
+        self.con.executemany(
+            '''INSERT OR REPLACE INTO archive.archived_sessions
+                   (id, title, mode, created_at, updated_at, payload, tenant_id)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            [(id_, title, mode, created_at, updated_at, zlib.compress(record.encode('utf-8')), tenant_id)
+             for record, id_, title, mode, created_at, updated_at, tenant_id in rows]
+        )
+        # 先写入归档库再删除; 两个库的提交不是原子的, 中途退出时会话会同时存在于两边, 访问时以主库为准
+        self.con.commit()
+        # 主库中的消息由后台分批回收
+        self._tombstone_sessions([row[1] for row in rows])
+        return len(rows)
+
+    async def rehydrate_session(self, session_id: str) -> bool:
+        """会话已归档时移回主库 (视为一次访问, 更新 updated_at), 返回是否发生了移动"""
+        return await self._asyncify(self._rehydrate_session, session_id)
+
+    def _rehydrate_session(self, session_id: str) -> bool:
+        row = self.con.execute('SELECT payload FROM archive.archived_sessions WHERE id = ?', (session_id,)).fetchone()
+        if row is None:
+            return False
+        restored = self._import_record(zlib.decompress(row[0]).decode('utf-8'), overwrite=False, archived_check=False)
+        if restored:
+            self.con.execute('UPDATE sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (session_id,))
+        self.con.execute('DELETE FROM archive.archived_sessions WHERE id = ?', (session_id,))
+        self.con.commit()
+        return bool(restored)
+
+    async def get_archived_sessions(self, limit: int = 50) -> list[dict]:
+        """获取已归档的会话列表"""
+        return await self._query(
+            '''SELECT id, title, mode, created_at, updated_at, archived_at
+               FROM archive.archived_sessions ORDER BY updated_at DESC LIMIT ?''',
+            limit,
+            row_factory=_archived_session_row
+        )
+
+    # ============================================
+    # 标签管理操作
+    # ============================================
+
+    async def get_tags(self) -> list[dict]:
+        """获取全部标签及各自的会话数 (读取 tag_stats, 不做聚合)"""
+        return await self._query(
+            '''SELECT t.id, t.name, t.color, t.created_at, COALESCE(ts.session_count, 0)
+               FROM tags t LEFT JOIN tag_stats ts ON ts.tag_id = t.id ORDER BY t.id''',
+            row_factory=_tag_row
+        )
+
+    async def create_tag(self, name: str, color: str | None = None) -> int | None:
+        """创建标签, 返回 ID; 同名标签已存在时返回 None"""
+        return await self._asyncify(self._create_tag, name, color)
+
+    def _create_tag(self, name: str, color: str | None) -> int | None:
+        row = self.con.execute(
+            '''INSERT INTO tags (name, color) VALUES (?1, COALESCE(?2, '#667eea'))
+               ON CONFLICT (name) DO NOTHING RETURNING id''',
+            (name, color)
+        ).fetchone()
+        self.con.commit()
+        return row[0] if row else None
+
+    async def update_tag(self, tag_id: int, name: str | None = None, color: str | None = None) -> bool:
+        """修改标签名称或颜色, 返回标签是否存在; 名称与其他标签重复时抛出 sqlite3.IntegrityError"""
+        return await self._asyncify(self._update_tag, tag_id, name, color)
+
+    def _update_tag(self, tag_id: int, name: str | None, color: str | None) -> bool:
+        try:
+            cur = self.con.execute(
+                'UPDATE tags SET name = COALESCE(?, name), color = COALESCE(?, color) WHERE id = ?',
+                (name, color, tag_id)
+            )
+        except sqlite3.IntegrityError:
+            # 结束失败语句开启的事务, 不要持有写锁到下一次提交
+            self.con.rollback()
+            raise
+        self.con.commit()
+        return cur.rowcount > 0
+
+    async def delete_tag(self, tag_id: int) -> bool:
+        """删除标签及其会话关联, 返回标签是否存在"""
+        cur = await self._asyncify(self._execute, 'DELETE FROM tags WHERE id = ?', tag_id, commit=True)
+        return cur.rowcount > 0
+
+    async def set_session_tags(self, session_id: str, tag_ids: list[int]) -> list[int] | None:
+        """把会话的标签替换为 tag_ids (忽略不存在的标签), 返回会话当前的标签 ID; 会话不存在时返回 None"""
+        return await self._asyncify(self._set_session_tags, session_id, tag_ids)
+
+    def _set_session_tags(self, session_id: str, tag_ids: list[int]) -> list[int] | None:
+        if self.con.execute('SELECT 1 FROM sessions WHERE id = ?', (session_id,)).fetchone() is None:
+            return None
+        ids = json.dumps(tag_ids)
+        # 只增删有变化的关联, 未变化时不触发统计和版本更新
+        self.con.execute(
+            'DELETE FROM session_tags WHERE session_id = ? AND tag_id NOT IN (SELECT value FROM json_each(?))',
+            (session_id, ids)
+        )
+        self.con.execute(
+            '''INSERT OR IGNORE INTO session_tags (session_id, tag_id)
+               SELECT ?, id FROM tags WHERE id IN (SELECT value FROM json_each(?))''',
+            (session_id, ids)
+        )
+        self.con.commit()
+        return self._session_tag_ids(session_id)
+
+    async def add_session_tag(self, session_id: str, tag_id: int) -> list[int] | None:
+        """为会话添加一个标签, 返回会话当前的标签 ID; 会话或标签不存在时返回 None"""
+        return await self._asyncify(self._add_session_tag, session_id, tag_id)
+
+    def _add_session_tag(self, session_id: str, tag_id: int) -> list[int] | None:
+        self.con.execute(
+            '''INSERT OR IGNORE INTO session_tags (session_id, tag_id)
+               SELECT s.id, t.id FROM sessions s, tags t WHERE s.id = ? AND t.id = ?''',
+            (session_id, tag_id)
+        )
+        self.con.commit()
+        tag_ids = self._session_tag_ids(session_id)
+        return tag_ids if tag_id in tag_ids else None
+
+    async def remove_session_tag(self, session_id: str, tag_id: int) -> bool:
+        """移除会话的一个标签, 返回关联是否存在"""
+        cur = await self._asyncify(
             self._execute,
-            'DELETE FROM sessions WHERE id = ?',
-            session_id,
+            'DELETE FROM session_tags WHERE session_id = ? AND tag_id = ?',
+            session_id, tag_id,
             commit=True
         )
+        return cur.rowcount > 0
+
+    def _session_tag_ids(self, session_id: str) -> list[int]:
+        return [row[0] for row in self.con.execute(
+            'SELECT tag_id FROM session_tags WHERE session_id = ? ORDER BY tag_id', (session_id,)
+        )]
 
     # ============================================
-    # 配置管理操作
+    # 租户管理操作
     # ============================================
 
-    async def save_config(self, key: str, value: str):
-        """保存配置"""
-        await self._asyncify(
+    async def get_tenants(self) -> list[dict]:
+        """获取全部租户 (不包括默认租户)"""
+        return await self._query(
+            '''SELECT id, name, key_hash, allowed_origins, rate_limit, max_concurrency, created_at
+               FROM tenants ORDER BY created_at''',
+            row_factory=_tenant_row
+        )
+
+    async def create_tenant(
+        self,
+        tenant_id: str,
+        name: str,
+        key_hash: str,
+        allowed_origins: list[str],
+        rate_limit: int | None = None,
+        max_concurrency: int | None = None
+    ) -> bool:
+        """创建租户, 返回是否创建; ID 或 API Key 已存在时返回 False"""
+        cur = await self._asyncify(
+            self._execute,
+            '''INSERT INTO tenants (id, name, key_hash, allowed_origins, rate_limit, max_concurrency)
+               VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING''',
+            tenant_id, name, key_hash, json.dumps(allowed_origins), rate_limit, max_concurrency,
+            commit=True
+        )
+        return cur.rowcount > 0
+
+    async def update_tenant(
+        self,
+        tenant_id: str,
+        name: str | None = None,
+        key_hash: str | None = None,
+        allowed_origins: list[str] | None = None,
+        rate_limit: int | None = None,
+        max_concurrency: int | None = None
+    ) -> bool:
+        """修改租户 (为 None 的字段保持不变), 返回租户是否存在"""
+        cur = await self._asyncify(
             self._execute,
-            'INSERT OR REPLACE INTO user_config (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)',
-            key, value,
+            '''UPDATE tenants SET name = COALESCE(?, name), key_hash = COALESCE(?, key_hash),
+                   allowed_origins = COALESCE(?, allowed_origins), rate_limit = COALESCE(?, rate_limit),
+                   max_concurrency = COALESCE(?, max_concurrency)
+               WHERE id = ?''',
+            name, key_hash, json.dumps(allowed_origins) if allowed_origins is not None else None,
+            rate_limit, max_concurrency, tenant_id,
+            commit=True
+        )
+        return cur.rowcount > 0
+
+    async def delete_tenant(self, tenant_id: str) -> int | None:
+        """删除租户及其会话 (消息由后台回收), 返回删除的会话数; 租户不存在时返回 None
+
+        已归档的会话不在主库中, 保留在归档库, 可按会话 ID 批量删除
+        """
+        return await self._asyncify(self._delete_tenant, tenant_id)
+
+    def _delete_tenant(self, tenant_id: str) -> int | None:
+        if self.con.execute('DELETE FROM tenants WHERE id = ?', (tenant_id,)).rowcount == 0:
+            self.con.rollback()
+            return None
+        self.con.commit()
+        session_ids = [row[0] for row in self.con.execute(
+            'SELECT id FROM sessions WHERE tenant_id = ?', (tenant_id,)
+        )]
+        return self._tombstone_sessions(session_ids)
+
+    async def add_tenant_usage(self, rows: list[tuple[str, str, str, int, int, int, int, int]]):
+        """累加用量: 每行为 (租户, 日期, 模型, 请求数, 拒绝数, 错误数, 输入 tokens, 输出 tokens)"""
+        await self._asyncify(
+            self._executemany,
+            '''INSERT INTO tenant_usage
+                   (tenant_id, date, model, requests, rejected, errors, tokens_input, tokens_output)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (tenant_id, date, model) DO UPDATE SET
+                   requests = requests + excluded.requests,
+                   rejected = rejected + excluded.rejected,
+                   errors = errors + excluded.errors,
+                   tokens_input = tokens_input + excluded.tokens_input,
+                   tokens_output = tokens_output + excluded.tokens_output''',
+            rows,
             commit=True
         )
 
+    async def get_tenant_usage(
+        self, tenant_id: str | None = None, since: str | None = None, until: str | None = None
+    ) -> list[dict]:
+        """获取用量, 按租户和日期范围 [since, until) 筛选 (为 None 的条件不限制)"""
+        return await self._query(
+            '''SELECT tenant_id, date, model, requests, rejected, errors, tokens_input, tokens_output
+               FROM tenant_usage
+               WHERE (?1 IS NULL OR tenant_id = ?1) AND (?2 IS NULL OR date >= ?2) AND (?3 IS NULL OR date < ?3)
+               ORDER BY tenant_id, date, model''',
+            tenant_id, since, until,
+            row_factory=_tenant_usage_row
+        )
+
+    # ============================================
+    # 配置管理操作
+    # ============================================
+
+    async def save_config(
+        self,
+        key: str,
+        value: str,
+        category: str | None = None,
+        expected_version: int | None = None
+    ) -> int | None:
+        """保存配置, 返回保存后的配置版本 (resource_versions 中的 'config', 由触发器递增)
+
+        提供 expected_version 时只在当前版本与之相同时写入 (乐观并发控制), 否则返回 None。
+        已有配置的分类保持不变, category 只用于新建的配置
+        """
+        return await self._asyncify(self._save_config, key, value, category, expected_version)
+
+    def _save_config(self, key: str, value: str, category: str | None, expected_version: int | None) -> int | None:
+        cur = self.con.execute(
+            '''INSERT INTO user_config (key, value, category, updated_at)
+               SELECT ?1, ?2, COALESCE(?3, 'general'), CURRENT_TIMESTAMP
+               WHERE ?4 IS NULL
+                  OR ?4 = COALESCE((SELECT version FROM resource_versions WHERE resource = 'config'), 0)
+               ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at''',
+            (key, value, category, expected_version)
+        )
+        version = self.con.execute(
+            "SELECT COALESCE((SELECT version FROM resource_versions WHERE resource = 'config'), 0)"
+        ).fetchone()[0]
+        self.con.commit()
+        return version if cur.rowcount else None
+
+    async def get_config_snapshot(self) -> tuple[int, list[tuple[str, str, str]]]:
+        """一次读取全部配置及其版本: (版本, [(键, 值, 分类), ...])"""
+        return await self._asyncify(self._get_config_snapshot)
+
+    def _get_config_snapshot(self) -> tuple[int, list[tuple[str, str, str]]]:
+        # 版本与内容在同一条语句中读取, 两者一致; 版本行附在结果末尾 (键为 NULL)
+        rows = self.con.execute(
+            '''SELECT key, value, category FROM user_config
+               UNION ALL
+               SELECT NULL, COALESCE((SELECT version FROM resource_versions WHERE resource = 'config'), 0), NULL'''
+        ).fetchall()
+        version = next(int(value) for key, value, _ in rows if key is None)
+        return version, [row for row in rows if row[0] is not None]
+
     async def get_config(self, key: str) -> str | None:
         """获取配置"""
-        c = await self._asyncify(
-            self._execute,
+        return await self._query_one(
             'SELECT value FROM user_config WHERE key = ?',
-            key
+            key,
+            row_factory=_scalar_row
         )
-        row = await self._asyncify(c.fetchone)
-        return row[0] if row else None
 
     async def get_all_configs(self) -> dict[str, str]:
         """获取所有配置"""
-        c = await self._asyncify(
-            self._execute,
-            'SELECT key, value FROM user_config'
-        )
-        rows = await self._asyncify(c.fetchall)
-        return {row[0]: row[1] for row in rows}
+        return dict(await self._query('SELECT key, value FROM user_config'))
 
     # ============================================
     # 绘画历史操作
@@ -279,23 +1239,11 @@ class Database:
 
     async def get_draw_history(self, limit: int = 20) -> list[dict]:
         """获取绘画历史"""
-        c = await self._asyncify(
-            self._execute,
+        return await self._query(
             'SELECT id, prompt, image_url, model, parameters, created_at FROM draw_history ORDER BY created_at DESC LIMIT ?',
-            limit
-        )
-        rows = await self._asyncify(c.fetchall)
-        return [
-            {
-                'id': row[0],
-                'prompt': row[1],
-                'image_url': row[2],
-                'model': row[3],
-                'parameters': row[4],
-                'created_at': row[5]
-            }
-            for row in rows
-        ]
+            limit,
+            row_factory=_draw_history_row
+        )
 
     # ============================================
     # 网页缓存操作 (预留)
@@ -322,29 +1270,197 @@ class Database:
 
     async def get_web_cache(self, url: str) -> dict | None:
         """获取网页缓存"""
-        c = await self._asyncify(
+        return await self._query_one(
+            _WEB_CACHE_SQL,
+            url,
+            row_factory=_web_cache_row
+        )
+
+    # ============================================
+    # 分段总结缓存
+    # ============================================
+
+    async def get_summary_chunks(self, keys: list[str]) -> dict[str, str]:
+        """批量获取未过期的分段要点: 哈希 -> 要点"""
+        rows = await self._query(
+            '''SELECT key, summary FROM summary_chunks
+               WHERE key IN (SELECT value FROM json_each(?)) AND expires_at > datetime('now')''',
+            json.dumps(keys)
+        )
+        return dict(rows)
+
+    async def save_summary_chunk(self, key: str, summary: str, ttl: int):
+        """保存分段要点, 顺带清理过期的记录"""
+        await self._asyncify(self._save_summary_chunk, key, summary, ttl)
+
+    def _save_summary_chunk(self, key: str, summary: str, ttl: int):
+        self._execute(
+            '''INSERT OR REPLACE INTO summary_chunks (key, summary, expires_at)
+               VALUES (?, ?, datetime('now', '+' || ? || ' seconds'))''',
+            key, summary, ttl
+        )
+        self._execute("DELETE FROM summary_chunks WHERE expires_at <= datetime('now')", commit=True)
+
+    # ============================================
+    # 资源版本 (HTTP 缓存)
+    # ============================================
+
+    async def get_resource_version(self, resource: str) -> int:
+        """获取资源版本号 (由触发器在数据变更时递增), 未记录过的资源为 0"""
+        version = await self._query_one(
+            'SELECT version FROM resource_versions WHERE resource = ?',
+            resource,
+            row_factory=_scalar_row
+        )
+        return version or 0
+
+    # ============================================
+    # 缓存失效通知 (多进程)
+    # ============================================
+
+    async def add_invalidation(self, channel: str, key: str | None, origin: str):
+        """写入缓存失效通知"""
+        await self._asyncify(
+            self._execute,
+            'INSERT INTO cache_invalidations (channel, key, origin) VALUES (?, ?, ?)',
+            channel, key, origin,
+            commit=True
+        )
+
+    async def get_invalidations(self, after_id: int) -> list[tuple[int, str, str | None, str]]:
+        """获取指定 ID 之后的缓存失效通知 (id, channel, key, origin)"""
+        return await self._query(
+            'SELECT id, channel, key, origin FROM cache_invalidations WHERE id > ? ORDER BY id',
+            after_id
+        )
+
+    async def get_last_invalidation_id(self) -> int:
+        """获取最新的通知 ID"""
+        return await self._query_one(
+            'SELECT COALESCE(MAX(id), 0) FROM cache_invalidations',
+            row_factory=_scalar_row
+        )
+
+    async def prune_invalidations(self, max_age: int = 600):
+        """清理超过 max_age 秒的旧通知"""
+        await self._asyncify(
+            self._execute,
+            "DELETE FROM cache_invalidations WHERE created_at < datetime('now', '-' || ? || ' seconds')",
+            max_age,
+            commit=True
+        )
+
+    # ============================================
+    # 流式帧转存 (可续传的流式回答)
+    # ============================================
+
+    async def add_stream_frames(self, stream_id: str, frames: list[tuple[int, str, bytes]]):
+        """批量转存帧 (seq, type, frame)"""
+        await self._asyncify(
+            self._executemany,
+            'INSERT OR IGNORE INTO stream_frames (stream_id, seq, type, frame) VALUES (?, ?, ?, ?)',
+            [(stream_id, seq, type_, frame) for seq, type_, frame in frames],
+            commit=True
+        )
+
+    async def get_stream_frames(self, stream_id: str, after_seq: int) -> list[tuple[int, str, bytes]]:
+        """获取指定序号之后的转存帧"""
+        return await self._query(
+            'SELECT seq, type, frame FROM stream_frames WHERE stream_id = ? AND seq > ? ORDER BY seq',
+            stream_id, after_seq
+        )
+
+    async def delete_stream_frames(self, stream_id: str):
+        """删除一个流的所有转存帧"""
+        await self._asyncify(
             self._execute,
-            '''SELECT url, title, content, summary, json_data, created_at 
-               FROM web_cache 
-               WHERE url = ? AND (expires_at IS NULL OR expires_at > datetime('now'))''',
-            url
-        )
-        row = await self._asyncify(c.fetchone)
-        if row:
-            return {
-                'url': row[0],
-                'title': row[1],
-                'content': row[2],
-                'summary': row[3],
-                'json_data': row[4],
-                'created_at': row[5]
-            }
-        return None
+            'DELETE FROM stream_frames WHERE stream_id = ?',
+            stream_id,
+            commit=True
+        )
+
+    async def prune_stream_frames(self, max_age: float):
+        """清理超过 max_age 秒的转存帧"""
+        await self._asyncify(
+            self._execute,
+            "DELETE FROM stream_frames WHERE created_at < datetime('now', '-' || ? || ' seconds')",
+            int(max_age),
+            commit=True
+        )
 
     # ============================================
     # 内部工具方法
     # ============================================
 
+    async def _query(
+        self, sql: LiteralString, *args: Any, row_factory: RowFactory | None = None
+    ) -> list[Any]:
+        """执行查询并取回全部结果 (执行与读取在同一次线程池调用中完成)"""
+        return await self._asyncify(self._fetchall, sql, *args, row_factory=row_factory)
+
+    async def _query_one(
+        self, sql: LiteralString, *args: Any, row_factory: RowFactory | None = None
+    ) -> Any | None:
+        """执行查询并取回第一行, 无结果时返回 None"""
+        return await self._asyncify(self._fetchone, sql, *args, row_factory=row_factory)
+
+    async def _iterate(
+        self,
+        sql: LiteralString,
+        *args: Any,
+        row_factory: RowFactory | None = None,
+        batch_size: int = FETCH_BATCH_SIZE
+    ) -> AsyncIterator[list[Any]]:
+        """分批读取大结果集, 每批一次线程池调用; 避免一次性载入全部行
+
+        第一批与执行在同一次调用中完成, 结果不足一批时只需一次调用
+        """
+        cur, rows = await self._asyncify(
+            self._open_batch, sql, *args, row_factory=row_factory, batch_size=batch_size
+        )
+        try:
+            while rows:
+                yield rows
+                if cur is None:
+                    return
+                rows = await self._asyncify(cur.fetchmany, batch_size)
+        finally:
+            if cur is not None:
+                await self._asyncify(cur.close)
+
+    def _open_batch(
+        self,
+        sql: LiteralString,
+        *args: Any,
+        row_factory: RowFactory | None = None,
+        batch_size: int = FETCH_BATCH_SIZE
+    ) -> tuple[sqlite3.Cursor | None, list[Any]]:
+        cur = self._open_cursor(sql, *args, row_factory=row_factory)
+        rows = cur.fetchmany(batch_size)
+        if len(rows) < batch_size:
+            cur.close()
+            return None, rows
+        return cur, rows
+
+    def _fetchall(
+        self, sql: LiteralString, *args: Any, row_factory: RowFactory | None = None
+    ) -> list[Any]:
+        return self._open_cursor(sql, *args, row_factory=row_factory).fetchall()
+
+    def _fetchone(
+        self, sql: LiteralString, *args: Any, row_factory: RowFactory | None = None
+    ) -> Any | None:
+        return self._open_cursor(sql, *args, row_factory=row_factory).fetchone()
+
+    def _open_cursor(
+        self, sql: LiteralString, *args: Any, row_factory: RowFactory | None = None
+    ) -> sqlite3.Cursor:
+        cur = self.con.cursor()
+        if row_factory is not None:
+            cur.row_factory = row_factory
+        cur.execute(sql, args)
+        return cur
+
     def _execute(
         self, sql: LiteralString, *args: Any, commit: bool = False
     ) -> sqlite3.Cursor:
@@ -355,12 +1471,27 @@ class Database:
             self.con.commit()
         return cur
 
+    def _executemany(
+        self, sql: LiteralString, rows: list[tuple[Any, ...]], commit: bool = False
+    ) -> sqlite3.Cursor:
+        """批量执行 SQL 语句"""
+        cur = self.con.cursor()
+        cur.executemany(sql, rows)
+        if commit:
+            self.con.commit()
+        return cur
+
     async def _asyncify(
         self, func: Callable[P, R], *args: P.args, **kwargs: P.kwargs
     ) -> R:
-        """将同步函数转为异步执行"""
-        return await self._loop.run_in_executor(
-            self._executor,
-            partial(func, **kwargs),
-            *args, # type: ignore
-        )
+        """将同步函数转为异步执行 (占用当前优先级的数据库名额)"""
+        async with self._executor.limiter.slot():
+            return await self._loop.run_in_executor(
+                self._executor,
+                partial(func, **kwargs),
+                *args, # type: ignore
+            )
+
+    def executor_stats(self) -> dict:
+        """数据库线程各优先级的排队和执行统计"""
+        return self._executor.as_dict()
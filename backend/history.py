@@ -0,0 +1,132 @@
+"""会话上下文缓存与预取
+
+对话前需要读取并解析会话的全部 AI 上下文 (messages 表), 会话较长时这是首个 token 之前最大的开销。
+嵌入插件在用户打开窗口之前 (悬停按钮或页面空闲时) 调用 GET /api/chat/warm/{session_id}:
+接口立即返回精简的显示历史, 同时在后台把解析好的上下文放入本缓存, 打开窗口后的第一次对话直接使用。
+
+- 缓存项记录读取时的历史版本 (resource_versions 中的 'history:<会话 ID>', 写入 messages / chat_messages 时递增),
+  使用前比较版本 (一次主键查询), 其他请求或 worker 写入过的会话重新读取
+- 一轮对话在一个事务中保存 (Database.add_chat_turn), 写入前的版本与缓存项一致时把新消息追加到缓存项,
+  同一会话的后续对话继续命中
+- 同一会话并发的预取和读取合并为一次
+- 最多缓存 HISTORY_CACHE_SIZE 个会话, 超过 HISTORY_CACHE_TTL 秒未使用的缓存项失效
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from database import Database
+
+if TYPE_CHECKING:
+    from pydantic_ai import ModelMessage
+
+# 缓存的会话数上限
+HISTORY_CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', '256'))
+
+# 缓存项未使用多久后失效 (秒)
+HISTORY_CACHE_TTL = float(os.getenv('HISTORY_CACHE_TTL', '600'))
+
+
+@dataclass
+class _Entry:
+    version: int
+    messages: list[ModelMessage]
+    used_at: float = field(default_factory=time.monotonic)
+
+
+class HistoryCache:
+    """按会话缓存解析后的 AI 上下文"""
+
+    def __init__(self, max_sessions: int = HISTORY_CACHE_SIZE, ttl: float = HISTORY_CACHE_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        # 进行中的读取: 会话 ID -> 任务 (结果为 (版本, 消息))
+        self._loading: dict[str, asyncio.Task[tuple[int, list[ModelMessage]]]] = {}
+
+    def prefetch(self, db: Database, session_id: str, version: int):
+        """后台读取会话上下文 (已缓存且版本一致、或正在读取时不重复读取)"""
+        if self._fresh(session_id, version) is not None or session_id in self._loading:
+            return
+        self.prefetches += 1
+        self._start_load(db, session_id, version)
+
+    async def load(self, db: Database, session_id: str) -> tuple[int, list[ModelMessage]]:
+        """会话的 (历史版本, 上下文); 缓存未命中时从数据库读取并缓存"""
+        # 先取版本再取内容: 两者之间有写入时, 缓存的版本偏旧, 下次读取会重新获取
+        version = await db.get_resource_version(f'history:{session_id}')
+        entry = self._fresh(session_id, version)
+        if entry is not None:
+            self.hits += 1
+            return version, list(entry.messages)
+        task = self._loading.get(session_id)
+        if task is not None:
+            loaded_version, messages = await asyncio.shield(task)
+            if loaded_version == version:
+                self.hits += 1
+                return version, list(messages)
+        self.misses += 1
+        loaded_version, messages = await asyncio.shield(self._start_load(db, session_id, version))
+        return loaded_version, list(messages)
+
+    def append(
+        self,
+        session_id: str,
+        version: int,
+        messages: list[ModelMessage],
+        new_messages: list[ModelMessage],
+        saved: tuple[int, int]
+    ):
+        """一轮对话保存后更新缓存: messages 为对话使用的上下文 (版本 version), saved 为保存前后的版本"""
+        before, after = saved
+        if before == version:
+            self._store(session_id, after, messages + new_messages)
+        else:
+            # 期间有其他写入, 缓存的上下文不完整
+            self._entries.pop(session_id, None)
+
+    def _start_load(self, db: Database, session_id: str, version: int) -> asyncio.Task[tuple[int, list[ModelMessage]]]:
+        task = asyncio.create_task(self._load(db, session_id, version))
+        self._loading[session_id] = task
+        task.add_done_callback(lambda _: self._loading.pop(session_id, None) if self._loading.get(session_id) is task else None)
+        return task
+
+    async def _load(self, db: Database, session_id: str, version: int) -> tuple[int, list[ModelMessage]]:
+        messages = await db.get_messages(session_id)
+        self._store(session_id, version, messages)
+        return version, messages
+
+    def _fresh(self, session_id: str, version: int) -> _Entry | None:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry.version != version or now - entry.used_at > self.ttl:
+            del self._entries[session_id]
+            return None
+        entry.used_at = now
+        self._entries.move_to_end(session_id)
+        return entry
+
+    def _store(self, session_id: str, version: int, messages: list[ModelMessage]):
+        self._entries[session_id] = _Entry(version, messages)
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_sessions:
+            self._entries.popitem(last=False)
+
+    def as_dict(self) -> dict:
+        return {
+            'sessions': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'prefetches': self.prefetches,
+        }
@@ -11,6 +11,7 @@ CREATE TABLE IF NOT EXISTS sessions (
     id TEXT PRIMARY KEY,                    -- UUID 格式的会话 ID
     title TEXT NOT NULL,                    -- 会话标题
     mode TEXT DEFAULT 'standalone',         -- 模式: standalone/embedded
+    tenant_id TEXT NOT NULL DEFAULT 'default', -- 所属租户 (嵌入的站点), 见 tenants 表
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
@@ -24,6 +25,12 @@ CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at DESC);
 -- 索引: 按模式筛选
 CREATE INDEX IF NOT EXISTS idx_sessions_mode ON sessions(mode);
 
+-- 联合索引: 按模式筛选并按更新时间排序
+CREATE INDEX IF NOT EXISTS idx_sessions_mode_updated ON sessions(mode, updated_at DESC);
+
+-- 联合索引: 按租户列出会话 (各站点只能看到自己的会话)
+CREATE INDEX IF NOT EXISTS idx_sessions_tenant_updated ON sessions(tenant_id, updated_at DESC);
+
 
 -- ============================================
 -- 消息表 (Messages)
@@ -126,6 +133,21 @@ CREATE TABLE IF NOT EXISTS web_cache (
 CREATE INDEX IF NOT EXISTS idx_web_cache_expires ON web_cache(expires_at);
 
 
+-- ============================================
+-- 分段总结缓存表 (Summary Chunks)
+-- 长网页分段提炼的要点, 按 (用途, 模型, 分段内容) 的哈希缓存
+-- ============================================
+CREATE TABLE IF NOT EXISTS summary_chunks (
+    key TEXT PRIMARY KEY,                   -- 分段哈希 (SHA-256)
+    summary TEXT NOT NULL,                  -- 分段要点
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL           -- 过期时间
+) WITHOUT ROWID;
+
+-- 索引: 按过期时间清理
+CREATE INDEX IF NOT EXISTS idx_summary_chunks_expires ON summary_chunks(expires_at);
+
+
 -- ============================================
 -- 分析任务表 (Analysis Tasks) - 预留
 -- 记录图片分析、网页分析等异步任务
@@ -152,7 +174,7 @@ CREATE INDEX IF NOT EXISTS idx_tasks_created ON analysis_tasks(created_at DESC);
 
 
 -- ============================================
--- 标签表 (Tags) - 预留
+-- 标签表 (Tags)
 -- 为会话添加标签功能
 -- ============================================
 CREATE TABLE IF NOT EXISTS tags (
@@ -164,7 +186,7 @@ CREATE TABLE IF NOT EXISTS tags (
 
 
 -- ============================================
--- 会话标签关联表 (Session Tags) - 预留
+-- 会话标签关联表 (Session Tags)
 -- 多对多关系: 会话 <-> 标签
 -- ============================================
 CREATE TABLE IF NOT EXISTS session_tags (
@@ -176,6 +198,41 @@ CREATE TABLE IF NOT EXISTS session_tags (
     FOREIGN KEY (tag_id) REFERENCES tags(id) ON DELETE CASCADE
 );
 
+-- 覆盖索引: 按标签查找会话 (主键只能按会话查找标签)
+CREATE INDEX IF NOT EXISTS idx_session_tags_tag ON session_tags(tag_id, session_id);
+
+
+-- ============================================
+-- 标签统计表 (Tag Stats)
+-- 每个标签的会话数, 由触发器维护, 侧边栏读取时不需要聚合
+-- ============================================
+CREATE TABLE IF NOT EXISTS tag_stats (
+    tag_id INTEGER PRIMARY KEY,
+    session_count INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (tag_id) REFERENCES tags(id) ON DELETE CASCADE
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_session_tags_insert_stats AFTER INSERT ON session_tags
+BEGIN
+    INSERT INTO tag_stats (tag_id, session_count) VALUES (NEW.tag_id, 1)
+    ON CONFLICT (tag_id) DO UPDATE SET session_count = session_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_session_tags_delete_stats AFTER DELETE ON session_tags
+BEGIN
+    UPDATE tag_stats SET session_count = session_count - 1 WHERE tag_id = OLD.tag_id;
+END;
+
+
+-- ============================================
+-- 会话墓碑表 (Session Tombstones)
+-- 已删除会话的消息由后台分批回收, 回收完成后删除墓碑
+-- ============================================
+CREATE TABLE IF NOT EXISTS session_tombstones (
+    session_id TEXT PRIMARY KEY,            -- 已删除的会话 ID
+    deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
+
 
 -- ============================================
 -- 使用统计表 (Usage Stats) - 预留
@@ -196,6 +253,159 @@ CREATE TABLE IF NOT EXISTS usage_stats (
 CREATE INDEX IF NOT EXISTS idx_stats_date_model ON usage_stats(date, model);
 
 
+-- ============================================
+-- 租户表 (Tenants)
+-- 托管的嵌入站点, 各自使用独立的 API Key、会话空间和配额; 'default' 为本站 (不需要 Key)
+-- ============================================
+CREATE TABLE IF NOT EXISTS tenants (
+    id TEXT PRIMARY KEY,                    -- 租户 ID
+    name TEXT NOT NULL,                     -- 站点名称
+    key_hash TEXT NOT NULL UNIQUE,          -- API Key 的 SHA-256 (不保存明文)
+    allowed_origins TEXT DEFAULT '[]',      -- 允许嵌入的来源 (JSON 数组), 为空时不限制
+    rate_limit INTEGER,                     -- 每分钟请求数上限, NULL 使用默认值
+    max_concurrency INTEGER,                -- 同时进行的模型调用上限, NULL 使用默认值
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+
+-- ============================================
+-- 租户用量表 (Tenant Usage)
+-- 按租户、日期和模型累计, 由应用定期批量写入
+-- ============================================
+CREATE TABLE IF NOT EXISTS tenant_usage (
+    tenant_id TEXT NOT NULL,                -- 租户 ID
+    date TEXT NOT NULL,                     -- 日期 (YYYY-MM-DD)
+    model TEXT NOT NULL,                    -- 模型名称
+    requests INTEGER DEFAULT 0,             -- 请求次数
+    rejected INTEGER DEFAULT 0,             -- 因配额被拒绝的次数
+    errors INTEGER DEFAULT 0,               -- 错误次数
+    tokens_input INTEGER DEFAULT 0,         -- 输入 tokens
+    tokens_output INTEGER DEFAULT 0,        -- 输出 tokens
+    PRIMARY KEY (tenant_id, date, model)
+) WITHOUT ROWID;
+
+
+-- ============================================
+-- 缓存失效通知表 (Cache Invalidations)
+-- 多进程部署时, 各 worker 通过轮询此表同步缓存失效事件
+-- ============================================
+CREATE TABLE IF NOT EXISTS cache_invalidations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,                  -- 缓存通道: config/session/...
+    key TEXT,                               -- 失效的键, NULL 表示整个通道
+    origin TEXT NOT NULL,                   -- 发出通知的 worker 标识
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 索引: 按时间清理旧通知
+CREATE INDEX IF NOT EXISTS idx_invalidations_created ON cache_invalidations(created_at);
+
+
+-- ============================================
+-- 流式帧转存表 (Stream Frames)
+-- 可续传的流式回答在内存缓冲区超限时, 最早的帧转存到此表
+-- ============================================
+CREATE TABLE IF NOT EXISTS stream_frames (
+    stream_id TEXT NOT NULL,                -- 流 ID
+    seq INTEGER NOT NULL,                   -- 帧序号
+    type TEXT NOT NULL,                     -- 帧类型: start/content/end/error
+    frame BLOB NOT NULL,                    -- 编码后的帧 (NDJSON 一行)
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (stream_id, seq)
+) WITHOUT ROWID;
+
+-- 索引: 按时间清理遗留帧
+CREATE INDEX IF NOT EXISTS idx_stream_frames_created ON stream_frames(created_at);
+
+
+-- ============================================
+-- 资源版本表 (Resource Versions)
+-- 由触发器维护的版本号, 用作 HTTP ETag 和进程内缓存的校验: 'sessions' 为会话列表, 'history:<会话 ID>' 为对话历史
+-- ============================================
+CREATE TABLE IF NOT EXISTS resource_versions (
+    resource TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS trg_sessions_insert_version AFTER INSERT ON sessions
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('sessions', 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_sessions_update_version AFTER UPDATE ON sessions
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('sessions', 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_sessions_delete_version AFTER DELETE ON sessions
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('sessions', 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+    DELETE FROM resource_versions WHERE resource = 'history:' || OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chat_messages_insert_version AFTER INSERT ON chat_messages
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('history:' || NEW.session_id, 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chat_messages_update_version AFTER UPDATE ON chat_messages
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('history:' || NEW.session_id, 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+-- AI 上下文 (messages) 写入时同样更新对话历史的版本, 用于各 worker 的上下文缓存
+CREATE TRIGGER IF NOT EXISTS trg_messages_insert_version AFTER INSERT ON messages
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('history:' || NEW.session_id, 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+-- 会话列表包含各会话的标签, 标签变化时更新会话列表的版本
+CREATE TRIGGER IF NOT EXISTS trg_session_tags_insert_version AFTER INSERT ON session_tags
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('sessions', 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_session_tags_delete_version AFTER DELETE ON session_tags
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('sessions', 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+-- 用户配置的版本, 用于各 worker 的配置缓存和写入时的并发检查
+CREATE TRIGGER IF NOT EXISTS trg_user_config_insert_version AFTER INSERT ON user_config
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('config', 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_user_config_update_version AFTER UPDATE ON user_config
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('config', 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_user_config_delete_version AFTER DELETE ON user_config
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('config', 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+-- 级联删除会话时不再记录版本 (会话的版本行随会话一起删除)
+CREATE TRIGGER IF NOT EXISTS trg_chat_messages_delete_version AFTER DELETE ON chat_messages
+WHEN EXISTS (SELECT 1 FROM sessions WHERE id = OLD.session_id)
+BEGIN
+    INSERT INTO resource_versions (resource, version) VALUES ('history:' || OLD.session_id, 1)
+    ON CONFLICT (resource) DO UPDATE SET version = version + 1;
+END;
+
+
 -- ============================================
 -- 默认数据插入
 -- ============================================
@@ -216,6 +426,10 @@ INSERT OR IGNORE INTO tags (id, name, color) VALUES
 (3, '创作', '#ed8936'),
 (4, '其他', '#718096');
 
+-- 已有的标签关联 (升级前创建) 计入统计
+INSERT OR IGNORE INTO tag_stats (tag_id, session_count)
+SELECT tag_id, count(*) FROM session_tags GROUP BY tag_id;
+
 
 -- ============================================
 -- 清理过期数据的存储过程 (通过应用层实现)
@@ -242,7 +456,16 @@ CREATE TABLE IF NOT EXISTS schema_version (
 );
 
 INSERT OR IGNORE INTO schema_version (version, description) VALUES
-(1, 'Initial schema - Core tables for chat, sessions, and config');
+(1, 'Initial schema - Core tables for chat, sessions, and config'),
+(2, 'Cross-worker cache invalidation table'),
+(3, 'Spilled frames for resumable streams'),
+(4, 'Resource versions for HTTP caching'),
+(5, 'Chunk summary cache for long pages'),
+(6, 'Session tombstones for batched deletion'),
+(7, 'Tag filtering indexes and maintained tag counts'),
+(8, 'Config version triggers'),
+(9, 'Tenants, tenant-scoped sessions and tenant usage'),
+(10, 'History version bumped by context messages');
 
 
 -- ============================================
@@ -5,23 +5,39 @@
 
 from __future__ import annotations
 
+import startup  # 最先导入, 用于统计其余模块的导入耗时
+
 import asyncio
-import json
 import os
-from contextlib import asynccontextmanager
+import sqlite3
+import zlib
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Annotated, Literal
 
 import fastapi
-from fastapi import Depends, Form, Request, UploadFile, File
+from fastapi import Depends, Form, Header, HTTPException, Query, Request, UploadFile, File, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
 from database import Database
-from agents import get_agent, to_chat_message
+from agents import DEFAULT_MODEL, close_mcp_pool, get_agent, get_mcp_pool, get_title_agent, to_chat_message, tool_executor
+from archive import DeletionReclaimer, SessionArchiver, export_lines, gzip_stream, import_records, read_lines
+from assets import IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, AssetRegistry
+from compression import CompressionMiddleware, negotiate
+from configuration import ConfigStore
+from coordination import InvalidationBus
+from extraction import ExtractionError, WebExtractor, clip_text, normalize_text
+from history import HistoryCache
+from scheduling import Priority, priority, upstream
+from serialization import FastJSONResponse, RawJSONResponse, dumps, loads
+from streams import StreamRegistry, StreamRun, apply_flush_config, encode_ndjson, encode_sse
+from summarization import ChunkSummarizer
+from tenants import ADMIN_ALLOW_LOOPBACK, ADMIN_API_KEY, QuotaExceeded, Tenant, TenantLease, TenantMiddleware, TenantRegistry
+from titling import SessionTitler
 
 # 路径配置
 THIS_DIR = Path(__file__).parent
@@ -30,15 +46,102 @@ FRONTEND_DIR = PROJECT_ROOT / 'frontend'
 DATA_DIR = PROJECT_ROOT / 'data'
 DB_FILE = DATA_DIR / os.getenv('DB_NAME', 'chat.db')
 
+# 启动时是否预热数据库连接 (读入常用表和索引页)
+PREWARM_DB = os.getenv('PREWARM_DB', 'true').lower() == 'true'
+
+# SSE 空闲时发送保活注释的间隔 (秒), 防止代理因超时断开连接
+SSE_KEEPALIVE = float(os.getenv('SSE_KEEPALIVE', '15'))
+
+# 关闭时等待进行中的流式响应结束的最长时间 (秒)
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '30'))
+
+# 网页总结 / 转 JSON 时提供给模型的正文最大字符数
+WEB_PROMPT_MAX_CHARS = int(os.getenv('WEB_PROMPT_MAX_CHARS', '3000'))
+
+# 租户用量中网页提取 (/api/web/extract, 不调用模型) 的记录名称
+WEB_EXTRACT_USAGE_MODEL = 'web-extract'
+
+# 回答被停止或客户端断开时如何保存已生成的部分:
+# discard - 不保存; display - 只保存到聊天记录 (用于显示); context - 同时作为 AI 上下文
+STREAM_PARTIAL_POLICY = os.getenv('STREAM_PARTIAL_POLICY', 'display')
+
+# 会话事件流 (GET /api/sessions/events) 的最长持续时间 (秒), 到期后由浏览器自动重连,
+# 避免长连接阻止服务关闭
+SESSION_EVENTS_MAX_AGE = 120
+
 # 确保数据目录存在
 DATA_DIR.mkdir(exist_ok=True)
 
+startup_report = startup.StartupReport()
+startup_report.mark('import')
+
+stream_registry = StreamRegistry()
+web_extractor = WebExtractor()
+summarizer = ChunkSummarizer()
+# user_config 的内存快照, 请求路径上的配置只从这里读取
+config = ConfigStore()
+config.on_change(apply_flush_config)
+titler = SessionTitler(get_title_agent, enabled=lambda: config.get_bool('auto_title', True))
+# 嵌入站点 (租户) 的 API Key、配额和用量
+tenants = TenantRegistry()
+# 解析后的会话上下文 (嵌入插件打开前预取)
+history_cache = HistoryCache()
+
+
+def current_model() -> str:
+    """当前默认模型 (user_config 的 default_model)"""
+    return config.get('default_model') or DEFAULT_MODEL
+
+
+async def warm_up(db: Database):
+    """后台预热: 构建默认 Agent, 可选预热数据库连接; 完成后标记就绪"""
+    try:
+        with startup_report.phase('agent_build'):
+            # 构建 Agent 会导入 pydantic-ai / openai / fastmcp, 放到线程中避免阻塞事件循环
+            await asyncio.to_thread(get_agent, DEFAULT_MODEL)
+        pool = get_mcp_pool()
+        if pool is not None:
+            with startup_report.phase('mcp_connect'):
+                # 保持外部 MCP 服务器会话, 各次对话复用
+                await pool.start()
+        if PREWARM_DB:
+            with startup_report.phase('db_prewarm'):
+                await db.prewarm()
+        startup_report.mark_ready()
+    except Exception as e:
+        startup_report.error = str(e)
+    startup_report.log()
+
 
 @asynccontextmanager
 async def lifespan(_app: fastapi.FastAPI):
     """应用生命周期管理"""
-    async with Database.connect(DB_FILE) as db:
-        yield {'db': db}
+    async with AsyncExitStack() as stack:
+        with startup_report.phase('db_connect'):
+            db = await stack.enter_async_context(Database.connect(DB_FILE))
+        bus = InvalidationBus(db)
+        await bus.start()
+        stack.push_async_callback(bus.stop)
+        await config.start(db, bus)
+        await tenants.start(db, bus)
+        stack.push_async_callback(tenants.stop)
+        await stream_registry.start(db, bus)
+        stack.callback(stream_registry.stop_janitor)
+        titler.start(db, bus)
+        stack.push_async_callback(titler.stop)
+        reclaimer = DeletionReclaimer(db)
+        reclaimer.start()
+        stack.push_async_callback(reclaimer.stop)
+        archiver = SessionArchiver(db, reclaimer)
+        archiver.start()
+        stack.push_async_callback(archiver.stop)
+        stack.push_async_callback(close_mcp_pool)
+        stack.callback(web_extractor.shutdown)
+        warm_up_task = asyncio.create_task(warm_up(db))
+        stack.callback(warm_up_task.cancel)
+        # 退出时最先执行: 等待进行中的流式响应写完数据库
+        stack.push_async_callback(stream_registry.drain, DRAIN_TIMEOUT)
+        yield {'db': db, 'bus': bus, 'archiver': archiver, 'reclaimer': reclaimer}
 
 
 # 创建 FastAPI 应用
@@ -46,10 +149,14 @@ app = fastapi.FastAPI(
     title="PopupChatKit API",
     description="AI 对话与网页分析服务",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
-# CORS 配置
+# 租户识别与接口范围 (在 CORS 之前添加, 位于其内层, 拒绝的响应同样带有 CORS 头)
+app.add_middleware(TenantMiddleware, registry=tenants)
+
+# CORS 配置 (各站点允许的来源由 TenantMiddleware 按租户检查)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # 本地使用,允许所有源
@@ -58,6 +165,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 响应压缩 (gzip / brotli, 流式响应逐帧同步刷新)
+app.add_middleware(CompressionMiddleware)
+
+
+# 嵌入模式插件的静态资源 (内容哈希地址)
+embedded_assets = AssetRegistry(FRONTEND_DIR / 'embedded')
+
+standalone_assets = AssetRegistry(FRONTEND_DIR / 'standalone')
+
+# 需要在资源清单中提供哈希地址的文件
+EMBEDDED_ENTRYPOINTS = ['loader.js', 'popup.js']
+
 
 # 依赖注入
 async def get_db(request: Request) -> Database:
@@ -65,6 +184,87 @@ async def get_db(request: Request) -> Database:
     return request.state.db
 
 
+async def get_tenant(request: Request) -> Tenant:
+    """请求所属的租户 (由 TenantMiddleware 识别)"""
+    return request.state.tenant
+
+
+async def require_admin(request: Request):
+    """管理接口 (租户管理, 以及跨租户的会话导入导出、归档和批量删除): 须携带 ADMIN_API_KEY
+
+    未设置 ADMIN_API_KEY 时关闭; ADMIN_ALLOW_LOOPBACK=true 时只接受本机的同源请求
+    """
+    if not request.state.tenant_admin:
+        if ADMIN_API_KEY:
+            detail = '需要管理员 API Key'
+        elif ADMIN_ALLOW_LOOPBACK:
+            detail = '未设置 ADMIN_API_KEY, 只接受本机请求'
+        else:
+            detail = '未设置 ADMIN_API_KEY, 管理接口已关闭'
+        raise HTTPException(status_code=403, detail=detail)
+
+
+async def check_session(tenant: Tenant, session_id: str):
+    """租户 (包括本站) 只能访问自己的会话 (其他租户的会话视为不存在)"""
+    if not await tenants.owns(tenant, session_id):
+        raise HTTPException(status_code=404, detail='会话不存在')
+
+
+def admit(tenant: Tenant, model: str) -> TenantLease:
+    """占用租户的请求配额, 超出时返回 429"""
+    try:
+        return tenants.admit(tenant, model)
+    except QuotaExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={'Retry-After': str(e.retry_after)})
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match 是否与当前 ETag 匹配 (按弱比较)"""
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    current = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == current for tag in header.split(','))
+
+
+def not_modified(etag: str, cache_control: str = REVALIDATE_CACHE_CONTROL) -> Response:
+    return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': cache_control})
+
+
+def ensure_not_draining():
+    if stream_registry.draining:
+        raise HTTPException(status_code=503, detail='服务正在关闭')
+
+
+def ndjson_response(frames) -> StreamingResponse:
+    """返回按行分隔 JSON 的流式响应, 并登记到 stream_registry"""
+    ensure_not_draining()
+    return StreamingResponse(
+        stream_registry.wrap(encode_ndjson(frames)),
+        media_type='text/plain'
+    )
+
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache, no-transform',
+    'Connection': 'keep-alive',
+    # 关闭 nginx 等反向代理的响应缓冲
+    'X-Accel-Buffering': 'no',
+}
+
+
+def sse_response(frames) -> StreamingResponse:
+    """返回 Server-Sent Events 流式响应, 并登记到 stream_registry"""
+    ensure_not_draining()
+    return StreamingResponse(
+        stream_registry.wrap(encode_sse(frames)),
+        media_type='text/event-stream',
+        headers=SSE_HEADERS
+    )
+
+
 # ============================================
 # Pydantic 模型
 # ============================================
@@ -76,12 +276,59 @@ class ChatMessage(BaseModel):
     stream: bool = True
 
 
+class StopRequest(BaseModel):
+    """停止流式回答请求"""
+    session_id: str
+
+
 class SessionCreate(BaseModel):
     """创建会话请求"""
     title: str
     mode: str = 'standalone'
 
 
+class BulkDeleteRequest(BaseModel):
+    """批量删除会话请求 (各条件同时满足, 至少提供一个)"""
+    session_ids: list[str] | None = None
+    tag: str | None = None
+    older_than_days: float | None = None
+
+
+class TagCreate(BaseModel):
+    """创建标签请求"""
+    name: str
+    color: str | None = None
+
+
+class TagUpdate(BaseModel):
+    """修改标签请求 (未提供的字段不变)"""
+    name: str | None = None
+    color: str | None = None
+
+
+class SessionTagsRequest(BaseModel):
+    """设置会话标签请求"""
+    tag_ids: list[int]
+
+
+class TenantCreate(BaseModel):
+    """创建租户 (嵌入站点) 请求; rate_limit / max_concurrency 未提供时使用默认值, 0 表示不限制"""
+    id: str
+    name: str
+    allowed_origins: list[str] = []
+    rate_limit: int | None = None
+    max_concurrency: int | None = None
+
+
+class TenantUpdate(BaseModel):
+    """修改租户请求 (未提供的字段不变); rotate_key 为 true 时重新生成 API Key"""
+    name: str | None = None
+    allowed_origins: list[str] | None = None
+    rate_limit: int | None = None
+    max_concurrency: int | None = None
+    rotate_key: bool = False
+
+
 class WebExtractRequest(BaseModel):
     """网页提取请求"""
     url: str | None = None
@@ -90,15 +337,54 @@ class WebExtractRequest(BaseModel):
 
 
 class ConfigRequest(BaseModel):
-    """配置保存请求"""
+    """配置保存请求 (category 只用于新建的配置)"""
     key: str
     value: str
+    category: str | None = None
 
 
 # ============================================
 # 静态文件服务
 # ============================================
 
+@app.get('/embedded/{name}')
+async def embedded_asset(name: str, request: Request):
+    """嵌入模式静态资源: 哈希地址永久缓存, 固定地址按 ETag 协商"""
+    return asset_response(embedded_assets, name, request)
+
+
+@app.get('/standalone/{name}')
+async def standalone_asset(name: str, request: Request):
+    """独立模式页面 (预压缩, 按 ETag 协商)"""
+    return asset_response(standalone_assets, name, request)
+
+
+def asset_response(registry: AssetRegistry, name: str, request: Request) -> Response:
+    """返回静态资源, 客户端支持时直接返回预压缩版本"""
+    found = registry.get(name)
+    if found is None:
+        raise HTTPException(status_code=404, detail='资源不存在')
+    asset, hashed = found
+    encoding = negotiate(request.headers.get('accept-encoding', ''))
+    content, etag = asset.variant(encoding)
+    cache_control = IMMUTABLE_CACHE_CONTROL if hashed else REVALIDATE_CACHE_CONTROL
+    headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if content is not asset.content:
+        headers['Content-Encoding'] = encoding
+    return Response(content, media_type=asset.media_type, headers=headers)
+
+
+@app.get('/api/assets')
+async def asset_manifest():
+    """嵌入模式资源清单: 文件名 -> 带内容哈希的地址"""
+    return {
+        name: f'/embedded/{hashed}'
+        for name, hashed in embedded_assets.manifest(EMBEDDED_ENTRYPOINTS).items()
+    }
+
+
 @app.get("/")
 async def root():
     """返回首页"""
@@ -113,123 +399,412 @@ async def root():
 # 对话相关 API
 # ============================================
 
-@app.post('/api/chat/stream')
-async def chat_stream(
-    chat_req: ChatMessage,
-    database: Database = Depends(get_db)
-) -> StreamingResponse:
-    """流式对话接口"""
+def chat_producer(database: Database, chat_req: ChatMessage, lease: TenantLease):
+    """创建对话的生产者任务 (NDJSON / SSE / WebSocket 共用); 生成结束时释放租户的并发名额"""
     
-    async def stream_messages():
+    async def stream_messages(run: StreamRun):
+        full_response = ""
+        streamed = False
         try:
             # 发送开始标记
-            yield json.dumps({
+            run.emit({
                 'type': 'start',
+                'stream_id': run.stream_id,
                 'timestamp': datetime.now(tz=timezone.utc).isoformat()
-            }).encode('utf-8') + b'\n'
+            })
             
-            # 获取历史消息
-            messages = await database.get_messages(chat_req.session_id)
+            # 获取历史消息 (会话已归档时先移回主库)
+            await database.rehydrate_session(chat_req.session_id)
+            version, messages = await history_cache.load(database, chat_req.session_id)
+            first_turn = not messages
             
-            # 选择 Agent (默认智谱)
-            agent = get_agent('zhipu')
+            # 选择 Agent (配置中的默认模型)
+            agent = get_agent(current_model())
             
-            # 流式运行 Agent
-            async with agent.run_stream(
+            # 流式运行 Agent (按 FLUSH_POLICIES 合并输出; 模型调用名额优先分配给对话)
+            async with upstream.slot(), agent.run_stream(
                 chat_req.message,
                 message_history=messages
             ) as result:
-                # 流式输出内容
-                full_response = ""
-                async for text in result.stream_text(debounce_by=0.01):
-                    full_response = text
-                    yield json.dumps({
+                if chat_req.stream and config.get_bool('stream_response', True):
+                    # 流式输出内容
+                    async for text in run.paced(result.stream_text(debounce_by=None)):
+                        full_response = text
+                        run.emit({
+                            'type': 'content',
+                            'content': text
+                        })
+                else:
+                    # 关闭流式输出时生成完成后一次发送
+                    full_response = await result.get_output()
+                    run.emit({
                         'type': 'content',
-                        'content': text
-                    }).encode('utf-8') + b'\n'
+                        'content': full_response
+                    })
+                usage = result.usage()
+                lease.record_tokens(usage.input_tokens, usage.output_tokens)
+            streamed = True
             print("Full response:", full_response)
-            # 保存新消息到数据库 (用于 AI 上下文)
-            await database.add_messages(
-                chat_req.session_id,
-                result.new_messages_json()
-            )
-            
-            # 保存格式化消息到聊天消息表 (用于显示)
-            await database.add_chat_message(
+            # 回答已完整生成, 保存过程不再受停止/断开影响
+            saved = await asyncio.shield(save_chat_turn(
+                database,
                 chat_req.session_id,
-                'user',
                 chat_req.message,
-                'text'
-            )
-            await database.add_chat_message(
-                chat_req.session_id,
-                'assistant',
                 full_response,
-                'text'
-            )
-            
-            # 更新会话时间
-            await database.update_session(chat_req.session_id)
+                result.new_messages_json()
+            ))
+            history_cache.append(chat_req.session_id, version, messages, result.new_messages(), saved)
+            if first_turn:
+                # 后台生成标题, 完成后推送给客户端
+                titler.enqueue(chat_req.session_id, chat_req.message, full_response)
             
             # 发送结束标记
-            yield json.dumps({
+            run.emit({
                 'type': 'end',
                 'timestamp': datetime.now(tz=timezone.utc).isoformat()
-            }).encode('utf-8') + b'\n'
+            })
             
+        except asyncio.CancelledError:
+            # 用户停止或客户端断开: 上游调用已中止, 按策略保存已生成的部分
+            if not streamed:
+                await save_partial_response(
+                    database, chat_req.session_id, chat_req.message, full_response
+                )
+            run.emit({
+                'type': 'end',
+                'stopped': True,
+                'reason': run.cancel_reason,
+                'timestamp': datetime.now(tz=timezone.utc).isoformat()
+            })
         except Exception as e:
-            yield json.dumps({
+            lease.fail()
+            run.emit({
                 'type': 'error',
                 'message': str(e)
-            }).encode('utf-8') + b'\n'
+            })
+        finally:
+            lease.release()
     
-    return StreamingResponse(
-        stream_messages(),
-        media_type='text/plain'
-    )
+    return stream_messages
+
+
+@app.post('/api/chat/stream')
+async def chat_stream(
+    chat_req: ChatMessage,
+    request: Request,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
+) -> StreamingResponse:
+    """流式对话接口 (按行分隔的 JSON)"""
+    await check_session(tenant, chat_req.session_id)
+    ensure_not_draining()
+    lease = admit(tenant, current_model())
+    return ndjson_response(stream_registry.relay(
+        request, chat_producer(database, chat_req, lease), key=chat_req.session_id
+    ))
+
+
+@app.post('/api/chat/sse')
+async def chat_sse(
+    chat_req: ChatMessage,
+    request: Request,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
+) -> StreamingResponse:
+    """流式对话接口 (Server-Sent Events)"""
+    await check_session(tenant, chat_req.session_id)
+    ensure_not_draining()
+    lease = admit(tenant, current_model())
+    return sse_response(stream_registry.relay(
+        request, chat_producer(database, chat_req, lease), key=chat_req.session_id, keepalive=SSE_KEEPALIVE
+    ))
+
+
+async def get_stream_run(tenant: Tenant, stream_id: str) -> StreamRun:
+    """续传的流; 对话流只能由会话所属的租户续传"""
+    run = stream_registry.get(stream_id)
+    if run is None or (run.key is not None and not await tenants.owns(tenant, run.key)):
+        raise HTTPException(status_code=404, detail='流不存在或已过期')
+    return run
+
+
+@app.get('/api/chat/stream/{stream_id}')
+async def resume_chat_stream(
+    stream_id: str,
+    request: Request,
+    last_seq: int = -1,
+    tenant: Tenant = Depends(get_tenant)
+) -> StreamingResponse:
+    """续传流式回答: 返回 last_seq 之后的帧, 生成未结束时继续推送"""
+    run = await get_stream_run(tenant, stream_id)
+    return ndjson_response(stream_registry.follow(request, run, last_seq))
+
+
+@app.get('/api/chat/sse/{stream_id}')
+async def resume_chat_sse(
+    stream_id: str,
+    request: Request,
+    last_seq: int = -1,
+    last_event_id: Annotated[str | None, Header()] = None,
+    tenant: Tenant = Depends(get_tenant)
+) -> StreamingResponse:
+    """续传 SSE 流式回答; 支持 EventSource 自动重连携带的 Last-Event-ID"""
+    run = await get_stream_run(tenant, stream_id)
+    if last_event_id and last_event_id.isdigit():
+        last_seq = max(last_seq, int(last_event_id))
+    return sse_response(stream_registry.follow(request, run, last_seq, keepalive=SSE_KEEPALIVE))
+
+
+@app.websocket('/api/chat/ws')
+async def chat_websocket(websocket: WebSocket):
+    """WebSocket 对话接口: 一个连接上复用多个会话的多轮对话
+    
+    客户端消息:
+        {"type": "chat", "request_id": "...", "session_id": "...", "message": "..."}
+        {"type": "resume", "request_id": "...", "stream_id": "...", "last_seq": 12}
+        {"type": "stop", "session_id": "..."}
+        {"type": "ping"}
+    
+    服务端消息:
+        {"request_id": "...", "frame": {...}}  与 NDJSON 接口的帧相同
+        {"type": "session_updated", "session_id": "...", "title": "..."}  自动生成的会话标题
+        {"type": "pong"} / {"type": "error", "request_id": "...", "message": "..."}
+    
+    格式错误的消息 (非 JSON、非对象、字段不合法) 回复 error 后继续处理后续消息, 不断开连接
+    """
+    await websocket.accept()
+    database: Database = websocket.state.db
+    tenant: Tenant = websocket.state.tenant
+    send_lock = asyncio.Lock()
+    forwards: set[asyncio.Task] = set()
+    
+    def dumps_text(obj: dict) -> str:
+        return dumps(obj).decode('utf-8')
+    
+    async def send_text(text: str):
+        async with send_lock:
+            await websocket.send_text(text)
+    
+    async def forward(request_id: str, run: StreamRun, last_seq: int):
+        # 帧已编码为 JSON, 直接拼接外层结构, 不再重复序列化
+        prefix = '{"request_id":%s,"frame":' % dumps(request_id).decode('utf-8')
+        async for frame in stream_registry.wrap(stream_registry.follow(None, run, last_seq)):
+            await send_text(prefix + frame[2].decode('utf-8').rstrip('\n') + '}')
+    
+    def start_forward(request_id: str, run: StreamRun, last_seq: int = -1):
+        task = asyncio.create_task(forward(request_id, run, last_seq))
+        forwards.add(task)
+        task.add_done_callback(forwards.discard)
+    
+    def push_event(event: dict):
+        if event.get('tenant_id', tenant.id) != tenant.id:
+            return
+        task = asyncio.create_task(send_text(dumps_text(event)))
+        forwards.add(task)
+        task.add_done_callback(forwards.discard)
+    
+    async def send_error(request_id, message: str, **extra):
+        await send_text(dumps_text({'type': 'error', 'request_id': request_id, 'message': message, **extra}))
+    
+    async def receive_message() -> dict:
+        # 不使用 receive_json: 格式错误的消息只回复错误, 不断开连接
+        message = await websocket.receive()
+        if message['type'] == 'websocket.disconnect':
+            raise WebSocketDisconnect(message.get('code', 1000), message.get('reason'))
+        data = message.get('text')
+        msg = loads(data if data is not None else message.get('bytes') or b'')
+        if not isinstance(msg, dict):
+            raise ValueError('消息必须是 JSON 对象')
+        return msg
+    
+    async def handle(msg: dict):
+        msg_type = msg.get('type')
+        request_id = msg.get('request_id')
+        if msg_type == 'chat':
+            if stream_registry.draining:
+                await send_error(request_id, '服务正在关闭')
+                return
+            chat_req = ChatMessage.model_validate(msg)
+            if not await tenants.owns(tenant, chat_req.session_id):
+                await send_error(request_id, '会话不存在')
+                return
+            try:
+                lease = tenants.admit(tenant, current_model())
+            except QuotaExceeded as e:
+                await send_error(request_id, str(e), retry_after=e.retry_after)
+                return
+            run = stream_registry.start_run(chat_producer(database, chat_req, lease), key=chat_req.session_id)
+            start_forward(str(request_id or run.stream_id), run)
+        elif msg_type == 'resume':
+            last_seq = int(msg.get('last_seq', -1))
+            try:
+                run = await get_stream_run(tenant, str(msg.get('stream_id', '')))
+            except HTTPException as e:
+                await send_error(request_id, e.detail)
+                return
+            start_forward(str(request_id or run.stream_id), run, last_seq)
+        elif msg_type == 'stop':
+            session_id = str(msg.get('session_id', ''))
+            if await tenants.owns(tenant, session_id):
+                await stream_registry.stop_everywhere(session_id)
+        elif msg_type == 'ping':
+            await send_text('{"type":"pong"}')
+        else:
+            await send_error(request_id, f'未知消息类型: {msg_type}')
+    
+    # 会话标题等更新推送给该连接
+    unlisten = titler.listen(push_event)
+    try:
+        while True:
+            try:
+                msg = await receive_message()
+            except (ValueError, TypeError) as e:
+                await send_error(None, f'无法解析的消息: {e}')
+                continue
+            # 单条消息的错误只回复给客户端, 连接上的其他请求不受影响
+            try:
+                await handle(msg)
+            except ValidationError as e:
+                await send_error(msg.get('request_id'), '消息格式错误', errors=e.errors(include_url=False, include_context=False, include_input=False))
+            except (ValueError, TypeError) as e:
+                await send_error(msg.get('request_id'), f'消息格式错误: {e}')
+    except WebSocketDisconnect:
+        pass
+    finally:
+        unlisten()
+        # 断开后各生成进入重连等待期, 超时未续传则取消
+        for task in list(forwards):
+            task.cancel()
+
+
+@app.post('/api/chat/stop')
+async def stop_chat(request: StopRequest, tenant: Tenant = Depends(get_tenant)):
+    """停止会话中正在进行的流式回答
+
+    stopped: 已在处理本请求的 worker 中停止; broadcast: 本 worker 中没有, 已通知其他 worker 停止
+    """
+    await check_session(tenant, request.session_id)
+    stopped, broadcast = await stream_registry.stop_everywhere(request.session_id)
+    return {'session_id': request.session_id, 'stopped': stopped, 'broadcast': broadcast}
+
+
+async def save_chat_turn(
+    database: Database,
+    session_id: str,
+    message: str,
+    response: str,
+    new_messages: bytes
+) -> tuple[int, int]:
+    """保存一轮完整的对话 (AI 上下文、格式化消息、会话时间在同一事务中写入), 返回写入前后的历史版本"""
+    return await database.add_chat_turn(session_id, message, response, new_messages)
+
+
+async def save_partial_response(
+    database: Database,
+    session_id: str,
+    message: str,
+    partial: str
+):
+    """按 STREAM_PARTIAL_POLICY 保存被中断的回答"""
+    if STREAM_PARTIAL_POLICY == 'discard' or not partial:
+        return
+    if STREAM_PARTIAL_POLICY == 'context':
+        from pydantic_ai import ModelMessagesTypeAdapter, ModelRequest, ModelResponse, TextPart, UserPromptPart
+
+        await database.add_messages(session_id, ModelMessagesTypeAdapter.dump_json([
+            ModelRequest(parts=[UserPromptPart(message)]),
+            ModelResponse(parts=[TextPart(partial)]),
+        ]))
+    await database.add_chat_message(session_id, 'user', message, 'text')
+    await database.add_chat_message(session_id, 'assistant', partial, 'text')
+    await database.update_session(session_id)
 
 
 @app.get('/api/chat/history/{session_id}')
 async def get_chat_history(
     session_id: str,
-    database: Database = Depends(get_db)
+    request: Request,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ):
-    """获取对话历史"""
-    # 使用新的格式化消息表
-    chat_messages = await database.get_chat_messages(session_id)
-    return {
-        'session_id': session_id,
-        'messages': chat_messages
-    }
+    """获取对话历史 (支持 ETag 协商缓存, 未变化时不读取消息; 会话已归档时先移回主库)"""
+    await check_session(tenant, session_id)
+    await database.rehydrate_session(session_id)
+    # 先取版本再取内容: 两者之间有写入时, 下次请求版本不匹配会重新获取
+    version = await database.get_resource_version(f'history:{session_id}')
+    etag = f'W/"h{version}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    # 使用新的格式化消息表 (JSON 由 SQLite 直接生成)
+    return RawJSONResponse(
+        await database.get_chat_history_json(session_id),
+        headers={'ETag': etag, 'Cache-Control': REVALIDATE_CACHE_CONTROL}
+    )
+
+
+@app.get('/api/chat/warm/{session_id}')
+async def warm_chat_session(
+    session_id: str,
+    request: Request,
+    limit: int = Query(30, ge=1, le=200),
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """预取会话: 返回最近 limit 条精简的显示历史, 并在后台把 AI 上下文读入缓存 (嵌入插件在打开窗口前调用)"""
+    await check_session(tenant, session_id)
+    if await database.get_session_tenant(session_id) is None:
+        raise HTTPException(status_code=404, detail='会话不存在')
+    await database.rehydrate_session(session_id)
+    version = await database.get_resource_version(f'history:{session_id}')
+    history_cache.prefetch(database, session_id, version)
+    etag = f'W/"h{version}-{limit}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return RawJSONResponse(
+        await database.get_chat_history_compact(session_id, limit),
+        headers={'ETag': etag, 'Cache-Control': REVALIDATE_CACHE_CONTROL}
+    )
 
 
 @app.post('/api/chat/message')
 async def post_chat_message(
     prompt: Annotated[str, Form()],
     session_id: Annotated[str, Form()],
-    database: Database = Depends(get_db)
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ):
     """非流式对话接口"""
+    await check_session(tenant, session_id)
+    lease = admit(tenant, current_model())
     try:
-        # 获取历史消息
-        messages = await database.get_messages(session_id)
+        # 获取历史消息 (会话已归档时先移回主库)
+        await database.rehydrate_session(session_id)
+        version, messages = await history_cache.load(database, session_id)
         
         # 获取 Agent
-        agent = get_agent('zhipu')
+        agent = get_agent(current_model())
         
         # 运行对话
-        result = await agent.run(prompt, message_history=messages)
+        async with upstream.slot():
+            result = await agent.run(prompt, message_history=messages)
+        usage = result.usage()
+        lease.record_tokens(usage.input_tokens, usage.output_tokens)
         
         # 保存消息
         await database.add_messages(session_id, result.new_messages_json())
         await database.update_session(session_id)
+        if not messages:
+            titler.enqueue(session_id, prompt, result.output)
         
         return {
             'response': result.output,
             'timestamp': datetime.now(tz=timezone.utc).isoformat()
         }
     except Exception as e:
+        lease.fail()
         return {'error': str(e)}, 500
+    finally:
+        lease.release()
 
 
 # ============================================
@@ -238,23 +813,37 @@ async def post_chat_message(
 
 @app.get('/api/sessions')
 async def get_sessions(
+    request: Request,
     limit: int = 50,
-    database: Database = Depends(get_db)
+    tag: str | None = None,
+    mode: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ):
-    """获取会话列表"""
-    sessions = await database.get_sessions(limit)
-    return {'sessions': sessions}
+    """获取当前租户的会话列表 (支持 ETag 协商缓存); 可按标签名、模式、更新时间范围 [since, until) 筛选"""
+    version = await database.get_resource_version('sessions')
+    filters = zlib.crc32(repr((tenant.id, tag, mode, since, until)).encode())
+    etag = f'W/"s{version}-{limit}-{filters:x}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return RawJSONResponse(
+        await database.get_sessions_json(limit, tag, mode, since, until, tenant.id),
+        headers={'ETag': etag, 'Cache-Control': REVALIDATE_CACHE_CONTROL}
+    )
 
 
 @app.post('/api/sessions')
 async def create_session(
     request: SessionCreate,
-    database: Database = Depends(get_db)
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ):
-    """创建新会话"""
+    """创建新会话 (属于当前租户)"""
     import uuid
     session_id = str(uuid.uuid4())
-    await database.create_session(session_id, request.title, request.mode)
+    await database.create_session(session_id, request.title, request.mode, tenant.id)
     return {
         'session_id': session_id,
         'title': request.title,
@@ -262,13 +851,152 @@ async def create_session(
     }
 
 
+@app.get('/api/sessions/events')
+async def session_events(tenant: Tenant = Depends(get_tenant)) -> StreamingResponse:
+    """会话更新事件 (Server-Sent Events): 自动生成标题后推送 session_updated 事件 (只包括当前租户的会话)
+
+    连接持续 SESSION_EVENTS_MAX_AGE 秒后结束, 由 EventSource 自动重连
+    """
+    queue: asyncio.Queue[dict] = asyncio.Queue()
+
+    def push_event(event: dict):
+        if event.get('tenant_id', tenant.id) == tenant.id:
+            queue.put_nowait(event)
+
+    async def frames():
+        unlisten = titler.listen(push_event)
+        deadline = asyncio.get_running_loop().time() + SESSION_EVENTS_MAX_AGE
+        seq = 0
+        try:
+            while (remaining := deadline - asyncio.get_running_loop().time()) > 0:
+                try:
+                    event = await asyncio.wait_for(queue.get(), min(SSE_KEEPALIVE, remaining))
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield seq, event['type'], dumps(event) + b'\n'
+                seq += 1
+        finally:
+            unlisten()
+
+    return StreamingResponse(encode_sse(frames()), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+@app.get('/api/sessions/archived', dependencies=[Depends(require_admin)])
+async def get_archived_sessions(
+    limit: int = 50,
+    database: Database = Depends(get_db)
+):
+    """获取已归档的会话列表 (访问其历史记录或继续对话时自动恢复)"""
+    return {'sessions': await database.get_archived_sessions(limit)}
+
+
+@app.get('/api/sessions/export', dependencies=[Depends(require_admin)])
+async def export_sessions(
+    session_id: Annotated[list[str] | None, Query()] = None,
+    since: str | None = None,
+    until: str | None = None,
+    include_archived: bool = True,
+    compress: Literal['gzip'] | None = None,
+    database: Database = Depends(get_db)
+) -> StreamingResponse:
+    """流式导出会话 (NDJSON, 每行一个会话); 可按会话 ID (可重复) 或创建时间范围 [since, until) 筛选"""
+    lines = export_lines(database, session_id, since, until, include_archived)
+    filename = f'sessions-{datetime.now(tz=timezone.utc):%Y%m%d%H%M%S}.ndjson'
+    if compress == 'gzip':
+        return StreamingResponse(
+            gzip_stream(lines),
+            media_type='application/gzip',
+            headers={'Content-Disposition': f'attachment; filename="{filename}.gz"'}
+        )
+    return StreamingResponse(
+        lines,
+        media_type='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+@app.post('/api/sessions/import', dependencies=[Depends(require_admin)])
+async def import_sessions(
+    request: Request,
+    overwrite: bool = False,
+    database: Database = Depends(get_db)
+):
+    """导入会话 (导出格式的 NDJSON, 可为 gzip); 已存在的会话默认跳过, overwrite=true 时覆盖"""
+    try:
+        return await import_records(database, read_lines(request.stream()), overwrite)
+    except (ValueError, zlib.error) as e:
+        raise HTTPException(status_code=400, detail=f'导入数据无效: {e}')
+    except sqlite3.OperationalError as e:
+        # 之前的批次已提交, 已存在的会话默认跳过, 可使用同一文件重试
+        raise HTTPException(status_code=503, detail=f'数据库繁忙, 导入中断, 请重试: {e}')
+
+
+@app.post('/api/sessions/archive', dependencies=[Depends(require_admin)])
+async def archive_sessions(request: Request):
+    """立即运行一次归档任务"""
+    archiver: SessionArchiver = request.state.archiver
+    if archiver.idle_days <= 0:
+        raise HTTPException(status_code=400, detail='未启用归档 (ARCHIVE_AFTER_DAYS=0)')
+    return {'archived': await archiver.run_once()}
+
+
+@app.put('/api/sessions/{session_id}/tags')
+async def set_session_tags(
+    session_id: str,
+    body: SessionTagsRequest,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """把会话的标签替换为 tag_ids (不存在的标签忽略)"""
+    await check_session(tenant, session_id)
+    await database.rehydrate_session(session_id)
+    tag_ids = await database.set_session_tags(session_id, body.tag_ids)
+    if tag_ids is None:
+        raise HTTPException(status_code=404, detail='会话不存在')
+    return {'session_id': session_id, 'tags': tag_ids}
+
+
+@app.post('/api/sessions/{session_id}/tags/{tag_id}')
+async def add_session_tag(
+    session_id: str,
+    tag_id: int,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """为会话添加标签"""
+    await check_session(tenant, session_id)
+    await database.rehydrate_session(session_id)
+    tag_ids = await database.add_session_tag(session_id, tag_id)
+    if tag_ids is None:
+        raise HTTPException(status_code=404, detail='会话或标签不存在')
+    return {'session_id': session_id, 'tags': tag_ids}
+
+
+@app.delete('/api/sessions/{session_id}/tags/{tag_id}')
+async def remove_session_tag(
+    session_id: str,
+    tag_id: int,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """移除会话的标签"""
+    await check_session(tenant, session_id)
+    if not await database.remove_session_tag(session_id, tag_id):
+        raise HTTPException(status_code=404, detail='会话没有该标签')
+    return {'message': 'Tag removed'}
+
+
 @app.put('/api/sessions/{session_id}')
 async def update_session_title(
     session_id: str,
     title: str,
-    database: Database = Depends(get_db)
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ):
     """更新会话标题"""
+    await check_session(tenant, session_id)
+    await database.rehydrate_session(session_id)
     await database.update_session(session_id, title)
     return {'message': 'Session updated'}
 
@@ -276,177 +1004,354 @@ async def update_session_title(
 @app.delete('/api/sessions/{session_id}')
 async def delete_session(
     session_id: str,
-    database: Database = Depends(get_db)
+    request: Request,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ):
-    """删除会话"""
+    """删除会话 (立即生效, 消息在后台分批回收)"""
+    await check_session(tenant, session_id)
     await database.delete_session(session_id)
+    request.state.reclaimer.wake()
     return {'message': 'Session deleted'}
 
 
+@app.post('/api/sessions/bulk-delete', dependencies=[Depends(require_admin)])
+async def bulk_delete_sessions(
+    body: BulkDeleteRequest,
+    request: Request,
+    database: Database = Depends(get_db)
+):
+    """批量删除会话: 按 ID 列表、标签、未更新天数筛选 (包括已归档的会话, 按标签筛选时除外)"""
+    if body.session_ids is None and body.tag is None and body.older_than_days is None:
+        raise HTTPException(status_code=400, detail='请提供 session_ids、tag 或 older_than_days')
+    deleted, archived = await database.delete_sessions(body.session_ids, body.tag, body.older_than_days)
+    if deleted:
+        request.state.reclaimer.wake()
+    return {'deleted': deleted, 'archived_deleted': archived}
+
+
+# ============================================
+# 标签管理 API
+# ============================================
+
+@app.get('/api/tags')
+async def get_tags(database: Database = Depends(get_db)):
+    """获取全部标签及各自的会话数"""
+    return {'tags': await database.get_tags()}
+
+
+@app.post('/api/tags')
+async def create_tag(body: TagCreate, database: Database = Depends(get_db)):
+    """创建标签"""
+    tag_id = await database.create_tag(body.name, body.color)
+    if tag_id is None:
+        raise HTTPException(status_code=409, detail='标签已存在')
+    return {'id': tag_id, 'name': body.name}
+
+
+@app.put('/api/tags/{tag_id}')
+async def update_tag(tag_id: int, body: TagUpdate, database: Database = Depends(get_db)):
+    """修改标签名称或颜色"""
+    try:
+        found = await database.update_tag(tag_id, body.name, body.color)
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=409, detail='标签已存在')
+    if not found:
+        raise HTTPException(status_code=404, detail='标签不存在')
+    return {'message': 'Tag updated'}
+
+
+@app.delete('/api/tags/{tag_id}')
+async def delete_tag(tag_id: int, database: Database = Depends(get_db)):
+    """删除标签 (同时移除各会话上的该标签)"""
+    if not await database.delete_tag(tag_id):
+        raise HTTPException(status_code=404, detail='标签不存在')
+    return {'message': 'Tag deleted'}
+
+
 # ============================================
 # 配置管理 API
 # ============================================
 
-# @app.get('/api/config')
-# async def get_all_config(database: Database = Depends(get_db)):
-#     """获取所有配置"""
-#     # 这里可以返回非敏感配置
-#     default_model = await database.get_config('default_model')
-#     theme = await database.get_config('theme')
-#     return {
-#         'default_model': default_model or 'zhipu',
-#         'theme': theme or 'light'
-#     }
-
-
-# @app.get('/api/config/{key}')
-# async def get_config(
-#     key: str,
-#     database: Database = Depends(get_db)
-# ):
-#     """获取指定配置"""
-#     value = await database.get_config(key)
-#     return {'key': key, 'value': value}
-
-
-# @app.post('/api/config')
-# async def save_config(
-#     request: ConfigRequest,
-#     database: Database = Depends(get_db)
-# ):
-#     """保存配置"""
-#     await database.save_config(request.key, request.value)
-#     return {'message': 'Config saved'}
+def config_etag(version: int) -> str:
+    return f'W/"c{version}"'
+
+
+def parse_config_version(if_match: str | None) -> int | None:
+    """If-Match 中的配置版本 (config_etag 格式), 未提供时返回 None"""
+    if not if_match or if_match.strip() == '*':
+        return None
+    tag = if_match.strip().removeprefix('W/').strip('"')
+    if not tag.startswith('c') or not tag[1:].isdigit():
+        raise HTTPException(status_code=400, detail='If-Match 格式无效')
+    return int(tag[1:])
+
+
+@app.get('/api/config')
+async def get_all_config(request: Request):
+    """获取所有配置 (不含 API Key 等敏感配置; 读取内存快照, 支持 ETag 协商缓存)"""
+    etag = config_etag(config.version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return FastJSONResponse(
+        {'version': config.version, 'config': config.public()},
+        headers={'ETag': etag, 'Cache-Control': REVALIDATE_CACHE_CONTROL}
+    )
+
+
+@app.get('/api/config/{key}')
+async def get_config(key: str):
+    """获取指定配置"""
+    if not config.is_public(key):
+        raise HTTPException(status_code=404, detail='配置不存在')
+    return {'key': key, 'value': config.get(key), 'version': config.version}
+
+
+@app.post('/api/config')
+async def save_config(
+    request: ConfigRequest,
+    if_match: Annotated[str | None, Header()] = None
+):
+    """保存配置: 立即对所有 worker 生效; 带 If-Match (GET /api/config 返回的 ETag) 时, 配置已被修改则返回 412"""
+    version = await config.save(request.key, request.value, request.category, parse_config_version(if_match))
+    if version is None:
+        raise HTTPException(status_code=412, detail='配置已被修改, 请重新获取')
+    return FastJSONResponse(
+        {'key': request.key, 'version': version},
+        headers={'ETag': config_etag(version)}
+    )
+
+
+# ============================================
+# 租户管理 API
+# ============================================
+
+@app.get('/api/tenants', dependencies=[Depends(require_admin)])
+async def get_tenants():
+    """获取全部站点租户 (不含 API Key) 及当前进程中进行的请求数"""
+    return {'tenants': tenants.describe()}
+
+
+@app.post('/api/tenants', dependencies=[Depends(require_admin)])
+async def create_tenant(body: TenantCreate):
+    """创建租户, 返回的 API Key 只显示这一次"""
+    api_key = await tenants.create(
+        body.id, body.name, body.allowed_origins, body.rate_limit, body.max_concurrency
+    )
+    if api_key is None:
+        raise HTTPException(status_code=409, detail='租户已存在')
+    return {'id': body.id, 'api_key': api_key}
+
+
+@app.get('/api/tenants/usage')
+async def get_tenant_usage(
+    request: Request,
+    since: str | None = None,
+    until: str | None = None,
+    tenant_id: str | None = None,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """按日期和模型统计的用量 (日期范围 [since, until), YYYY-MM-DD); 管理员以外只能查看自己 (所属租户) 的用量"""
+    if not request.state.tenant_admin:
+        tenant_id = tenant.id
+    await tenants.flush()
+    return {'usage': await database.get_tenant_usage(tenant_id, since, until)}
+
+
+@app.put('/api/tenants/{tenant_id}', dependencies=[Depends(require_admin)])
+async def update_tenant(tenant_id: str, body: TenantUpdate):
+    """修改租户; rotate_key 时返回新的 API Key, 原 Key 立即失效"""
+    found, api_key = await tenants.update(
+        tenant_id, body.name, body.allowed_origins, body.rate_limit, body.max_concurrency, body.rotate_key
+    )
+    if not found:
+        raise HTTPException(status_code=404, detail='租户不存在')
+    return {'id': tenant_id, 'api_key': api_key} if api_key else {'id': tenant_id}
+
+
+@app.delete('/api/tenants/{tenant_id}', dependencies=[Depends(require_admin)])
+async def delete_tenant(tenant_id: str, request: Request):
+    """删除租户及其会话 (API Key 立即失效, 消息在后台分批回收)"""
+    deleted = await tenants.delete(tenant_id)
+    if deleted is None:
+        raise HTTPException(status_code=404, detail='租户不存在')
+    if deleted:
+        request.state.reclaimer.wake()
+    return {'deleted_sessions': deleted}
 
 
 # ============================================
 # 网页分析 API
 # ============================================
 
-@app.post('/api/web/extract')
-async def extract_web_content(request: WebExtractRequest):
-    """提取网页内容"""
-    # 简化实现,实际应使用专门的网页提取库
+async def resolve_web_content(database: Database, request: WebExtractRequest, refresh: bool = False) -> dict:
+    """网页正文: 请求中带有内容时规范化后使用, 否则按 URL 抓取提取 (结果缓存在 web_cache)"""
     if request.content:
         return {
             'title': 'User Content',
-            'content': request.content[:5000],
-            'url': request.url or 'N/A'
-        }
-    elif request.url:
-        return {
-            'title': 'URL Content',
-            'content': f'Content from {request.url}',
-            'url': request.url
+            'content': normalize_text(request.content),
+            'url': request.url or 'N/A',
+            'cached': False,
         }
-    return {'error': 'No content or URL provided'}, 400
+    if request.url:
+        return await web_extractor.get(database, request.url, refresh=refresh)
+    raise HTTPException(status_code=400, detail='请提供 content 或 url')
+
+
+async def condense_web_content(database: Database, run: StreamRun, agent, kind: str, content: str) -> tuple[str, bool]:
+    """不超过 WEB_PROMPT_MAX_CHARS 的正文原样使用; 更长的正文分段并发提炼要点 (期间发送 progress 帧)"""
+    def progress(done: int, total: int):
+        run.emit({'type': 'progress', 'done': done, 'total': total})
+
+    return await summarizer.condense(database, agent, kind, content, WEB_PROMPT_MAX_CHARS, on_progress=progress)
+
+
+@app.post('/api/web/extract')
+async def extract_web_content(
+    request: WebExtractRequest,
+    refresh: bool = False,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """提取网页内容 (refresh=true 时忽略缓存重新抓取)
+
+    抓取和解析不调用模型, 但同样计入租户的速率和并发配额 (用量中的模型记为 web-extract)
+    """
+    lease = admit(tenant, WEB_EXTRACT_USAGE_MODEL)
+    try:
+        page = await resolve_web_content(database, request, refresh)
+    except ExtractionError as e:
+        lease.fail()
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    finally:
+        lease.release()
+    if request.content:
+        page['content'] = clip_text(page['content'], 5000)
+    return page
 
 
 @app.post('/api/web/summarize')
 async def summarize_web(
     request: WebExtractRequest,
-    database: Database = Depends(get_db)
+    http_request: Request,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ) -> StreamingResponse:
     """总结网页内容 (流式响应)"""
+    ensure_not_draining()
+    lease = admit(tenant, current_model())
     
-    async def stream_summary():
+    async def stream_summary(run: StreamRun):
         try:
-            content = request.content or ''
-            url = request.url or 'N/A'
+            page = await resolve_web_content(database, request)
+            url = page['url']
             
-            # 使用 AI 总结
-            agent = get_agent('zhipu')
+            # 发送开始标记
+            run.emit({
+                'type': 'start',
+                'stream_id': run.stream_id,
+                'url': url
+            })
+            
+            # 使用 AI 总结 (长网页先分段提炼要点)
+            agent = get_agent(current_model())
+            content, condensed = await condense_web_content(database, run, agent, 'summary', page['content'])
             prompt = f"""请总结以下网页内容:
 
 URL: {url}
 
-内容:
-{content[:3000]}
+内容{'(各部分要点)' if condensed else ''}:
+{content}
 
 请用简洁的语言总结主要内容,不超过200字,使用 Markdown 格式。"""
             
-            # 发送开始标记
-            yield json.dumps({
-                'type': 'start',
-                'url': url
-            }).encode('utf-8') + b'\n'
-            
-            # 流式运行
-            async with agent.run_stream(prompt) as result:
-                async for text in result.stream_text(debounce_by=0.01):
-                    yield json.dumps({
+            # 流式运行 (按 FLUSH_POLICIES 合并输出)
+            async with upstream.slot(), agent.run_stream(prompt) as result:
+                async for text in run.paced(result.stream_text(debounce_by=None)):
+                    run.emit({
                         'type': 'content',
                         'content': text
-                    }).encode('utf-8') + b'\n'
+                    })
+                usage = result.usage()
+                lease.record_tokens(usage.input_tokens, usage.output_tokens)
             
             # 发送结束标记
-            yield json.dumps({
+            run.emit({
                 'type': 'end'
-            }).encode('utf-8') + b'\n'
+            })
             
         except Exception as e:
-            yield json.dumps({
+            lease.fail()
+            run.emit({
                 'type': 'error',
                 'message': str(e)
-            }).encode('utf-8') + b'\n'
+            })
+        finally:
+            lease.release()
     
-    return StreamingResponse(
-        stream_summary(),
-        media_type='text/plain'
-    )
+    return ndjson_response(stream_registry.relay(http_request, stream_summary, endpoint='summarize'))
 
 
 @app.post('/api/web/to-json')
 async def web_to_json(
     request: WebExtractRequest,
-    database: Database = Depends(get_db)
+    http_request: Request,
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ) -> StreamingResponse:
     """将网页内容转换为 JSON (流式响应)"""
+    ensure_not_draining()
+    lease = admit(tenant, current_model())
     
-    async def stream_json():
+    async def stream_json(run: StreamRun):
         try:
-            content = request.content or ''
-            url = request.url or 'N/A'
+            page = await resolve_web_content(database, request)
+            url = page['url']
+            
+            # 发送开始标记
+            run.emit({
+                'type': 'start',
+                'stream_id': run.stream_id,
+                'url': url
+            })
             
-            agent = get_agent('zhipu')
+            agent = get_agent(current_model())
+            content, condensed = await condense_web_content(database, run, agent, 'json', page['content'])
             prompt = f"""请将以下网页内容转换为结构化的 JSON 格式:
 
 URL: {url}
 
-内容:
-{content[:3000]}
+内容{'(各部分要点)' if condensed else ''}:
+{content}
 
 请提取关键信息,以 JSON 格式返回,包括标题、主要内容、关键词等,使用 Markdown 代码块包裹。"""
             
-            # 发送开始标记
-            yield json.dumps({
-                'type': 'start',
-                'url': url
-            }).encode('utf-8') + b'\n'
-            
-            # 流式运行
-            async with agent.run_stream(prompt) as result:
-                async for text in result.stream_text(debounce_by=0.01):
-                    yield json.dumps({
+            # 流式运行 (按 FLUSH_POLICIES 合并输出)
+            async with upstream.slot(), agent.run_stream(prompt) as result:
+                async for text in run.paced(result.stream_text(debounce_by=None)):
+                    run.emit({
                         'type': 'content',
                         'content': text
-                    }).encode('utf-8') + b'\n'
+                    })
+                usage = result.usage()
+                lease.record_tokens(usage.input_tokens, usage.output_tokens)
             
             # 发送结束标记
-            yield json.dumps({
+            run.emit({
                 'type': 'end'
-            }).encode('utf-8') + b'\n'
+            })
             
         except Exception as e:
-            yield json.dumps({
+            lease.fail()
+            run.emit({
                 'type': 'error',
                 'message': str(e)
-            }).encode('utf-8') + b'\n'
+            })
+        finally:
+            lease.release()
     
-    return StreamingResponse(
-        stream_json(),
-        media_type='text/plain'
-    )
+    return ndjson_response(stream_registry.relay(http_request, stream_json, endpoint='to_json'))
 
 
 # ============================================
@@ -458,87 +1363,98 @@ async def analyze_image(
     image: UploadFile = File(...),
     prompt: str = Form("分析这张图片"),
     session_id: str = Form(None),
-    database: Database = Depends(get_db)
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ):
     """分析上传的图片"""
     import base64
     import httpx
     import os
     
+    if session_id:
+        await check_session(tenant, session_id)
+    lease = admit(tenant, 'glm-4v-flash')
     try:
-        # 读取图片内容
-        image_data = await image.read()
-        
-        # 转换为base64
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-
-        api_key = os.getenv('ZHIPU_API_KEY')
-        if not api_key:
-            return {'error': 'API Key 未配置'}, 500
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                'https://open.bigmodel.cn/api/paas/v4/chat/completions',
-                headers={
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                },
-                json={
-                    'model': 'glm-4v-flash',
-                    'messages': [
-                        {
-                            'role': 'user',
-                            'content': [
-                                {
-                                    'type': 'text',
-                                    'text': prompt
-                                },
-                                {
-                                    'type': 'image_url',
-                                    'image_url': {
-                                        'url': f'data:image/jpeg;base64,{base64_image}'
-                                    }
-                                }
-                            ]
-                        }
-                    ]
-                }
-            )
-            
-            if response.status_code != 200:
-                error_text = response.text
-                return {'error': f'分析失败: {error_text}'}, response.status_code
+        with priority(Priority.MEDIA):
+            # 读取图片内容
+            image_data = await image.read()
             
-            result = response.json()
-            analysis = result['choices'][0]['message']['content']
+            # 转换为base64
+            base64_image = base64.b64encode(image_data).decode('utf-8')
+
+            api_key = os.getenv('ZHIPU_API_KEY')
+            if not api_key:
+                return {'error': 'API Key 未配置'}, 500
             
-            # 如果提供了session_id,保存到聊天历史
-            if session_id:
-                # 保存用户消息(带图片标记)
-                await database.add_chat_message(
-                    session_id,
-                    'user',
-                    f"📷 {prompt}",
-                    'text'
-                )
-                # 保存AI分析结果
-                await database.add_chat_message(
-                    session_id,
-                    'assistant',
-                    analysis,
-                    'text'
+            async with upstream.slot(), httpx.AsyncClient(timeout=30.0) as client:
+                response = await client.post(
+                    'https://open.bigmodel.cn/api/paas/v4/chat/completions',
+                    headers={
+                        'Authorization': f'Bearer {api_key}',
+                        'Content-Type': 'application/json'
+                    },
+                    json={
+                        'model': 'glm-4v-flash',
+                        'messages': [
+                            {
+                                'role': 'user',
+                                'content': [
+                                    {
+                                        'type': 'text',
+                                        'text': prompt
+                                    },
+                                    {
+                                        'type': 'image_url',
+                                        'image_url': {
+                                            'url': f'data:image/jpeg;base64,{base64_image}'
+                                        }
+                                    }
+                                ]
+                            }
+                        ]
+                    }
                 )
-                await database.update_session(session_id)
-            
-            return {
-                'filename': image.filename,
-                'analysis': analysis,
-                'prompt': prompt
-            }
+                
+                if response.status_code != 200:
+                    error_text = response.text
+                    lease.fail()
+                    return {'error': f'分析失败: {error_text}'}, response.status_code
+                
+                result = response.json()
+                analysis = result['choices'][0]['message']['content']
+                usage = result.get('usage') or {}
+                lease.record_tokens(usage.get('prompt_tokens'), usage.get('completion_tokens'))
+                
+                # 如果提供了session_id,保存到聊天历史
+                if session_id:
+                    # 保存用户消息(带图片标记)
+                    await database.add_chat_message(
+                        session_id,
+                        'user',
+                        f"📷 {prompt}",
+                        'text'
+                    )
+                    # 保存AI分析结果
+                    await database.add_chat_message(
+                        session_id,
+                        'assistant',
+                        analysis,
+                        'text'
+                    )
+                    await database.update_session(session_id)
+                
+                return {
+                    'filename': image.filename,
+                    'analysis': analysis,
+                    'prompt': prompt
+                }
     except Exception as e:
         import traceback
         traceback.print_exc()
+        lease.fail()
         return {'error': str(e)}, 500
+    finally:
+        lease.release()
 
 
 # ============================================
@@ -557,80 +1473,89 @@ class DrawRequest(BaseModel):
 @app.post('/api/draw')
 async def generate_image(
     request: DrawRequest,
-    database: Database = Depends(get_db)
+    database: Database = Depends(get_db),
+    tenant: Tenant = Depends(get_tenant)
 ):
     """AI 绘画生成"""
     import httpx
     import os
     
+    if request.session_id:
+        await check_session(tenant, request.session_id)
+    lease = admit(tenant, request.model)
     try:
-        api_key = os.getenv('ZHIPU_API_KEY')
-        if not api_key:
-            return {'error': 'API Key 未配置'}, 500
-        
-        # 调用智谱 AI 绘画接口
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                'https://open.bigmodel.cn/api/paas/v4/images/generations',
-                headers={
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                },
-                json={
-                    'model': request.model,
-                    'prompt': request.prompt,
-                    'size': request.size,
-                    'quality': request.quality
-                }
-            )
-            
-            if response.status_code != 200:
-                error_text = response.text
-                return {'error': f'生成失败: {error_text}'}, response.status_code
+        with priority(Priority.MEDIA):
+            api_key = os.getenv('ZHIPU_API_KEY')
+            if not api_key:
+                return {'error': 'API Key 未配置'}, 500
             
-            result = response.json()
-            image_url = result['data'][0]['url'] if result.get('data') else None
-            
-            # 保存到绘画历史
-            if image_url:
-                await database.save_draw_history(
-                    prompt=request.prompt,
-                    model=request.model,
-                    image_url=image_url,
-                    size=request.size
+            # 调用智谱 AI 绘画接口
+            async with upstream.slot(), httpx.AsyncClient(timeout=60.0) as client:
+                response = await client.post(
+                    'https://open.bigmodel.cn/api/paas/v4/images/generations',
+                    headers={
+                        'Authorization': f'Bearer {api_key}',
+                        'Content-Type': 'application/json'
+                    },
+                    json={
+                        'model': request.model,
+                        'prompt': request.prompt,
+                        'size': request.size,
+                        'quality': request.quality
+                    }
                 )
                 
-                # 如果提供了 session_id,保存到聊天消息表
-                if request.session_id:
-                    # 保存用户的绘图请求
-                    await database.add_chat_message(
-                        request.session_id,
-                        'user',
-                        f"🎨 {request.prompt}",
-                        'text'
-                    )
-                    # 保存 AI 生成的图片
-                    await database.add_chat_message(
-                        request.session_id,
-                        'assistant',
-                        f"已为您生成图片\n\n提示词: {request.prompt}",
-                        'image',
-                        image_url
+                if response.status_code != 200:
+                    error_text = response.text
+                    lease.fail()
+                    return {'error': f'生成失败: {error_text}'}, response.status_code
+                
+                result = response.json()
+                image_url = result['data'][0]['url'] if result.get('data') else None
+                
+                # 保存到绘画历史
+                if image_url:
+                    await database.save_draw_history(
+                        prompt=request.prompt,
+                        model=request.model,
+                        image_url=image_url,
+                        size=request.size
                     )
-                    await database.update_session(request.session_id)
-            
-            return {
-                'success': True,
-                'prompt': request.prompt,
-                'image_url': image_url,
-                'created': result.get('created'),
-                'content_filter': result.get('content_filter', [])
-            }
-            
+                    
+                    # 如果提供了 session_id,保存到聊天消息表
+                    if request.session_id:
+                        # 保存用户的绘图请求
+                        await database.add_chat_message(
+                            request.session_id,
+                            'user',
+                            f"🎨 {request.prompt}",
+                            'text'
+                        )
+                        # 保存 AI 生成的图片
+                        await database.add_chat_message(
+                            request.session_id,
+                            'assistant',
+                            f"已为您生成图片\n\n提示词: {request.prompt}",
+                            'image',
+                            image_url
+                        )
+                        await database.update_session(request.session_id)
+                
+                return {
+                    'success': True,
+                    'prompt': request.prompt,
+                    'image_url': image_url,
+                    'created': result.get('created'),
+                    'content_filter': result.get('content_filter', [])
+                }
+                
     except Exception as e:
         import traceback
         traceback.print_exc()
+        lease.fail()
         return {'error': str(e)}, 500
+    finally:
+        lease.release()
 
 
 @app.get('/api/draw/history')
@@ -656,6 +1581,44 @@ async def health_check():
     }
 
 
+@app.get('/api/ready')
+async def readiness_check():
+    """就绪检查: 预热完成前返回 503, 用于负载均衡/自动扩缩容"""
+    status_code = 200 if startup_report.ready else 503
+    return FastJSONResponse(startup_report.as_dict(), status_code=status_code)
+
+
+@app.get('/api/metrics/streams')
+async def stream_metrics():
+    """流式输出统计: 各接口的帧数、每帧字节数、帧率等, 以及长网页分段总结的缓存命中情况 (当前进程)"""
+    return {
+        'active': stream_registry.active,
+        'endpoints': {name: metrics.as_dict() for name, metrics in stream_registry.metrics.items()},
+        'chunk_summaries': summarizer.as_dict(),
+        'session_titles': titler.as_dict(),
+        'history_cache': history_cache.as_dict(),
+    }
+
+
+@app.get('/api/metrics/scheduler')
+async def scheduler_metrics(database: Database = Depends(get_db)):
+    """优先级调度统计: 数据库线程和模型服务调用在各优先级的名额占用、等待次数和等待时间 (当前进程)"""
+    return {
+        'db': database.executor_stats(),
+        'upstream': upstream.as_dict(),
+    }
+
+
+@app.get('/api/metrics/tools')
+async def tool_metrics():
+    """工具调用统计: 各工具的调用次数、缓存命中率、耗时和超时次数, 以及外部 MCP 服务器状态 (当前进程)"""
+    pool = get_mcp_pool()
+    return {
+        **tool_executor.snapshot(),
+        'mcp_servers': pool.status() if pool is not None else {},
+    }
+
+
 @app.get('/api/version')
 async def get_version():
     """获取版本信息"""
@@ -677,5 +1640,5 @@ if __name__ == '__main__':
         'main:app',
         host=os.getenv('HOST', '0.0.0.0'),
         port=int(os.getenv('PORT', 8000)),
-        reload=True
+        reload=os.getenv('RELOAD', 'true').lower() == 'true'
     )
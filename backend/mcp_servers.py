@@ -0,0 +1,174 @@
+"""外部 MCP 服务器
+
+通过 MCP_SERVERS_CONFIG 指定配置文件 (与常见 MCP 客户端相同的 mcpServers 格式), 支持 stdio 和 HTTP:
+
+    {
+      "mcpServers": {
+        "fetch": {"command": "uvx", "args": ["mcp-server-fetch"]},
+        "search": {"url": "http://127.0.0.1:9000/mcp"}
+      }
+    }
+
+工具名以服务器名为前缀 (如 fetch_fetch)。与每次对话运行时连接 (stdio 需启动子进程) 相比:
+
+- 持久会话: 应用启动后由一个常驻任务连接所有服务器并保持会话, 各次对话复用
+- 工具列表缓存: list_tools 的结果缓存 MCP_TOOLS_CACHE_TTL 秒, 不再每轮对话请求一次
+- 并发限制: 每个服务器同时进行的工具调用不超过 MCP_MAX_CONCURRENCY
+- 连接失败的服务器不向模型提供工具, 不影响其他工具和对话
+
+导入本模块会导入 pydantic-ai, 由 agents.get_mcp_pool 在构建 Agent 时按需导入。
+本地 MCP 服务器 (agents.build_mcp_server) 的工具默认直接以函数调用, 不经过这里。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field, replace
+from typing import Any
+
+from pydantic_ai.mcp import MCPServer, load_mcp_servers
+from pydantic_ai.toolsets import ToolsetTool, WrapperToolset
+
+# 每个服务器同时进行的工具调用上限
+MCP_MAX_CONCURRENCY = int(os.getenv('MCP_MAX_CONCURRENCY', '4'))
+
+# 工具列表缓存时间 (秒)
+MCP_TOOLS_CACHE_TTL = float(os.getenv('MCP_TOOLS_CACHE_TTL', '300'))
+
+
+@dataclass
+class PooledMCPToolset(WrapperToolset):
+    """包装一个 MCP 服务器: 缓存工具列表, 限制并发调用, 不可用时不提供工具"""
+
+    max_concurrency: int = MCP_MAX_CONCURRENCY
+    tools_ttl: float = MCP_TOOLS_CACHE_TTL
+    # 由 MCPServerPool 在连接失败时置为 False
+    available: bool = True
+    calls: int = 0
+    failures: int = 0
+    in_flight: int = 0
+    _semaphore: asyncio.Semaphore = field(init=False, repr=False)
+    _tools: dict[str, ToolsetTool] | None = field(default=None, init=False, repr=False)
+    _tools_expires: float = field(default=0.0, init=False, repr=False)
+    _tools_lock: asyncio.Lock = field(init=False, repr=False)
+    _entered: int = field(default=0, init=False, repr=False)
+
+    def __post_init__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._tools_lock = asyncio.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.wrapped.id or self.wrapped.label
+
+    async def __aenter__(self):
+        # 每次对话运行都会进入工具集; 常驻任务已保持会话时只增加引用计数, 不会重新连接
+        if not self.available:
+            return self
+        try:
+            await self.wrapped.__aenter__()
+            self._entered += 1
+        except Exception as e:
+            print(f"❌ [MCP] 连接 {self.name} 失败: {e}")
+        return self
+
+    async def __aexit__(self, *args: Any) -> bool | None:
+        if self._entered:
+            self._entered -= 1
+            return await self.wrapped.__aexit__(*args)
+        return None
+
+    async def get_tools(self, ctx) -> dict[str, ToolsetTool]:
+        if not self.available:
+            return {}
+        if self._tools is not None and time.monotonic() < self._tools_expires:
+            return self._tools
+        async with self._tools_lock:
+            if self._tools is None or time.monotonic() >= self._tools_expires:
+                try:
+                    self._tools = await self.wrapped.get_tools(ctx)
+                except Exception as e:
+                    # 服务器异常时本轮不提供其工具, 稍后重试
+                    print(f"❌ [MCP] 获取 {self.name} 工具列表失败: {e}")
+                    return self._tools or {}
+                self._tools_expires = time.monotonic() + self.tools_ttl
+        return self._tools
+
+    async def call_tool(self, name, tool_args, ctx, tool) -> Any:
+        async with self._semaphore:
+            self.calls += 1
+            self.in_flight += 1
+            try:
+                return await self.wrapped.call_tool(name, tool_args, ctx, tool)
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                self.in_flight -= 1
+
+    def visit_and_replace(self, visitor):
+        # Agent 每次运行都会复制工具集树; 被包装的服务器未被替换时保持同一实例,
+        # 工具列表缓存和并发限制才能跨运行共享
+        wrapped = self.wrapped.visit_and_replace(visitor)
+        return self if wrapped is self.wrapped else replace(self, wrapped=wrapped)
+
+    def status(self) -> dict:
+        return {
+            'available': self.available,
+            'connected': bool(getattr(self.wrapped, 'is_running', False)),
+            'tools': len(self._tools or {}),
+            'calls': self.calls,
+            'failures': self.failures,
+            'in_flight': self.in_flight,
+        }
+
+
+class MCPServerPool:
+    """外部 MCP 服务器的常驻连接"""
+
+    def __init__(self, servers: list[MCPServer]):
+        self.toolsets = [PooledMCPToolset(server) for server in servers]
+        self._task: asyncio.Task | None = None
+        self._stop = asyncio.Event()
+
+    @classmethod
+    def from_config(cls, path: str) -> MCPServerPool:
+        return cls(load_mcp_servers(path))
+
+    async def start(self):
+        """连接所有服务器, 全部连接 (或失败) 后返回"""
+        if self._task is not None:
+            return
+        ready = asyncio.Event()
+        self._task = asyncio.create_task(self._hold(ready))
+        await ready.wait()
+
+    async def _hold(self, ready: asyncio.Event):
+        # MCP 客户端 (anyio) 要求在同一个任务中进入和退出会话, 因此由一个常驻任务持有全部连接
+        try:
+            async with AsyncExitStack() as stack:
+                for toolset in self.toolsets:
+                    try:
+                        await stack.enter_async_context(toolset.wrapped)
+                    except Exception as e:
+                        toolset.available = False
+                        print(f"❌ [MCP] 连接 {toolset.name} 失败, 其工具将不可用: {e}")
+                    else:
+                        print(f"🔌 [MCP] 已连接 {toolset.name}")
+                ready.set()
+                await self._stop.wait()
+        finally:
+            ready.set()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        await self._task
+        self._task = None
+
+    def status(self) -> dict[str, dict]:
+        return {toolset.name: toolset.status() for toolset in self.toolsets}
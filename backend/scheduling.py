@@ -0,0 +1,279 @@
+"""优先级调度
+
+对话、图片生成/识别和后台任务 (标题生成、长网页分段提炼、归档、删除回收、用量写入) 共用同一个事件循环、
+数据库线程和模型服务配额。按优先级分为三类, 后台负载不影响对话的响应速度:
+
+- INTERACTIVE: 对话及其他用户正在等待的请求 (默认)
+- MEDIA: 图片生成、图片识别 (单次耗时长)
+- BATCH: 批量和后台任务
+
+优先级保存在 contextvars 中, 由 priority 代码块 (接口中) 或 prioritized 装饰的后台方法设置, 其中创建的任务继承同一优先级。
+
+- 数据库: PriorityExecutor 替代单线程的 ThreadPoolExecutor, 排队的操作按优先级执行,
+  高优先级的操作越过已排队的低优先级操作; 各类同时排队或执行的操作数受 DB_*_CONCURRENCY 限制
+- 模型服务: upstream 限制同时进行的调用总数 (UPSTREAM_MAX_CONCURRENCY), MEDIA 和 BATCH 另有上限,
+  总数中至少留出两者之差给对话; 名额释放时按优先级分配给等待者
+- 已开始的操作不会被中断, 只调整排队中的顺序
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import Executor, Future
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, Iterator, TypeVar
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+# 同时进行的模型服务调用上限 (0 表示不限制), 以及图片类、后台类各自的上限
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', '16'))
+UPSTREAM_MEDIA_CONCURRENCY = int(os.getenv('UPSTREAM_MEDIA_CONCURRENCY', '4'))
+UPSTREAM_BATCH_CONCURRENCY = int(os.getenv('UPSTREAM_BATCH_CONCURRENCY', '2'))
+
+# 图片类、后台类同时排队或执行的数据库操作上限 (0 表示不限制)
+DB_MEDIA_CONCURRENCY = int(os.getenv('DB_MEDIA_CONCURRENCY', '4'))
+DB_BATCH_CONCURRENCY = int(os.getenv('DB_BATCH_CONCURRENCY', '1'))
+
+
+class Priority(IntEnum):
+    """优先级 (数值越小越优先)"""
+
+    INTERACTIVE = 0
+    MEDIA = 1
+    BATCH = 2
+
+
+_priority: ContextVar[Priority] = ContextVar('priority', default=Priority.INTERACTIVE)
+
+
+def current_priority() -> Priority:
+    return _priority.get()
+
+
+@contextmanager
+def priority(level: Priority) -> Iterator[None]:
+    """在代码块内使用指定优先级"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def prioritized(level: Priority) -> Callable[[F], F]:
+    """以指定优先级运行的异步方法 (后台循环等)
+
+    不用于 FastAPI 接口: 包装函数的 __globals__ 属于本模块, 接口参数的字符串注解无法解析
+    """
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with priority(level):
+                return await func(*args, **kwargs)
+        return wrapper  # type: ignore
+    return decorator
+
+
+class _ClassStats:
+    __slots__ = ('granted', 'waited', 'wait_time', 'max_wait')
+
+    def __init__(self):
+        self.granted = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float | None):
+        self.granted += 1
+        if wait is not None:
+            self.waited += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> dict:
+        return {
+            'granted': self.granted,
+            'waited': self.waited,
+            'avg_wait_ms': round(self.wait_time / self.waited * 1000, 1) if self.waited else 0.0,
+            'max_wait_ms': round(self.max_wait * 1000, 1),
+        }
+
+
+# ============================================
+# 名额限制
+# ============================================
+
+class PriorityLimiter:
+    """按优先级分配的并发名额: 总数上限 + 各类上限, 释放时先分配给高优先级的等待者"""
+
+    def __init__(self, name: str, limit: int = 0, caps: dict[Priority, int] | None = None):
+        self.name = name
+        self.limit = limit
+        self.caps = caps or {}
+        self._active = {level: 0 for level in Priority}
+        self._waiting: dict[Priority, deque[tuple[asyncio.Future, float]]] = {level: deque() for level in Priority}
+        self._stats = {level: _ClassStats() for level in Priority}
+
+    @asynccontextmanager
+    async def slot(self, level: Priority | None = None) -> AsyncIterator[None]:
+        """占用一个名额 (默认使用当前优先级)"""
+        level = current_priority() if level is None else level
+        await self.acquire(level)
+        try:
+            yield
+        finally:
+            self.release(level)
+
+    async def acquire(self, level: Priority):
+        # 同类或更高优先级有等待者时排在其后
+        if self._allowed(level) and not any(self._waiting[p] for p in Priority if p <= level):
+            self._active[level] += 1
+            self._stats[level].record(None)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        self._waiting[level].append((waiter, start))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 已分配名额但请求被取消
+                self.release(level)
+            raise
+        self._stats[level].record(time.perf_counter() - start)
+
+    def release(self, level: Priority):
+        self._active[level] -= 1
+        self._dispatch()
+
+    def _allowed(self, level: Priority) -> bool:
+        if self.limit and sum(self._active.values()) >= self.limit:
+            return False
+        cap = self.caps.get(level, 0)
+        return not cap or self._active[level] < cap
+
+    def _dispatch(self):
+        for level in Priority:
+            queue = self._waiting[level]
+            while queue and self._allowed(level):
+                waiter, _ = queue.popleft()
+                if waiter.done():
+                    continue
+                self._active[level] += 1
+                waiter.set_result(None)
+            if self.limit and sum(self._active.values()) >= self.limit:
+                return
+
+    def as_dict(self) -> dict:
+        return {
+            'limit': self.limit,
+            'classes': {
+                level.name.lower(): {
+                    'cap': self.caps.get(level, 0),
+                    'active': self._active[level],
+                    'waiting': sum(not waiter.done() for waiter, _ in self._waiting[level]),
+                    **self._stats[level].as_dict(),
+                }
+                for level in Priority
+            },
+        }
+
+
+# ============================================
+# 数据库线程
+# ============================================
+
+class PriorityExecutor(Executor):
+    """单线程执行器: 排队的任务按提交时的优先级执行 (同一优先级先进先出)
+
+    asyncio 的 run_in_executor 在调用方的上下文中同步调用 submit, 可以直接读取当前优先级
+    """
+
+    def __init__(self, name: str = 'db', caps: dict[Priority, int] | None = None):
+        # 各类同时排队或执行的操作数 (由调用方在提交前占用)
+        self.limiter = PriorityLimiter(name, caps=caps)
+        self._queue: list[tuple[int, int, Future, Callable, tuple, dict, float]] = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._executed = {level: 0 for level in Priority}
+        self._queue_time = {level: 0.0 for level in Priority}
+        self._thread = threading.Thread(target=self._work, name=f'{name}-executor', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable, /, *args: Any, **kwargs: Any) -> Future:
+        future: Future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError('执行器已关闭')
+            heapq.heappush(self._queue, (
+                current_priority(), next(self._counter), future, fn, args, kwargs, time.perf_counter()
+            ))
+            self._condition.notify()
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self._condition:
+            self._shutdown = True
+            if cancel_futures:
+                for item in self._queue:
+                    item[2].cancel()
+                self._queue.clear()
+            self._condition.notify()
+        if wait:
+            self._thread.join()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._shutdown:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                level, _, future, fn, args, kwargs, queued_at = heapq.heappop(self._queue)
+                self._executed[level] += 1
+                self._queue_time[level] += time.perf_counter() - queued_at
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            del future, fn, args, kwargs
+
+    def as_dict(self) -> dict:
+        with self._condition:
+            queued = {level: 0 for level in Priority}
+            for item in self._queue:
+                queued[Priority(item[0])] += 1
+        limits = self.limiter.as_dict()['classes']
+        return {
+            level.name.lower(): {
+                **limits[level.name.lower()],
+                'queued': queued[level],
+                'executed': self._executed[level],
+                'avg_queue_ms': round(self._queue_time[level] / self._executed[level] * 1000, 2)
+                if self._executed[level] else 0.0,
+            }
+            for level in Priority
+        }
+
+
+# 模型服务调用名额 (对话、图片、后台共用)
+upstream = PriorityLimiter(
+    'upstream',
+    limit=UPSTREAM_MAX_CONCURRENCY,
+    caps={Priority.MEDIA: UPSTREAM_MEDIA_CONCURRENCY, Priority.BATCH: UPSTREAM_BATCH_CONCURRENCY}
+)
@@ -0,0 +1,69 @@
+"""JSON 序列化
+
+流式帧和 REST 响应共用的序列化层: 安装了 orjson 时使用 orjson, 否则回退到标准库 json。
+可通过 JSON_BACKEND 环境变量强制指定 (auto | orjson | stdlib)。
+
+两种实现的输出都是紧凑的 JSON (无多余空格); 标准库实现保留 ASCII 转义,
+其 C 加速路径比 ensure_ascii=False 更快。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from collections.abc import Callable
+from datetime import date, datetime
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto').lower()
+
+
+def _stdlib_default(obj: Any) -> Any:
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(',', ':'), default=_stdlib_default).encode('utf-8')
+
+
+def _load_backend() -> tuple[str, Callable[[Any], bytes], Callable[[str | bytes], Any]]:
+    if JSON_BACKEND in ('auto', 'orjson'):
+        try:
+            import orjson
+        except ImportError:
+            if JSON_BACKEND == 'orjson':
+                raise
+        else:
+            def orjson_dumps(obj: Any) -> bytes:
+                return orjson.dumps(obj, default=_stdlib_default, option=orjson.OPT_NON_STR_KEYS)
+            return 'orjson', orjson_dumps, orjson.loads
+    return 'stdlib', _stdlib_dumps, json.loads
+
+
+# 当前使用的实现名称, dumps 返回 UTF-8 编码的 bytes
+BACKEND, dumps, loads = _load_backend()
+
+
+def encode_frame(frame: dict[str, Any]) -> bytes:
+    """编码一帧 NDJSON (以换行结尾)"""
+    return dumps(frame) + b'\n'
+
+
+class FastJSONResponse(JSONResponse):
+    """使用 dumps 渲染的 JSON 响应, 作为应用的默认响应类"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class RawJSONResponse(JSONResponse):
+    """内容已是编码好的 JSON (如 SQLite json 函数的输出), 原样返回"""
+
+    def render(self, content: bytes | str) -> bytes:
+        return content if isinstance(content, bytes) else content.encode('utf-8')
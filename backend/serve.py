@@ -0,0 +1,45 @@
+"""生产环境启动脚本
+
+多进程部署, 每个 CPU 核心一个 worker:
+
+    cd backend
+    uv run python serve.py                # WORKERS 默认为 CPU 核心数
+    WORKERS=4 PORT=8000 uv run python serve.py
+
+多进程部署说明:
+
+- 每个 worker 拥有独立的 SQLite 连接和数据库线程。WAL 模式下读写互不阻塞,
+  写入由 SQLite 文件锁串行化; 拿不到写锁时按 DB_BUSY_TIMEOUT_MS 等待重试。
+- 各 worker 的内存缓存通过 cache_invalidations 表同步失效事件
+  (见 coordination.py), 轮询间隔由 INVALIDATION_POLL_INTERVAL 控制。
+- 收到 SIGTERM/SIGINT 后停止接收新连接, 进行中的流式响应最多等待
+  DRAIN_TIMEOUT 秒完成并写入数据库, 之后才关闭数据库连接。
+- 开发时仍使用 `python main.py` (单进程, 热重载)。
+"""
+
+from __future__ import annotations
+
+import os
+
+import uvicorn
+from dotenv import load_dotenv
+
+
+def main():
+    load_dotenv()
+    workers = int(os.getenv('WORKERS') or os.cpu_count() or 1)
+    drain_timeout = int(float(os.getenv('DRAIN_TIMEOUT', '30')))
+    print(f'🚀 启动 {workers} 个 worker')
+    uvicorn.run(
+        'main:app',
+        host=os.getenv('HOST', '0.0.0.0'),
+        port=int(os.getenv('PORT', 8000)),
+        workers=workers,
+        # uvicorn 先等待进行中的请求 (含流式响应) 结束, 超时后取消
+        timeout_graceful_shutdown=drain_timeout,
+        proxy_headers=True,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""启动阶段计时与就绪状态
+
+记录进程启动各阶段 (模块导入、数据库连接、Agent 构建、连接预热) 的耗时,
+并在预热完成后标记就绪, 供 /api/ready 使用
+"""
+
+from __future__ import annotations
+
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+# 本模块应最先被主模块导入, 以此作为导入阶段的起点
+IMPORT_STARTED = time.perf_counter()
+
+
+@dataclass
+class StartupReport:
+    """启动阶段耗时报告"""
+
+    started_at: float = IMPORT_STARTED
+    phases: dict[str, float] = field(default_factory=dict)
+    ready: bool = False
+    error: str | None = None
+    ready_after: float | None = None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """记录一个阶段的耗时 (秒)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def mark(self, name: str):
+        """记录从启动开始到当前的耗时, 用于无法包裹的阶段 (如模块导入)"""
+        self.phases[name] = time.perf_counter() - self.started_at
+
+    def mark_ready(self):
+        self.ready = True
+        self.ready_after = time.perf_counter() - self.started_at
+
+    def as_dict(self) -> dict:
+        return {
+            'ready': self.ready,
+            'error': self.error,
+            'ready_after_ms': round(self.ready_after * 1000, 1) if self.ready_after is not None else None,
+            'phases_ms': {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+        }
+
+    def log(self):
+        """打印启动阶段耗时"""
+        print('🚀 [启动] 阶段耗时:')
+        for name, seconds in self.phases.items():
+            print(f'   {name:<16} {seconds * 1000:>8.1f} ms')
+        if self.ready_after is not None:
+            print(f'   {"ready":<16} {self.ready_after * 1000:>8.1f} ms')
+        if self.error:
+            print(f'❌ [启动] 预热失败: {self.error}')
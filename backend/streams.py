@@ -0,0 +1,569 @@
+"""流式响应管理
+
+流式接口把模型调用放在独立的生产者任务中运行, HTTP 响应只负责转发帧:
+
+- 每次生成分配 stream_id, 帧带递增的 seq 并写入缓冲区; 连接中断后客户端可用
+  GET /api/chat/stream/{stream_id}?last_seq=N 续传, 无需重新调用模型
+- 缓冲区超过内存上限时, 最早的帧转存到 SQLite (stream_frames 表)
+- 所有客户端断开 STREAM_RESUME_GRACE 秒后仍未重连 (或调用 /api/chat/stop) 时取消生产者任务,
+  中止上游模型调用
+- 跟踪进程内进行中的流式响应, 以便关闭时等待它们完成 (优雅退出)
+- 模型输出按 FlushPolicy 合并成帧: 首个 token 立即发送, 之后累积到一定字数或等待时间
+  才发送一帧; 并发流较多时放宽等待时间, 用更少更大的帧降低编码和写入开销
+
+缓冲区只存在于当前进程内, 多 worker 部署时续传请求需路由到同一 worker (会话粘滞)。
+停止请求不需要粘滞: 本进程没有对应的生成时通过缓存失效通知 (STOP_CHANNEL) 广播, 由运行该生成的 worker 在下次轮询时取消。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from collections.abc import AsyncIterator, Awaitable, Callable, Mapping
+from dataclasses import dataclass, field, replace
+from typing import TYPE_CHECKING, Any, TypeVar
+
+from starlette.requests import Request
+
+from serialization import encode_frame
+
+if TYPE_CHECKING:
+    from coordination import InvalidationBus
+    from database import Database
+
+# 检测客户端断开的轮询间隔 (秒)
+# 部分服务器只在写入失败时才发现断开, 模型调用工具期间长时间没有输出, 需要主动检测
+DISCONNECT_POLL_INTERVAL = float(os.getenv('DISCONNECT_POLL_INTERVAL', '0.5'))
+
+# 所有客户端断开后等待重连的时间 (秒), 超时则取消生成; 0 表示断开即取消
+STREAM_RESUME_GRACE = float(os.getenv('STREAM_RESUME_GRACE', '10'))
+
+# 生成结束后缓冲区保留时间 (秒)
+STREAM_BUFFER_TTL = float(os.getenv('STREAM_BUFFER_TTL', '120'))
+
+# 单个流在内存中保留的最大字节数, 超出部分转存到 SQLite
+STREAM_BUFFER_MAX_BYTES = int(os.getenv('STREAM_BUFFER_MAX_BYTES', str(256 * 1024)))
+
+# 所有流缓冲区的内存总上限, 超出时先淘汰已结束的流, 再转存进行中的流
+STREAM_BUFFERS_MAX_TOTAL = int(os.getenv('STREAM_BUFFERS_MAX_TOTAL', str(64 * 1024 * 1024)))
+
+# 清理过期缓冲区的间隔 (秒)
+JANITOR_INTERVAL = 30
+
+# SQLite 中转存帧的最长保留时间 (秒), 用于清理异常退出的进程遗留的数据
+STREAM_FRAMES_MAX_AGE = 3600
+
+# 并发流数量达到该值时视为高负载, 使用 FlushPolicy.busy_latency
+STREAM_BUSY_STREAMS = int(os.getenv('STREAM_BUSY_STREAMS', '32'))
+
+# 吞吐统计的滑动窗口 (秒)
+METRICS_WINDOW = 60.0
+
+# 停止请求的失效通知通道, 键为会话 ID 等 key
+STOP_CHANNEL = 'stream_stop'
+
+# 生产者: 运行模型并通过 run.emit 发送帧; 被取消时可在 except CancelledError 中收尾
+Producer = Callable[['StreamRun'], Awaitable[None]]
+
+# 缓冲区中的一帧: (seq, type, 编码后的 NDJSON 行)
+Frame = tuple[int, str, bytes]
+
+T = TypeVar('T')
+
+
+# ============================================
+# 输出合并策略
+# ============================================
+
+@dataclass(frozen=True)
+class FlushPolicy:
+    """模型输出的合并策略
+
+    累积的新增字数达到 min_chars, 或距上次发送超过 max_latency 秒时发送一帧;
+    高负载时等待时间放宽到 busy_latency
+    """
+
+    min_chars: int = 32
+    max_latency: float = 0.05
+    busy_latency: float = 0.2
+    first_immediate: bool = True
+
+    @classmethod
+    def from_env(cls, name: str, default: FlushPolicy) -> FlushPolicy:
+        """读取 STREAM_FLUSH_<NAME> 覆盖默认值, 格式如 min_chars=16,max_latency=0.03"""
+        return cls.parse(os.getenv(f'STREAM_FLUSH_{name.upper()}', ''), default, f'STREAM_FLUSH_{name.upper()}')
+
+    @classmethod
+    def parse(cls, raw: str, default: FlushPolicy, source: str) -> FlushPolicy:
+        """按 min_chars=16,max_latency=0.03 格式覆盖 default 的字段, source 用于错误信息"""
+        overrides: dict[str, Any] = {}
+        for item in filter(None, (part.strip() for part in raw.split(','))):
+            field_name, _, value = item.partition('=')
+            field_name = field_name.strip()
+            if field_name == 'first_immediate':
+                overrides[field_name] = value.strip().lower() == 'true'
+            elif field_name == 'min_chars':
+                overrides[field_name] = int(value)
+            elif field_name in ('max_latency', 'busy_latency'):
+                overrides[field_name] = float(value)
+            else:
+                raise ValueError(f'{source}: 未知参数 {field_name}')
+        return replace(default, **overrides)
+
+
+# 各接口的默认策略: 对话优先响应速度; 网页总结和转 JSON 用户只看最终结果, 帧可以更大
+ENV_FLUSH_POLICIES: dict[str, FlushPolicy] = {
+    name: FlushPolicy.from_env(name, policy)
+    for name, policy in {
+        'chat': FlushPolicy(min_chars=24, max_latency=0.03, busy_latency=0.15),
+        'summarize': FlushPolicy(min_chars=64, max_latency=0.08, busy_latency=0.3),
+        'to_json': FlushPolicy(min_chars=128, max_latency=0.15, busy_latency=0.5),
+    }.items()
+}
+# 当前生效的策略: 环境变量的值再叠加 user_config 中的 stream_flush_<接口名> (见 apply_flush_config)
+FLUSH_POLICIES: dict[str, FlushPolicy] = dict(ENV_FLUSH_POLICIES)
+DEFAULT_FLUSH_POLICY = FlushPolicy()
+
+
+def apply_flush_config(config: Mapping[str, str]):
+    """配置变化时重新计算各接口的策略 (只在变化时解析一次, 每次流式输出直接读取 FLUSH_POLICIES)"""
+    for name, policy in ENV_FLUSH_POLICIES.items():
+        raw = config.get(f'stream_flush_{name}', '')
+        try:
+            FLUSH_POLICIES[name] = FlushPolicy.parse(raw, policy, f'stream_flush_{name}')
+        except ValueError as e:
+            FLUSH_POLICIES[name] = policy
+            print(f'⚠️ [流式输出] 配置无效, 使用默认策略: {e}')
+
+
+@dataclass
+class StreamMetrics:
+    """单个接口的输出统计"""
+
+    streams: int = 0
+    chunks: int = 0
+    frames: int = 0
+    bytes: int = 0
+    # 最近 METRICS_WINDOW 秒内每帧的 (时间, 字节数)
+    recent: deque[tuple[float, int]] = field(default_factory=deque)
+
+    def record(self, nbytes: int):
+        now = time.monotonic()
+        self.frames += 1
+        self.bytes += nbytes
+        self.recent.append((now, nbytes))
+        while self.recent and now - self.recent[0][0] > METRICS_WINDOW:
+            self.recent.popleft()
+
+    def as_dict(self) -> dict:
+        now = time.monotonic()
+        recent = [nbytes for t, nbytes in self.recent if now - t <= METRICS_WINDOW]
+        return {
+            'streams': self.streams,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'upstream_chunks': self.chunks,
+            'bytes_per_frame': round(self.bytes / self.frames, 1) if self.frames else 0,
+            'chunks_per_frame': round(self.chunks / self.frames, 2) if self.frames else 0,
+            'frames_per_sec': round(len(recent) / METRICS_WINDOW, 2),
+            'bytes_per_sec': round(sum(recent) / METRICS_WINDOW, 1),
+        }
+
+
+def coalesce(frames: list[Frame]) -> list[Frame]:
+    """content 帧携带的是截至当前的完整文本, 只需保留最后一个"""
+    last_content = max((i for i, f in enumerate(frames) if f[1] == 'content'), default=-1)
+    return [f for i, f in enumerate(frames) if f[1] != 'content' or i == last_content]
+
+
+# ============================================
+# 传输编码
+# ============================================
+
+async def encode_ndjson(frames: AsyncIterator[Frame | None]) -> AsyncIterator[bytes]:
+    """按行分隔的 JSON"""
+    async for frame in frames:
+        if frame is not None:
+            yield frame[2]
+
+
+async def encode_sse(frames: AsyncIterator[Frame | None]) -> AsyncIterator[bytes]:
+    """Server-Sent Events: id 为 seq, 断线后浏览器通过 Last-Event-ID 续传; 空闲时发送注释保活"""
+    # 先发送一条注释, 让代理和浏览器尽早确认响应已开始
+    yield b': stream\n\n'
+    async for frame in frames:
+        if frame is None:
+            yield b': keep-alive\n\n'
+        else:
+            seq, type_, data = frame
+            yield b'id: %d\nevent: %s\ndata: %s\n' % (seq, type_.encode(), data)
+
+
+@dataclass
+class StreamRun:
+    """一次流式生成及其帧缓冲区"""
+
+    registry: StreamRegistry
+    key: str | None
+    endpoint: str = 'chat'
+    stream_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    task: asyncio.Task | None = None
+    # 取消原因: 'stopped' (用户停止) / 'disconnected' (客户端断开) / 'shutdown'
+    cancel_reason: str | None = None
+    finished_at: float | None = None
+    next_seq: int = 0
+    consumers: int = 0
+    frames: deque[Frame] = field(default_factory=deque)
+    buffered_bytes: int = 0
+    # 正在写入 SQLite 的帧, 写入完成前仍从内存读取
+    spilling: list[Frame] = field(default_factory=list)
+    spilled: bool = False
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    _grace_task: asyncio.Task | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def emit(self, frame: dict[str, Any]):
+        """编码一帧并写入缓冲区, 唤醒等待中的客户端"""
+        seq = self.next_seq
+        self.next_seq += 1
+        data = encode_frame({**frame, 'seq': seq})
+        self.frames.append((seq, frame['type'], data))
+        self.registry.metrics_for(self.endpoint).record(len(data))
+        self.buffered_bytes += len(data)
+        self.registry.total_bytes += len(data)
+        if self.buffered_bytes > STREAM_BUFFER_MAX_BYTES:
+            self.spill(self.buffered_bytes - STREAM_BUFFER_MAX_BYTES // 2)
+        self.registry.enforce_memory_cap()
+        self._notify()
+
+    async def paced(self, texts: AsyncIterator[str]) -> AsyncIterator[str]:
+        """按接口的 FlushPolicy 合并模型输出
+
+        texts 为截至当前的完整文本 (stream_text 的默认输出), 合并时只需丢弃中间结果。
+        等待下一个 token 期间到达发送时间时, 也会发送已累积的文本。
+        """
+        policy = FLUSH_POLICIES.get(self.endpoint, DEFAULT_FLUSH_POLICY)
+        metrics = self.registry.metrics_for(self.endpoint)
+        iterator = aiter(texts)
+        pending: str | None = None
+        sent_len = 0
+        sent_at = time.monotonic()
+        first = policy.first_immediate
+        next_task: asyncio.Task | None = None
+        try:
+            while True:
+                if next_task is None:
+                    next_task = asyncio.ensure_future(anext(iterator))
+                timeout = None
+                if pending is not None:
+                    latency = policy.busy_latency if self.registry.active >= STREAM_BUSY_STREAMS else policy.max_latency
+                    timeout = max(0.0, sent_at + latency - time.monotonic())
+                done, _ = await asyncio.wait({next_task}, timeout=timeout)
+                if done:
+                    try:
+                        text = next_task.result()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        next_task = None
+                    metrics.chunks += 1
+                    pending = text
+                    if not first and len(text) - sent_len < policy.min_chars:
+                        continue
+                if pending is not None:
+                    first = False
+                    sent_len = len(pending)
+                    sent_at = time.monotonic()
+                    yield pending
+                    pending = None
+            if pending is not None:
+                yield pending
+        finally:
+            if next_task is not None:
+                next_task.cancel()
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def cancel(self, reason: str) -> bool:
+        """取消生产者任务; 已结束或已取消时返回 False"""
+        if self.task is None or self.task.done() or self.cancel_reason is not None:
+            return False
+        self.cancel_reason = reason
+        self.task.cancel()
+        return True
+
+    def spill(self, nbytes: int):
+        """将最早的帧 (至少 nbytes 字节) 转存到 SQLite; 始终保留最新一帧在内存中"""
+        db = self.registry.db
+        if db is None:
+            return
+        batch: list[Frame] = []
+        freed = 0
+        while self.frames and freed < nbytes and len(self.frames) > 1:
+            frame = self.frames.popleft()
+            batch.append(frame)
+            freed += len(frame[2])
+        if not batch:
+            return
+        self.buffered_bytes -= freed
+        self.registry.total_bytes -= freed
+        self.spilling.extend(batch)
+        self.spilled = True
+        asyncio.get_running_loop().create_task(self._write_spill(db, batch))
+
+    async def frames_after(self, seq: int) -> list[Frame]:
+        """返回 seq 之后的所有帧 (必要时从 SQLite 读取已转存的部分)"""
+        memory = [*self.spilling, *self.frames]
+        if self.spilled and (not memory or memory[0][0] > seq + 1) and self.registry.db is not None:
+            stored = await self.registry.db.get_stream_frames(self.stream_id, seq)
+            last = stored[-1][0] if stored else seq
+            return stored + [f for f in (*self.spilling, *self.frames) if f[0] > last]
+        return [f for f in memory if f[0] > seq]
+
+    def attach(self):
+        self.consumers += 1
+        if self._grace_task:
+            self._grace_task.cancel()
+            self._grace_task = None
+
+    def detach(self):
+        self.consumers -= 1
+        if self.consumers or self.finished:
+            return
+        if STREAM_RESUME_GRACE > 0:
+            self._grace_task = asyncio.get_running_loop().create_task(self._cancel_after_grace())
+        else:
+            self.cancel('disconnected')
+
+    def drop_buffer(self):
+        self.registry.total_bytes -= self.buffered_bytes
+        self.buffered_bytes = 0
+        self.frames.clear()
+
+    def _notify(self):
+        # 唤醒当前所有等待者, 之后的等待者使用新的 Event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def _cancel_after_grace(self):
+        await asyncio.sleep(STREAM_RESUME_GRACE)
+        if self.consumers == 0 and self.cancel('disconnected'):
+            print(f'🔌 [流式] 客户端未重连, 取消生成: {self.stream_id}')
+
+    async def _write_spill(self, db: Database, batch: list[Frame]):
+        try:
+            await db.add_stream_frames(self.stream_id, batch)
+        finally:
+            spilled_upto = batch[-1][0]
+            self.spilling = [f for f in self.spilling if f[0] > spilled_upto]
+
+
+@dataclass
+class StreamRegistry:
+    """进行中的流式响应及可续传的缓冲区"""
+
+    db: Database | None = None
+    bus: InvalidationBus | None = None
+    active: int = 0
+    draining: bool = False
+    total_bytes: int = 0
+    # 会话 ID 等 key -> 进行中的生成, 用于 /api/chat/stop
+    runs: dict[str, StreamRun] = field(default_factory=dict)
+    # stream_id -> 生成 (含已结束但未过期的)
+    buffers: dict[str, StreamRun] = field(default_factory=dict)
+    metrics: dict[str, StreamMetrics] = field(default_factory=dict)
+    _idle: asyncio.Event = field(default_factory=asyncio.Event)
+    _janitor: asyncio.Task | None = None
+
+    def __post_init__(self):
+        self._idle.set()
+
+    async def start(self, db: Database, bus: InvalidationBus | None = None):
+        """启动缓冲区清理任务, 并接收其他 worker 广播的停止请求"""
+        self.db = db
+        if bus is not None:
+            self.bus = bus
+            bus.subscribe(STOP_CHANNEL, lambda key: key is not None and self.stop(key))
+        await db.prune_stream_frames(STREAM_FRAMES_MAX_AGE)
+        self._janitor = asyncio.create_task(self._janitor_loop())
+
+    def stop_janitor(self):
+        if self._janitor:
+            self._janitor.cancel()
+            self._janitor = None
+
+    def metrics_for(self, endpoint: str) -> StreamMetrics:
+        metrics = self.metrics.get(endpoint)
+        if metrics is None:
+            metrics = self.metrics[endpoint] = StreamMetrics()
+        return metrics
+
+    def start_run(self, produce: Producer, key: str | None = None, endpoint: str = 'chat') -> StreamRun:
+        """启动生产者任务
+
+        key 用于 /api/chat/stop 定位任务 (如会话 ID), 同一 key 的新任务会停止旧任务;
+        endpoint 决定输出合并策略和统计归属
+        """
+        run = StreamRun(self, key, endpoint)
+        self.metrics_for(endpoint).streams += 1
+        if key is not None:
+            previous = self.runs.get(key)
+            if previous:
+                previous.cancel('stopped')
+            self.runs[key] = run
+        self.buffers[run.stream_id] = run
+        run.task = asyncio.create_task(self._produce(run, produce))
+        return run
+
+    async def relay(
+        self,
+        request: Request,
+        produce: Producer,
+        key: str | None = None,
+        keepalive: float | None = None,
+        endpoint: str = 'chat',
+    ) -> AsyncIterator[Frame | None]:
+        """启动生产者任务并转发其输出"""
+        run = self.start_run(produce, key, endpoint)
+        async for frame in self.follow(request, run, -1, keepalive):
+            yield frame
+
+    def get(self, stream_id: str) -> StreamRun | None:
+        return self.buffers.get(stream_id)
+
+    async def follow(
+        self,
+        request: Request | None,
+        run: StreamRun,
+        last_seq: int,
+        keepalive: float | None = None,
+    ) -> AsyncIterator[Frame | None]:
+        """转发 last_seq 之后的帧直到生成结束; 客户端断开时解除关联
+
+        设置 keepalive 时, 空闲超过该秒数会产出 None, 供传输层发送保活数据。
+        request 为 None 时 (如 WebSocket) 由调用方负责在断开时关闭生成器。
+        """
+        gone = False
+
+        async def watch_disconnect():
+            nonlocal gone
+            while True:
+                await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+                if await request.is_disconnected():
+                    gone = True
+                    run.changed.set()
+                    return
+
+        run.attach()
+        watcher = asyncio.create_task(watch_disconnect()) if request is not None else None
+        try:
+            while not gone:
+                changed = run.changed
+                frames = await run.frames_after(last_seq)
+                for frame in coalesce(frames):
+                    yield frame
+                    last_seq = frame[0]
+                if run.finished and last_seq >= run.next_seq - 1:
+                    return
+                if frames:
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            if watcher:
+                watcher.cancel()
+            run.detach()
+
+    def stop(self, key: str) -> bool:
+        """停止本进程中指定 key 的流式生成"""
+        run = self.runs.get(key)
+        return run.cancel('stopped') if run else False
+
+    async def stop_everywhere(self, key: str) -> tuple[bool, bool]:
+        """停止指定 key 的流式生成, 返回 (是否在本进程中停止, 是否已广播给其他 worker)
+
+        本进程中没有时广播停止请求, 生成在其他 worker 中时于下次轮询 (INVALIDATION_POLL_INTERVAL) 时取消
+        """
+        if self.stop(key):
+            return True, False
+        if self.bus is None:
+            return False, False
+        await self.bus.publish(STOP_CHANNEL, key)
+        return False, True
+
+    async def wrap(self, stream: AsyncIterator[T]) -> AsyncIterator[T]:
+        """包装流式生成器, 在其运行期间计入 active"""
+        self.active += 1
+        self._idle.clear()
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self.active -= 1
+            if self.active == 0:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """停止接收新的流, 并等待进行中的流结束; 超时返回 False"""
+        self.draining = True
+        if self.active:
+            print(f'⏳ [退出] 等待 {self.active} 个进行中的流式响应结束 (最多 {timeout:.0f}s)')
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            print(f'⚠️ [退出] 仍有 {self.active} 个流式响应未结束, 强制退出')
+            for run in list(self.buffers.values()):
+                run.cancel('shutdown')
+            return False
+
+    def enforce_memory_cap(self):
+        """超出总内存上限时, 先淘汰最早结束的缓冲区, 再转存最大的进行中缓冲区"""
+        if self.total_bytes <= STREAM_BUFFERS_MAX_TOTAL:
+            return
+        finished = sorted((r for r in self.buffers.values() if r.finished), key=lambda r: r.finished_at)
+        for run in finished:
+            self._expire(run)
+            if self.total_bytes <= STREAM_BUFFERS_MAX_TOTAL:
+                return
+        for run in sorted(self.buffers.values(), key=lambda r: r.buffered_bytes, reverse=True):
+            run.spill(run.buffered_bytes)
+            if self.total_bytes <= STREAM_BUFFERS_MAX_TOTAL:
+                return
+
+    async def _produce(self, run: StreamRun, produce: Producer):
+        try:
+            await produce(run)
+        finally:
+            run.finish()
+            if run.key is not None and self.runs.get(run.key) is run:
+                del self.runs[run.key]
+
+    def _expire(self, run: StreamRun):
+        run.drop_buffer()
+        self.buffers.pop(run.stream_id, None)
+        if run.spilled and self.db is not None:
+            asyncio.get_running_loop().create_task(self.db.delete_stream_frames(run.stream_id))
+
+    async def _janitor_loop(self):
+        while True:
+            await asyncio.sleep(JANITOR_INTERVAL)
+            now = time.monotonic()
+            for run in list(self.buffers.values()):
+                if run.finished and run.consumers == 0 and now - run.finished_at > STREAM_BUFFER_TTL:
+                    self._expire(run)
+            if self.db is not None:
+                try:
+                    await self.db.prune_stream_frames(STREAM_FRAMES_MAX_AGE)
+                except Exception as e:
+                    print(f'❌ [流式] 清理转存帧失败: {e}')
@@ -0,0 +1,226 @@
+"""长网页的分段总结 (map-reduce)
+
+网页总结 / 转 JSON 时, 正文超过 WEB_PROMPT_MAX_CHARS 不再截断, 而是:
+
+1. 分段: 按结构切分 (段落、Markdown 标题, 过长的段落按句子), 每段不超过 SUMMARY_CHUNK_CHARS。
+   分段边界由内容决定: 在标题前、以及哈希命中的段落之后结束一段, 修改页面某处只会改变附近的分段
+2. map: 各分段并发提炼要点, 全进程同时进行的提炼调用不超过 SUMMARY_CONCURRENCY;
+   结果按 (用途, 模型, 分段内容) 的哈希缓存在 summary_chunks 表, 重新总结修改过的页面时只处理变化的分段,
+   并发请求中相同的分段只调用一次模型; 提炼按批量任务调度 (scheduling.Priority.BATCH), 大量分段不会挤占对话的模型调用名额
+3. reduce: 各段要点按顺序合并后交给原来的提示词流式生成最终结果; 要点仍然过长时先分组再提炼一轮
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import re
+import time
+import zlib
+from collections.abc import Callable
+from typing import TYPE_CHECKING
+
+from scheduling import Priority, prioritized, upstream
+
+if TYPE_CHECKING:
+    from pydantic_ai import Agent
+
+    from database import Database
+
+# 每个分段的最大字符数
+SUMMARY_CHUNK_CHARS = int(os.getenv('SUMMARY_CHUNK_CHARS', '3000'))
+
+# 全进程同时进行的分段提炼调用上限
+SUMMARY_CONCURRENCY = int(os.getenv('SUMMARY_CONCURRENCY', '4'))
+
+# 单个网页最多处理的分段数, 超出部分忽略
+SUMMARY_MAX_CHUNKS = int(os.getenv('SUMMARY_MAX_CHUNKS', '32'))
+
+# 分段要点的缓存时间 (秒)
+SUMMARY_CACHE_TTL = int(os.getenv('SUMMARY_CACHE_TTL', str(7 * 86400)))
+
+# 段落哈希能被该值整除时 (且分段已达一半长度) 在其后结束分段, 使边界只取决于附近的内容
+BOUNDARY_MODULUS = 4
+
+# 提示词版本, 修改 MAP_PROMPTS 后递增, 使旧的缓存失效
+PROMPT_VERSION = 1
+
+# 各用途提炼分段的提示词
+MAP_PROMPTS = {
+    'summary': """以下是一篇网页正文的一部分:
+
+{chunk}
+
+请提炼这部分的要点, 使用简洁的 Markdown 列表, 不超过 150 字, 不要添加原文没有的信息。""",
+    'json': """以下是一篇网页正文的一部分:
+
+{chunk}
+
+请提取这部分中的关键信息 (标题、事实、数据、人名、日期、关键词等), 使用简洁的 Markdown 列表,
+不超过 200 字, 不要添加原文没有的信息。""",
+}
+
+# 进度回调: (已完成分段数, 分段总数)
+ProgressCallback = Callable[[int, int], None]
+
+_HEADING = re.compile(r'#{1,6} ')
+# 在句末标点 (或英文句号后的空格) 之后切分
+_SENTENCE_BREAK = re.compile(r'(?<=[。！？!?；])|(?<=[.;] )')
+
+
+# ============================================
+# 分段
+# ============================================
+
+def _units(text: str, size: int) -> list[str]:
+    """正文按行切成段落 (提取结果以空行分隔, 插件提交的文本以换行分隔);
+    超过 size 的段落按句子组合, 单句过长时按长度硬切
+    """
+    units: list[str] = []
+    for block in text.splitlines():
+        block = block.strip()
+        if not block:
+            continue
+        if len(block) <= size:
+            units.append(block)
+            continue
+        piece = ''
+        for sentence in _SENTENCE_BREAK.split(block):
+            while len(sentence) > size:
+                if piece:
+                    units.append(piece)
+                    piece = ''
+                units.append(sentence[:size])
+                sentence = sentence[size:]
+            if piece and len(piece) + len(sentence) > size:
+                units.append(piece)
+                piece = ''
+            piece += sentence
+        if piece.strip():
+            units.append(piece.strip())
+    return units
+
+
+def split_chunks(text: str, size: int = SUMMARY_CHUNK_CHARS) -> list[str]:
+    """按结构把正文切成不超过 size 字符的分段"""
+    chunks: list[str] = []
+    current: list[str] = []
+    length = 0
+    for unit in _units(text, size):
+        # 加入后超长, 或遇到标题且当前分段已有一定长度时, 先结束当前分段
+        if current and (length + len(unit) > size or (_HEADING.match(unit) and length >= size // 4)):
+            chunks.append('\n'.join(current))
+            current, length = [], 0
+        current.append(unit)
+        length += len(unit) + 1
+        if length >= size // 2 and zlib.crc32(unit.encode()) % BOUNDARY_MODULUS == 0:
+            chunks.append('\n'.join(current))
+            current, length = [], 0
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+# ============================================
+# map-reduce
+# ============================================
+
+class ChunkSummarizer:
+    """分段提炼要点: 缓存 + 并发限制 + 合并相同的进行中调用"""
+
+    def __init__(self, concurrency: int = SUMMARY_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.chunks = 0
+        self.cache_hits = 0
+        self.model_calls = 0
+
+    async def condense(
+        self,
+        database: Database,
+        agent: Agent,
+        kind: str,
+        text: str,
+        limit: int,
+        on_progress: ProgressCallback | None = None,
+    ) -> tuple[str, bool]:
+        """返回 (提供给模型的正文, 是否为分段要点); 不超过 limit 的正文原样返回"""
+        if len(text) <= limit:
+            return text, False
+        start = time.perf_counter()
+        stats = (self.chunks, self.cache_hits)
+        chunks = split_chunks(text)
+        if len(chunks) > SUMMARY_MAX_CHUNKS:
+            print(f"⚠️ [总结] 正文分为 {len(chunks)} 段, 只处理前 {SUMMARY_MAX_CHUNKS} 段")
+            chunks = chunks[:SUMMARY_MAX_CHUNKS]
+        notes = await self.map(database, agent, kind, chunks, on_progress)
+        # 要点合计仍然过长时分组再提炼一轮
+        while len(notes) > 1 and sum(len(note) for note in notes) > limit:
+            groups = split_chunks('\n\n'.join(notes))
+            if len(groups) >= len(notes):
+                break
+            notes = await self.map(database, agent, kind, groups)
+        print(
+            f"🧩 [总结] {len(text)} 字 -> {len(chunks)} 段, 缓存命中 {self.cache_hits - stats[1]}/"
+            f"{self.chunks - stats[0]}, 耗时 {(time.perf_counter() - start) * 1000:.0f}ms"
+        )
+        return '\n\n'.join(f'【第 {i} 部分】\n{note}' for i, note in enumerate(notes, 1)), True
+
+    async def map(
+        self,
+        database: Database,
+        agent: Agent,
+        kind: str,
+        chunks: list[str],
+        on_progress: ProgressCallback | None = None,
+    ) -> list[str]:
+        """并发提炼各分段, 按原顺序返回要点"""
+        model = getattr(agent.model, 'model_name', str(agent.model))
+        keys = [_chunk_key(kind, model, chunk) for chunk in chunks]
+        cached = await database.get_summary_chunks(list(set(keys)))
+        self.chunks += len(chunks)
+        self.cache_hits += sum(key in cached for key in keys)
+        total = len(chunks)
+        done = len(chunks) - sum(key not in cached for key in keys)
+        if on_progress is not None:
+            on_progress(done, total)
+
+        async def resolve(key: str, chunk: str) -> str:
+            nonlocal done
+            if key in cached:
+                return cached[key]
+            task = self._inflight.get(key)
+            if task is None:
+                task = self._inflight[key] = asyncio.create_task(self._summarize(database, agent, kind, key, chunk))
+                task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            # 请求取消时不取消提炼, 结果仍写入缓存供之后的请求使用
+            note = await asyncio.shield(task)
+            done += 1
+            if on_progress is not None:
+                on_progress(done, total)
+            return note
+
+        return list(await asyncio.gather(*(resolve(key, chunk) for key, chunk in zip(keys, chunks))))
+
+    @prioritized(Priority.BATCH)
+    async def _summarize(self, database: Database, agent: Agent, kind: str, key: str, chunk: str) -> str:
+        async with self._semaphore, upstream.slot():
+            self.model_calls += 1
+            result = await agent.run(MAP_PROMPTS[kind].format(chunk=chunk))
+        note = result.output.strip()
+        await database.save_summary_chunk(key, note, ttl=SUMMARY_CACHE_TTL)
+        return note
+
+    def as_dict(self) -> dict:
+        return {
+            'chunks': self.chunks,
+            'cache_hits': self.cache_hits,
+            'hit_rate': round(self.cache_hits / self.chunks, 3) if self.chunks else 0.0,
+            'model_calls': self.model_calls,
+            'in_flight': len(self._inflight),
+        }
+
+
+def _chunk_key(kind: str, model: str, chunk: str) -> str:
+    return hashlib.sha256(f'{PROMPT_VERSION}\0{kind}\0{model}\0{chunk}'.encode()).hexdigest()
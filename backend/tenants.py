@@ -0,0 +1,501 @@
+"""多租户 (托管多个站点的嵌入插件)
+
+同一个服务为多个站点提供嵌入插件时, 各站点 (租户) 使用独立的 API Key, 互相隔离:
+
+- 识别: 请求头 X-API-Key (WebSocket / EventSource 无法设置请求头, 使用查询参数 api_key) 对应的租户;
+  不带 Key 的请求属于默认租户 (本站)。租户配置了 allowed_origins 时, 只接受来自这些来源的请求
+- 会话空间: 会话记录所属租户 (sessions.tenant_id), 每个租户 (包括本站) 只能列出和访问自己的会话,
+  不带 Key 无法访问站点租户的会话
+- 接口范围: 站点租户只能使用对话、会话和只读接口 (TENANT_ROUTES), 导入导出、标签、配置修改、统计等只对本站开放;
+  不带 Key 的跨域请求 (其他站点的页面) 同样只能使用这些接口
+- 配额: 每个租户的请求速率 (令牌桶, 每分钟 rate_limit 个) 和同时进行的模型调用数 (max_concurrency),
+  超出时返回 429, 一个站点的突发流量不会占满模型调用。不带 Key 的跨域请求按来源分别使用站点租户的默认配额,
+  去掉 Key 不能绕过限制。多 worker 部署时每个进程分别计数
+- 用量: 请求数、拒绝数、错误数和 tokens 在内存中累计, 每 USAGE_FLUSH_INTERVAL 秒批量写入 tenant_usage
+- 管理接口: 须携带 ADMIN_API_KEY; 未设置时关闭 (ADMIN_ALLOW_LOOPBACK=true 时只接受本机不带 Key 的同源请求)
+- 租户的增删改通过 InvalidationBus 的 tenants 通道通知各 worker 重新加载
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import ipaddress
+import json
+import os
+import re
+import secrets
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlsplit
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from coordination import InvalidationBus
+from database import DEFAULT_TENANT_ID, Database
+from scheduling import Priority, prioritized
+
+# 站点租户未单独设置时的每分钟请求数上限 (0 表示不限制)
+TENANT_RATE_LIMIT = int(os.getenv('TENANT_RATE_LIMIT', '60'))
+
+# 站点租户未单独设置时同时进行的模型调用上限 (0 表示不限制)
+TENANT_MAX_CONCURRENCY = int(os.getenv('TENANT_MAX_CONCURRENCY', '4'))
+
+# 为 true 时, 不带 API Key 的跨域请求 (其他站点的页面) 返回 401; 否则视为本站请求 (只能使用 TENANT_ROUTES, 按来源限流)
+TENANT_KEY_REQUIRED = os.getenv('TENANT_KEY_REQUIRED', 'false').lower() == 'true'
+
+# 管理员 Key, 管理接口 (租户管理、会话导入导出等) 须携带 (X-API-Key); 未设置时管理接口关闭
+ADMIN_API_KEY = os.getenv('ADMIN_API_KEY', '')
+
+# 未设置 ADMIN_API_KEY 时, 是否允许本机 (回环地址) 不带 Key 的同源请求使用管理接口。
+# 仅用于直接访问服务的单机部署: 经由同机反向代理时所有请求的来源都是本机, 开启后等于对外开放管理接口
+ADMIN_ALLOW_LOOPBACK = os.getenv('ADMIN_ALLOW_LOOPBACK', 'false').lower() == 'true'
+
+# 用量写入数据库的间隔 (秒)
+USAGE_FLUSH_INTERVAL = float(os.getenv('TENANT_USAGE_FLUSH_INTERVAL', '10'))
+
+# 会话所属租户的缓存数量 (会话的租户不会改变)
+SESSION_OWNER_CACHE_SIZE = 4096
+
+# 令牌桶数量上限 (不带 Key 的跨域请求按来源分别计数), 超出时清理已回满的令牌桶
+QUOTA_BUCKET_LIMIT = 4096
+
+# 失效通知通道
+TENANTS_CHANNEL = 'tenants'
+
+# API Key 前缀, 便于识别
+API_KEY_PREFIX = 'pck_'
+
+# 站点租户可以使用的接口: (方法, 路径); 其余 /api 接口只对本站开放
+TENANT_ROUTES = [
+    (re.compile(r'GET|HEAD'), re.compile(r'/api/(health|ready|version|assets)')),
+    (re.compile(r'.*'), re.compile(r'/api/chat/.+')),
+    (re.compile(r'GET|POST'), re.compile(r'/api/sessions')),
+    (re.compile(r'GET'), re.compile(r'/api/sessions/events')),
+    (re.compile(r'PUT|DELETE'), re.compile(r'/api/sessions/[^/]+')),
+    (re.compile(r'POST'), re.compile(r'/api/web/(extract|summarize|to-json)')),
+    (re.compile(r'POST'), re.compile(r'/api/(image/analyze|draw)')),
+    (re.compile(r'GET'), re.compile(r'/api/config(/[^/]+)?')),
+    (re.compile(r'GET'), re.compile(r'/api/tenants/usage')),
+]
+
+
+def hash_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+def generate_key() -> str:
+    return API_KEY_PREFIX + secrets.token_urlsafe(24)
+
+
+@dataclass(frozen=True)
+class Tenant:
+    """租户配置 (运行时状态由 TenantRegistry 维护)"""
+
+    id: str
+    name: str
+    allowed_origins: frozenset[str] = frozenset()
+    # 每分钟请求数上限, 0 表示不限制
+    rate_limit: int = 0
+    # 同时进行的模型调用上限, 0 表示不限制
+    max_concurrency: int = 0
+    # 配额的计数键, 默认为租户 ID (不带 Key 的跨域请求按来源计数)
+    quota_key: str = ''
+
+    @property
+    def is_default(self) -> bool:
+        return self.id == DEFAULT_TENANT_ID
+
+    @property
+    def bucket(self) -> str:
+        return self.quota_key or self.id
+
+    def allows_origin(self, origin: str | None) -> bool:
+        return not self.allowed_origins or origin is None or origin in self.allowed_origins
+
+
+DEFAULT_TENANT = Tenant(DEFAULT_TENANT_ID, '本站')
+
+
+class QuotaExceeded(Exception):
+    """超出租户的请求速率或并发配额"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class TenantLease:
+    """一次已获准的模型调用, 结束时 release (可重复调用); 期间记录 tokens 和错误"""
+
+    registry: TenantRegistry
+    tenant_id: str
+    model: str
+    bucket: str
+    released: bool = False
+
+    def record_tokens(self, input_tokens: int | None, output_tokens: int | None):
+        self.registry.record(self.tenant_id, self.model, tokens_input=input_tokens or 0, tokens_output=output_tokens or 0)
+
+    def fail(self):
+        self.registry.record(self.tenant_id, self.model, errors=1)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.registry._release(self.bucket)
+
+
+@dataclass
+class _Bucket:
+    tokens: float
+    updated_at: float = field(default_factory=time.monotonic)
+
+
+class TenantRegistry:
+    """租户的内存缓存、配额和用量"""
+
+    db: Database
+    bus: InvalidationBus
+
+    def __init__(self):
+        self._by_id: dict[str, Tenant] = {DEFAULT_TENANT_ID: DEFAULT_TENANT}
+        self._by_key_hash: dict[str, Tenant] = {}
+        self._owners: OrderedDict[str, str] = OrderedDict()
+        self._buckets: dict[str, _Bucket] = {}
+        self._active: dict[str, int] = defaultdict(int)
+        # (租户, 日期, 模型) -> [请求数, 拒绝数, 错误数, 输入 tokens, 输出 tokens]
+        self._usage: dict[tuple[str, str, str], list[int]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._task: asyncio.Task | None = None
+
+    async def start(self, db: Database, bus: InvalidationBus):
+        self.db = db
+        self.bus = bus
+        bus.subscribe(TENANTS_CHANNEL, self._on_invalidated)
+        if not ADMIN_API_KEY:
+            if ADMIN_ALLOW_LOOPBACK:
+                print("⚠️  [租户] 未设置 ADMIN_API_KEY, 管理接口接受本机的同源请求 (经由同机反向代理部署时请关闭 ADMIN_ALLOW_LOOPBACK)")
+            else:
+                print("⚠️  [租户] 未设置 ADMIN_API_KEY, 管理接口 (租户管理、会话导入导出、批量删除) 已关闭")
+        await self.reload()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    # ============================================
+    # 识别
+    # ============================================
+
+    def resolve(self, api_key: str) -> Tenant | None:
+        """API Key 对应的租户, 无效时返回 None"""
+        return self._by_key_hash.get(hash_key(api_key))
+
+    def get(self, tenant_id: str) -> Tenant | None:
+        return self._by_id.get(tenant_id)
+
+    def anonymous(self, origin: str) -> Tenant:
+        """不带 Key 的跨域请求: 属于本站, 但按来源使用站点租户的默认配额"""
+        return Tenant(
+            DEFAULT_TENANT_ID, DEFAULT_TENANT.name,
+            rate_limit=TENANT_RATE_LIMIT, max_concurrency=TENANT_MAX_CONCURRENCY, quota_key=f'origin:{origin}'
+        )
+
+    async def owns(self, tenant: Tenant, session_id: str) -> bool:
+        """租户能否访问会话: 每个租户 (包括本站) 只能访问自己的会话 (会话不存在时为 False)"""
+        owner = self._owners.get(session_id)
+        if owner is None:
+            owner = await self.db.get_session_tenant(session_id)
+            if owner is None:
+                return False
+            self._owners[session_id] = owner
+            if len(self._owners) > SESSION_OWNER_CACHE_SIZE:
+                self._owners.popitem(last=False)
+        else:
+            self._owners.move_to_end(session_id)
+        return owner == tenant.id
+
+    # ============================================
+    # 配额
+    # ============================================
+
+    def admit(self, tenant: Tenant, model: str) -> TenantLease:
+        """检查速率和并发配额并占用一个并发名额; 超出时抛出 QuotaExceeded"""
+        if tenant.max_concurrency and self._active[tenant.bucket] >= tenant.max_concurrency:
+            self.record(tenant.id, model, rejected=1)
+            raise QuotaExceeded(f'同时进行的请求已达上限 ({tenant.max_concurrency})', 1)
+        if tenant.rate_limit:
+            rate = tenant.rate_limit / 60
+            now = time.monotonic()
+            bucket = self._buckets.get(tenant.bucket)
+            if bucket is None:
+                if len(self._buckets) >= QUOTA_BUCKET_LIMIT:
+                    self._prune_buckets(now)
+                bucket = self._buckets[tenant.bucket] = _Bucket(float(tenant.rate_limit), now)
+            bucket.tokens = min(float(tenant.rate_limit), bucket.tokens + (now - bucket.updated_at) * rate)
+            bucket.updated_at = now
+            if bucket.tokens < 1:
+                self.record(tenant.id, model, rejected=1)
+                raise QuotaExceeded(
+                    f'请求过于频繁 (每分钟 {tenant.rate_limit} 次)', max(1, round((1 - bucket.tokens) / rate))
+                )
+            bucket.tokens -= 1
+        self._active[tenant.bucket] += 1
+        self.record(tenant.id, model, requests=1)
+        return TenantLease(self, tenant.id, model, tenant.bucket)
+
+    def _release(self, bucket: str):
+        self._active[bucket] -= 1
+        if self._active[bucket] <= 0:
+            del self._active[bucket]
+
+    def _prune_buckets(self, now: float):
+        # 超过一分钟未使用的令牌桶已回满, 删除后重新创建的效果相同
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket.updated_at < 60}
+
+    # ============================================
+    # 用量
+    # ============================================
+
+    def record(
+        self,
+        tenant_id: str,
+        model: str,
+        requests: int = 0,
+        rejected: int = 0,
+        errors: int = 0,
+        tokens_input: int = 0,
+        tokens_output: int = 0
+    ):
+        date = datetime.now(tz=timezone.utc).strftime('%Y-%m-%d')
+        counters = self._usage.setdefault((tenant_id, date, model), [0, 0, 0, 0, 0])
+        counters[0] += requests
+        counters[1] += rejected
+        counters[2] += errors
+        counters[3] += tokens_input
+        counters[4] += tokens_output
+
+    async def flush(self):
+        """把内存中累计的用量写入数据库"""
+        if not self._usage:
+            return
+        usage, self._usage = self._usage, {}
+        try:
+            await self.db.add_tenant_usage([(*key, *counters) for key, counters in usage.items()])
+        except Exception:
+            # 写入失败时放回, 下次再写
+            for key, counters in usage.items():
+                merged = self._usage.setdefault(key, [0, 0, 0, 0, 0])
+                for i, value in enumerate(counters):
+                    merged[i] += value
+            raise
+
+    @prioritized(Priority.BATCH)
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'❌ [租户] 写入用量失败: {e}')
+
+    # ============================================
+    # 管理
+    # ============================================
+
+    async def create(
+        self,
+        tenant_id: str,
+        name: str,
+        allowed_origins: list[str],
+        rate_limit: int | None = None,
+        max_concurrency: int | None = None
+    ) -> str | None:
+        """创建租户, 返回 API Key (只在此时可见); ID 已存在时返回 None"""
+        if tenant_id == DEFAULT_TENANT_ID:
+            return None
+        api_key = generate_key()
+        if not await self.db.create_tenant(
+            tenant_id, name, hash_key(api_key), allowed_origins, rate_limit, max_concurrency
+        ):
+            return None
+        await self._changed(tenant_id)
+        return api_key
+
+    async def update(
+        self,
+        tenant_id: str,
+        name: str | None = None,
+        allowed_origins: list[str] | None = None,
+        rate_limit: int | None = None,
+        max_concurrency: int | None = None,
+        rotate_key: bool = False
+    ) -> tuple[bool, str | None]:
+        """修改租户, 返回 (是否存在, 新的 API Key); rotate_key 时原 Key 立即失效"""
+        api_key = generate_key() if rotate_key else None
+        found = await self.db.update_tenant(
+            tenant_id, name, hash_key(api_key) if api_key else None, allowed_origins, rate_limit, max_concurrency
+        )
+        if found:
+            await self._changed(tenant_id)
+        return found, api_key if found else None
+
+    async def delete(self, tenant_id: str) -> int | None:
+        """删除租户及其会话, 返回删除的会话数; 租户不存在时返回 None"""
+        deleted = await self.db.delete_tenant(tenant_id)
+        if deleted is not None:
+            await self._changed(tenant_id)
+        return deleted
+
+    def describe(self) -> list[dict]:
+        """全部站点租户及当前进程中的运行状态"""
+        return [
+            {
+                'id': tenant.id,
+                'name': tenant.name,
+                'allowed_origins': sorted(tenant.allowed_origins),
+                'rate_limit': tenant.rate_limit,
+                'max_concurrency': tenant.max_concurrency,
+                'active': self._active.get(tenant.id, 0),
+            }
+            for tenant in self._by_id.values() if not tenant.is_default
+        ]
+
+    async def reload(self):
+        rows = await self.db.get_tenants()
+        by_id: dict[str, Tenant] = {DEFAULT_TENANT_ID: DEFAULT_TENANT}
+        by_key_hash: dict[str, Tenant] = {}
+        for row in rows:
+            tenant = Tenant(
+                row['id'],
+                row['name'],
+                frozenset(row['allowed_origins']),
+                TENANT_RATE_LIMIT if row['rate_limit'] is None else row['rate_limit'],
+                TENANT_MAX_CONCURRENCY if row['max_concurrency'] is None else row['max_concurrency'],
+            )
+            by_id[tenant.id] = tenant
+            by_key_hash[row['key_hash']] = tenant
+        self._by_id, self._by_key_hash = by_id, by_key_hash
+        # 已删除的租户不再保留令牌桶
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items() if key in by_id or key.startswith('origin:')
+        }
+
+    async def _changed(self, tenant_id: str):
+        await self.reload()
+        await self.bus.publish(TENANTS_CHANNEL, tenant_id)
+
+    def _on_invalidated(self, _key: str | None):
+        task = asyncio.create_task(self._reload_quietly())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reload_quietly(self):
+        try:
+            await self.reload()
+        except Exception as e:
+            print(f'❌ [租户] 重新加载租户失败: {e}')
+
+
+# ============================================
+# 中间件: 识别租户并限制接口范围
+# ============================================
+
+class TenantMiddleware:
+    """识别请求所属的租户 (写入 request.state.tenant), 拒绝无效的 Key、不允许的来源和超出范围的接口
+
+    纯 ASGI 实现, 不影响流式响应; 只处理 /api 下的 HTTP 和 WebSocket 请求
+    """
+
+    def __init__(self, app: ASGIApp, registry: TenantRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] not in ('http', 'websocket') or not scope['path'].startswith('/api/'):
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        api_key = headers.get('x-api-key')
+        if api_key is None:
+            api_key = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('api_key', [None])[0]
+        origin = headers.get('origin')
+        if ADMIN_API_KEY:
+            is_admin = api_key is not None and secrets.compare_digest(api_key, ADMIN_API_KEY)
+        else:
+            # 未设置管理员 Key 时默认关闭; 显式开启后只信任本机的同源请求 (跨域页面可能借用浏览器向本机发请求)
+            is_admin = (
+                ADMIN_ALLOW_LOOPBACK and api_key is None and _is_loopback(scope.get('client'))
+                and not _is_cross_origin(origin, headers.get('host'))
+            )
+        if is_admin:
+            tenant = DEFAULT_TENANT
+        elif api_key is None:
+            tenant = DEFAULT_TENANT
+            if _is_cross_origin(origin, headers.get('host')):
+                # 其他站点的页面: 只能使用站点接口, 按来源限流
+                if TENANT_KEY_REQUIRED:
+                    await _reject(scope, send, 401, '缺少 API Key')
+                    return
+                if not _tenant_route(scope.get('method', 'GET'), scope['path']):
+                    await _reject(scope, send, 403, '该接口不对其他站点开放')
+                    return
+                tenant = self.registry.anonymous(origin)
+        else:
+            tenant = self.registry.resolve(api_key)
+            if tenant is None:
+                await _reject(scope, send, 401, 'API Key 无效')
+                return
+            if not tenant.allows_origin(origin):
+                await _reject(scope, send, 403, '该站点未被允许使用此 API Key')
+                return
+            if not _tenant_route(scope.get('method', 'GET'), scope['path']):
+                await _reject(scope, send, 403, '该接口不对站点开放')
+                return
+        state = scope.setdefault('state', {})
+        state['tenant'] = tenant
+        state['tenant_admin'] = is_admin
+        await self.app(scope, receive, send)
+
+
+def _tenant_route(method: str, path: str) -> bool:
+    return any(methods.fullmatch(method) and paths.fullmatch(path) for methods, paths in TENANT_ROUTES)
+
+
+def _is_loopback(client: tuple[str, int] | None) -> bool:
+    if client is None:
+        return False
+    try:
+        return ipaddress.ip_address(client[0]).is_loopback
+    except ValueError:
+        return False
+
+
+def _is_cross_origin(origin: str | None, host: str | None) -> bool:
+    return origin is not None and urlsplit(origin).netloc != host
+
+
+async def _reject(scope: Scope, send: Send, status_code: int, detail: str):
+    if scope['type'] == 'websocket':
+        # 握手前关闭, 客户端收到 403
+        await send({'type': 'websocket.close', 'code': 1008, 'reason': detail})
+        return
+    body = json.dumps({'detail': detail}, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
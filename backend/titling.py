@@ -0,0 +1,208 @@
+"""会话自动标题
+
+会话的第一轮对话保存后, 由后台任务用轻量模型 (agents.TITLE_MODEL, 不带工具) 生成简短标题,
+对话接口只把会话放入队列, 不增加任何延迟:
+
+- 批量: 收集 TITLE_BATCH_WINDOW 秒内完成首轮的会话, 每批最多 TITLE_BATCH_SIZE 个, 一次模型调用生成全部标题
+- 遵循 user_config 中的 auto_title 配置 (为 false 时不生成, 由调用方通过 enabled 从配置快照读取)
+- 入队时 (后台) 记下会话当前的标题, 只在标题未变化时替换, 用户在此之后手动改名不会被覆盖
+- 以后台优先级 (scheduling.Priority.BATCH) 读写数据库和调用模型, 不占用对话的名额
+- 标题更新后通过 InvalidationBus 的 session_title 通道通知各 worker,
+  再推送给本进程的订阅者 (WebSocket 连接、GET /api/sessions/events)
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import time
+from collections.abc import Callable
+from typing import TYPE_CHECKING
+
+from coordination import InvalidationBus
+from database import Database
+from scheduling import Priority, prioritized, upstream
+
+if TYPE_CHECKING:
+    from pydantic_ai import Agent
+
+# 收集同批会话的等待时间 (秒)
+TITLE_BATCH_WINDOW = float(os.getenv('TITLE_BATCH_WINDOW', '2'))
+
+# 每次模型调用生成的标题数上限
+TITLE_BATCH_SIZE = int(os.getenv('TITLE_BATCH_SIZE', '8'))
+
+# 标题最大字符数
+TITLE_MAX_CHARS = 20
+
+# 提示词中每条消息保留的字符数
+EXCERPT_CHARS = 300
+
+# 失效通知通道, 键为会话 ID
+TITLE_CHANNEL = 'session_title'
+
+TITLE_PROMPT = """请为下面每段对话生成一个简短的标题 (不超过 {max_chars} 个字, 概括用户的意图, 不要标点和引号)。
+每行输出一个标题, 格式为 "编号. 标题", 不要输出其他内容。
+
+{conversations}"""
+
+# 事件监听器: 参数为推送给客户端的事件 ({'type': 'session_updated', 'session_id', 'title', 'tenant_id'})
+Listener = Callable[[dict], None]
+
+_NUMBERED = re.compile(r'^\s*(\d+)\s*[.、:：)）]\s*(.+?)\s*$')
+_STRIP = '"\'“”‘’「」《》【】#*`。.,，!！?？ '
+
+
+class SessionTitler:
+    """后台批量生成会话标题"""
+
+    db: Database
+    bus: InvalidationBus
+
+    def __init__(
+        self,
+        agent_factory: Callable[[], Agent],
+        enabled: Callable[[], bool] = lambda: True,
+        window: float = TITLE_BATCH_WINDOW,
+        batch_size: int = TITLE_BATCH_SIZE
+    ):
+        self.agent_factory = agent_factory
+        self.enabled = enabled
+        self.window = window
+        self.batch_size = batch_size
+        self.titled = 0
+        self.model_calls = 0
+        # 会话 ID -> (用户消息, 回答, 入队时的标题)
+        self._pending: dict[str, tuple[str, str, str]] = {}
+        self._listeners: set[Listener] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self, db: Database, bus: InvalidationBus):
+        if self._task is None:
+            self.db = db
+            self.bus = bus
+            self.bus.subscribe(TITLE_CHANNEL, self._on_title_changed)
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._tasks):
+            task.cancel()
+
+    def enqueue(self, session_id: str, message: str, response: str):
+        """第一轮对话保存后调用 (只入队, 不等待); 未启动时忽略"""
+        if self._task is None or not self.enabled():
+            return
+        self._spawn(self._add(session_id, message[:EXCERPT_CHARS], response[:EXCERPT_CHARS]))
+
+    @prioritized(Priority.BATCH)
+    async def _add(self, session_id: str, message: str, response: str):
+        titles = await self.db.get_session_titles([session_id])
+        if session_id in titles:
+            self._pending[session_id] = (message, response, titles[session_id])
+            self._wake.set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def listen(self, listener: Listener) -> Callable[[], None]:
+        """订阅标题更新事件, 返回取消订阅的函数"""
+        self._listeners.add(listener)
+        return lambda: self._listeners.discard(listener)
+
+    @prioritized(Priority.BATCH)
+    async def _loop(self):
+        while True:
+            await self._wake.wait()
+            # 等待同一时间段内完成首轮的其他会话, 合并为一次调用
+            await asyncio.sleep(self.window)
+            self._wake.clear()
+            while self._pending:
+                batch = dict(list(self._pending.items())[:self.batch_size])
+                for session_id in batch:
+                    del self._pending[session_id]
+                try:
+                    await self._title_batch(batch)
+                except Exception as e:
+                    print(f'❌ [标题] 生成会话标题失败: {e}')
+
+    async def _title_batch(self, batch: dict[str, tuple[str, str, str]]):
+        if not self.enabled():
+            return
+        session_ids = list(batch)
+        start = time.perf_counter()
+        conversations = '\n\n'.join(
+            f'{i}. 用户: {batch[session_id][0]}\n   助手: {batch[session_id][1]}'
+            for i, session_id in enumerate(session_ids, 1)
+        )
+        async with upstream.slot():
+            self.model_calls += 1
+            result = await self.agent_factory().run(
+                TITLE_PROMPT.format(max_chars=TITLE_MAX_CHARS, conversations=conversations)
+            )
+        titles = _parse_titles(result.output, len(session_ids))
+        updated = 0
+        for i, session_id in enumerate(session_ids, 1):
+            title, expected = titles.get(i), batch[session_id][2]
+            if not title or title == expected:
+                continue
+            # 标题已被用户修改 (或会话已删除) 时不更新
+            if await self.db.update_session(session_id, title, expected_title=expected):
+                updated += 1
+                await self.bus.publish(TITLE_CHANNEL, session_id)
+        self.titled += updated
+        print(f'🏷️ [标题] 生成 {updated}/{len(session_ids)} 个会话标题 ({(time.perf_counter() - start) * 1000:.0f}ms)')
+
+    def _on_title_changed(self, session_id: str | None):
+        # 通知只携带会话 ID (可能来自其他 worker), 读取最新标题后推送
+        if session_id is None or not self._listeners:
+            return
+        self._spawn(self._announce(session_id))
+
+    async def _announce(self, session_id: str):
+        titles = await self.db.get_session_titles([session_id])
+        if session_id not in titles:
+            return
+        # 订阅者按租户过滤, 站点只收到自己会话的事件
+        tenant_id = await self.db.get_session_tenant(session_id)
+        event = {'type': 'session_updated', 'session_id': session_id, 'title': titles[session_id], 'tenant_id': tenant_id}
+        for listener in list(self._listeners):
+            try:
+                listener(event)
+            except Exception as e:
+                print(f'❌ [标题] 推送标题更新失败: {e}')
+
+    def as_dict(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'titled': self.titled,
+            'model_calls': self.model_calls,
+            'listeners': len(self._listeners),
+        }
+
+
+def _parse_titles(output: str, count: int) -> dict[int, str]:
+    """解析 "编号. 标题" 格式的输出; 只有一个会话时整段输出即为标题"""
+    titles: dict[int, str] = {}
+    for line in output.splitlines():
+        match = _NUMBERED.match(line)
+        if match and 1 <= int(match.group(1)) <= count:
+            titles[int(match.group(1))] = _clean_title(match.group(2))
+    if not titles and count == 1:
+        titles[1] = _clean_title(output.strip().splitlines()[0] if output.strip() else '')
+    return {i: title for i, title in titles.items() if title}
+
+
+def _clean_title(title: str) -> str:
+    return title.strip().strip(_STRIP)[:TITLE_MAX_CHARS].strip()
@@ -0,0 +1,121 @@
+/**
+ * PopupChatKit 加载器
+ *
+ * 只渲染悬浮按钮, 完整插件 (popup.js) 在鼠标悬停或获得焦点时预加载, 首次点击时初始化并打开。
+ * 有保存的会话时, 在页面空闲或悬停时预取会话 (GET /api/chat/warm/{session_id}): 服务端返回最近的消息,
+ * 并在后台读取会话的 AI 上下文, 打开窗口时历史已就绪, 第一次对话也不必等待读取。
+ * 用法与 popup.js 相同:
+ *
+ *     <script src="http://localhost:8000/embedded/loader.js"></script>
+ *     <script>PopupChatKit.init({ apiBase: 'http://localhost:8000/api' });</script>
+ *
+ * 下方的文件名占位符由服务端替换为带内容哈希的 popup.js 文件名。
+ */
+(function(window, document) {
+    'use strict';
+
+    if (window.PopupChatKit) return;
+
+    const script = document.currentScript;
+    const src = (script ? script.src.replace(/[^/]*$/, '') : '') + '__POPUP_FILE__';
+    const offsets = {
+        'bottom-right': 'bottom:24px;right:24px',
+        'bottom-left': 'bottom:24px;left:24px',
+        'top-right': 'top:24px;right:24px',
+        'top-left': 'top:24px;left:24px'
+    };
+
+    let options = {};
+    let button = null;
+    let loading = null;
+    let prefetched = null;
+
+    function prefetch() {
+        if (prefetched) return;
+        const apiBase = options.apiBase || 'http://localhost:8000/api';
+        let sessionId = null;
+        try {
+            sessionId = window.localStorage.getItem('PopupChatKit:session:' + apiBase);
+        } catch (error) {
+            // 浏览器禁用存储
+        }
+        if (!sessionId) return;
+        const headers = options.apiKey ? { 'X-API-Key': options.apiKey } : {};
+        prefetched = fetch(apiBase + '/chat/warm/' + encodeURIComponent(sessionId) + '?limit=' + (options.historyLimit || 30), {
+            headers: headers
+        }).then(function(response) {
+            return response.ok ? response.json() : null;
+        }).catch(function() {
+            return null;
+        });
+    }
+
+    function preload() {
+        prefetch();
+        return load();
+    }
+
+    function load() {
+        if (!loading) {
+            loading = new Promise(function(resolve, reject) {
+                const tag = document.createElement('script');
+                tag.src = src;
+                tag.async = true;
+                tag.onload = resolve;
+                tag.onerror = function() {
+                    loading = null;
+                    reject(new Error('PopupChatKit 加载失败'));
+                };
+                document.head.appendChild(tag);
+            });
+        }
+        return loading;
+    }
+
+    function activate(open) {
+        prefetch();
+        return load().then(function() {
+            // 完整插件加载后会替换 window.PopupChatKit, 并创建自己的按钮
+            if (button) {
+                button.remove();
+                button = null;
+            }
+            window.PopupChatKit.init(Object.assign({}, options, { prefetched: prefetched }));
+            if (open) window.PopupChatKit.open();
+        });
+    }
+
+    window.PopupChatKit = {
+        init: function(opts) {
+            options = opts || {};
+            const size = options.buttonSize || 60;
+            button = document.createElement('button');
+            button.setAttribute('aria-label', '打开聊天');
+            button.style.cssText = 'position:fixed;' + (offsets[options.position] || offsets['bottom-right']) +
+                ';width:' + size + 'px;height:' + size + 'px;border-radius:50%;border:none;cursor:pointer;color:#fff' +
+                ';background:' + (options.buttonColor || '#6366f1') +
+                ';box-shadow:0 4px 12px rgba(0,0,0,.15);display:flex;align-items:center;justify-content:center' +
+                ';z-index:' + (options.zIndex || 9999);
+            button.innerHTML = '<svg viewBox="0 0 24 24" width="28" height="28" fill="none" stroke="currentColor" stroke-width="2">' +
+                '<path d="M21 15a2 2 0 0 1-2 2H7l-4 4V5a2 2 0 0 1 2-2h14a2 2 0 0 1 2 2z"></path></svg>';
+            button.addEventListener('mouseenter', preload, { once: true });
+            button.addEventListener('focus', preload, { once: true });
+            button.addEventListener('click', function() {
+                activate(true).catch(function(error) {
+                    console.error(error);
+                });
+            });
+            document.body.appendChild(button);
+            // 页面空闲时预取会话
+            (window.requestIdleCallback || function(callback) { setTimeout(callback, 1000); })(prefetch);
+        },
+
+        /**
+         * 立即加载完整插件 (不打开窗口)
+         */
+        load: function() {
+            return activate(false);
+        }
+    };
+
+})(window, document);
@@ -3,6 +3,8 @@
  * 使用方法:
  * <script src="popup.js"></script>
  * <script>PopupChatKit.init({ apiBase: 'http://localhost:8000/api' });</script>
+ * 托管在其他站点时传入该站点的 API Key: PopupChatKit.init({ apiBase: '...', apiKey: 'pck_...' })
+ * 会话 ID 保存在 localStorage 中, 刷新页面后继续之前的对话
  */
 
 (function(window) {
@@ -16,7 +18,11 @@
             buttonColor: '#6366f1',
             maxWidth: 400,
             maxHeight: 600,
-            zIndex: 9999
+            zIndex: 9999,
+            transport: 'ndjson', // 流式传输方式: ndjson, sse, websocket
+            apiKey: null, // 站点的 API Key (托管的嵌入站点), 本站使用时不需要
+            historyLimit: 30, // 恢复会话时显示的最近消息数
+            prefetched: null // 加载器预取的会话历史 (Promise), 由 loader.js 传入
         },
 
         isOpen: false,
@@ -26,6 +32,10 @@
         button: null,
         chatWindow: null,
         selectedText: '',  // 存储选中的文本
+        currentStream: null,  // 进行中的流式回答 { sessionId, controller }
+        messageObserver: null,  // 长对话虚拟化
+        socket: null,  // WebSocket 连接 (transport 为 websocket 时复用)
+        socketHandlers: {},  // request_id -> 帧处理函数
 
         /**
          * 初始化插件
@@ -43,8 +53,9 @@
             // 创建聊天窗口
             this.createChatWindow();
             
-            // 自动创建会话（保存 Promise）
-            this.sessionPromise = this.createSession();
+            // 恢复上次的会话, 没有时自动创建（保存 Promise）
+            const savedSessionId = this.loadSessionId();
+            this.sessionPromise = savedSessionId ? this.restoreSession(savedSessionId) : this.createSession();
             
             // 监听文本选中事件
             this.initTextSelection();
@@ -158,6 +169,24 @@
                     word-wrap: break-word;
                 }
 
+                .popup-chat-message-content pre {
+                    margin: 6px 0;
+                    padding: 8px 10px;
+                    background: #f3f4f6;
+                    border-radius: 6px;
+                    overflow-x: auto;
+                }
+
+                .popup-chat-message-content code {
+                    font-family: Menlo, Consolas, monospace;
+                    font-size: 0.9em;
+                }
+
+                /* 流式渲染的段落容器, 不参与布局 */
+                .popup-chat-md-block {
+                    display: contents;
+                }
+
                 .popup-chat-message.user .popup-chat-message-content {
                     background: #6366f1;
                     color: white;
@@ -365,6 +394,17 @@
             this.isOpen = false;
         },
 
+        /**
+         * 请求头: 附带站点的 API Key
+         */
+        headers: function(extra) {
+            const headers = { ...extra };
+            if (this.config.apiKey) {
+                headers['X-API-Key'] = this.config.apiKey;
+            }
+            return headers;
+        },
+
         /**
          * 创建会话
          */
@@ -372,9 +412,9 @@
             try {
                 const response = await fetch(`${this.config.apiBase}/sessions`, {
                     method: 'POST',
-                    headers: {
+                    headers: this.headers({
                         'Content-Type': 'application/json'
-                    },
+                    }),
                     body: JSON.stringify({
                         title: '嵌入式对话',
                         mode: 'embedded'
@@ -383,6 +423,7 @@
                 
                 const data = await response.json();
                 this.currentSessionId = data.session_id;
+                this.saveSessionId(data.session_id);
                 console.log('会话创建成功:', this.currentSessionId);
                 return this.currentSessionId;
             } catch (error) {
@@ -391,6 +432,54 @@
             }
         },
 
+        /**
+         * 恢复保存的会话: 显示最近的消息 (优先使用加载器预取的结果), 会话已不存在时创建新会话
+         * 服务端同时在后台读取会话的 AI 上下文, 打开窗口后的第一次对话不必再等待读取
+         */
+        restoreSession: async function(sessionId) {
+            let data = null;
+            try {
+                data = this.config.prefetched ? await this.config.prefetched : null;
+                if (!data || data.session_id !== sessionId) {
+                    const response = await fetch(
+                        `${this.config.apiBase}/chat/warm/${sessionId}?limit=${this.config.historyLimit}`,
+                        { headers: this.headers() }
+                    );
+                    data = response.ok ? await response.json() : null;
+                }
+            } catch (error) {
+                console.error('恢复会话失败:', error);
+            }
+            if (!data) {
+                return this.createSession();
+            }
+            this.currentSessionId = sessionId;
+            for (const [role, content] of data.messages) {
+                this.addMessage(role, content);
+            }
+            console.log('会话已恢复:', sessionId);
+            return sessionId;
+        },
+
+        /**
+         * 保存的会话 ID (按 API 地址区分; 浏览器禁用存储时不保存)
+         */
+        loadSessionId: function() {
+            try {
+                return window.localStorage.getItem(`PopupChatKit:session:${this.config.apiBase}`);
+            } catch (error) {
+                return null;
+            }
+        },
+
+        saveSessionId: function(sessionId) {
+            try {
+                window.localStorage.setItem(`PopupChatKit:session:${this.config.apiBase}`, sessionId);
+            } catch (error) {
+                // 忽略
+            }
+        },
+
         /**
          * 确保会话已创建
          */
@@ -411,13 +500,137 @@
             const messagesContainer = document.getElementById('popupChatMessages');
             const messageDiv = document.createElement('div');
             messageDiv.className = `popup-chat-message ${role}`;
+            const html = role === 'assistant' ? this.formatContent(content) : this.escapeHtml(content);
             messageDiv.innerHTML = `
-                <div class="popup-chat-message-content">${this.escapeHtml(content)}</div>
+                <div class="popup-chat-message-content">${html}</div>
             `;
             messagesContainer.appendChild(messageDiv);
+            this.observeMessage(messageDiv);
             messagesContainer.scrollTop = messagesContainer.scrollHeight;
         },
 
+        /**
+         * 格式化回答内容 (简单的 Markdown 支持: 代码块、行内代码、粗体、换行)
+         */
+        formatContent: function(text) {
+            if (!text) return '';
+            let html = this.escapeHtml(text);
+            html = html.replace(/```(\w+)?\n([\s\S]*?)```/g, (match, lang, code) => `<pre><code>${code.trim()}</code></pre>`);
+            html = html.replace(/`([^`]+)`/g, '<code>$1</code>');
+            html = html.replace(/\*\*([^*]+)\*\*/g, '<strong>$1</strong>');
+            return html.replace(/\n/g, '<br>');
+        },
+
+        /**
+         * 流式消息渲染器
+         * content 帧携带截至当前的完整文本: 已完成的段落 (代码块之外的空行之前的文本) 只解析一次并追加,
+         * 每帧只重新解析末尾未完成的段落; 同一动画帧内的多个帧只绘制最后一个
+         */
+        createStreamRenderer: function(element, scroller) {
+            const doneBlock = document.createElement('div');
+            const tailBlock = document.createElement('div');
+            doneBlock.className = 'popup-chat-md-block';
+            tailBlock.className = 'popup-chat-md-block';
+            element.replaceChildren(doneBlock, tailBlock);
+
+            let text = '';
+            let committed = 0;    // 已追加到 doneBlock 的文本长度
+            let scanned = 0;      // 段落边界已查找到的位置
+            let inFence = false;  // scanned 处是否在代码块内
+            let pending = null;
+            let frame = 0;
+
+            const render = (content) => {
+                // 文本不再以已渲染部分开头时从头渲染
+                if (content.length < committed || !content.startsWith(text.slice(0, committed))) {
+                    doneBlock.replaceChildren();
+                    committed = 0;
+                    scanned = 0;
+                    inFence = false;
+                }
+                text = content;
+
+                let boundary = committed;
+                let i = scanned;
+                while (true) {
+                    const fence = text.indexOf('```', i);
+                    const blank = inFence ? -1 : text.indexOf('\n\n', i);
+                    if (blank !== -1 && (fence === -1 || blank < fence)) {
+                        boundary = blank + 2;
+                        i = boundary;
+                    } else if (fence !== -1) {
+                        inFence = !inFence;
+                        i = fence + 3;
+                    } else {
+                        break;
+                    }
+                }
+                scanned = i;
+
+                if (boundary > committed) {
+                    doneBlock.insertAdjacentHTML('beforeend', this.formatContent(text.slice(committed, boundary)));
+                    committed = boundary;
+                }
+                tailBlock.innerHTML = this.formatContent(text.slice(committed));
+            };
+
+            const flush = () => {
+                frame = 0;
+                if (pending === null) return;
+                // 用户向上翻看时不强制滚动到底部
+                const atBottom = scroller.scrollHeight - scroller.scrollTop - scroller.clientHeight < 40;
+                render(pending);
+                pending = null;
+                if (atBottom) {
+                    scroller.scrollTop = scroller.scrollHeight;
+                }
+            };
+
+            return {
+                update: (content) => {
+                    pending = content;
+                    if (!frame) {
+                        frame = requestAnimationFrame(flush);
+                    }
+                },
+                finish: () => {
+                    if (frame) {
+                        cancelAnimationFrame(frame);
+                    }
+                    flush();
+                }
+            };
+        },
+
+        /**
+         * 长对话虚拟化: 远离可视区域的消息只保留固定高度的空元素, 滚动回附近时再恢复其内容
+         */
+        observeMessage: function(messageDiv) {
+            if (!('IntersectionObserver' in window)) return;
+            if (!this.messageObserver) {
+                this.messageObserver = new IntersectionObserver((entries) => {
+                    entries.forEach(entry => {
+                        const target = entry.target;
+                        if (entry.isIntersecting) {
+                            if (target.detachedNodes) {
+                                target.replaceChildren(...target.detachedNodes);
+                                target.detachedNodes = null;
+                                target.style.height = '';
+                            }
+                        } else if (!target.detachedNodes && target.isConnected && entry.boundingClientRect.height > 0) {
+                            target.style.height = `${entry.boundingClientRect.height}px`;
+                            target.detachedNodes = Array.from(target.childNodes);
+                            target.replaceChildren();
+                        }
+                    });
+                }, {
+                    root: document.getElementById('popupChatMessages'),
+                    rootMargin: '1000px 0px'
+                });
+            }
+            this.messageObserver.observe(messageDiv);
+        },
+
         /**
          * 显示加载状态
          */
@@ -662,6 +875,12 @@
          * 发送消息
          */
         sendMessage: async function() {
+            // 回答生成中时, 发送按钮作为停止按钮
+            if (this.currentStream) {
+                await this.stopGeneration();
+                return;
+            }
+            
             const input = document.getElementById('popupChatInput');
             const message = input.value.trim();
             
@@ -765,68 +984,278 @@ ${pageContent.content}
 用户问题：${message}`;
                 }
                 
-                // 调用流式API
-                const response = await fetch(`${this.config.apiBase}/chat/stream`, {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        session_id: this.currentSessionId,
-                        message: finalMessage,
-                        stream: true
-                    })
-                });
+                // 调用流式API (生成过程中发送按钮切换为停止)
+                this.currentStream = { sessionId: this.currentSessionId, controller: new AbortController() };
+                sendBtn.disabled = false;
+                sendBtn.textContent = '停止';
                 
-                this.removeLoading();
+                const messagesContainer = document.getElementById('popupChatMessages');
+                let renderer = null;
                 
-                if (!response.ok) {
-                    throw new Error('请求失败');
+                // 读取流式响应 (连接中断时自动续传)
+                await this.streamChat({
+                    session_id: this.currentSessionId,
+                    message: finalMessage,
+                    stream: true
+                }, (data) => {
+                    if (!renderer) {
+                        // 收到首帧后创建AI消息容器
+                        this.removeLoading();
+                        const aiMessageDiv = document.createElement('div');
+                        aiMessageDiv.className = 'popup-chat-message assistant';
+                        aiMessageDiv.innerHTML = '<div class="popup-chat-message-content"></div>';
+                        messagesContainer.appendChild(aiMessageDiv);
+                        this.observeMessage(aiMessageDiv);
+                        renderer = this.createStreamRenderer(
+                            aiMessageDiv.querySelector('.popup-chat-message-content'), messagesContainer
+                        );
+                    }
+                    if (data.type === 'content') {
+                        renderer.update(data.content);
+                    }
+                }, this.currentStream.controller.signal);
+                if (renderer) {
+                    renderer.finish();
                 }
                 
-                // 创建AI消息容器
-                const messagesContainer = document.getElementById('popupChatMessages');
-                const aiMessageDiv = document.createElement('div');
-                aiMessageDiv.className = 'popup-chat-message assistant';
-                aiMessageDiv.innerHTML = '<div class="popup-chat-message-content"></div>';
-                messagesContainer.appendChild(aiMessageDiv);
-                
-                const contentDiv = aiMessageDiv.querySelector('.popup-chat-message-content');
+            } catch (error) {
+                this.removeLoading();
+                if (error.name !== 'AbortError') {
+                    console.error('发送消息失败:', error);
+                    this.addMessage('assistant', '抱歉,出现了错误,请稍后重试。');
+                }
+            } finally {
+                this.currentStream = null;
+                sendBtn.disabled = false;
+                sendBtn.textContent = '发送';
+            }
+        },
+
+        /**
+         * 逐行读取 NDJSON 响应
+         */
+        readNdjson: async function(response, onFrame) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
                 
-                // 读取流式响应
-                const reader = response.body.getReader();
-                const decoder = new TextDecoder();
-                let buffer = '';
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
                 
-                while (true) {
-                    const { done, value } = await reader.read();
-                    if (done) break;
-                    
-                    buffer += decoder.decode(value, { stream: true });
-                    const lines = buffer.split('\n');
-                    buffer = lines.pop();
-                    
-                    for (const line of lines) {
-                        if (line.trim()) {
-                            try {
-                                const data = JSON.parse(line);
-                                if (data.type === 'content') {
-                                    contentDiv.textContent = data.content;
-                                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
-                                }
-                            } catch (e) {
-                                console.error('解析失败:', e);
-                            }
+                for (const line of lines) {
+                    if (line.trim()) {
+                        try {
+                            onFrame(JSON.parse(line));
+                        } catch (e) {
+                            console.error('解析失败:', e);
                         }
                     }
                 }
+            }
+        },
+
+        /**
+         * 按配置的传输方式发起流式对话
+         */
+        streamChat: async function(body, onFrame, signal) {
+            if (this.config.transport === 'websocket') {
+                return this.streamChatWs(body, onFrame, signal);
+            }
+            const path = this.config.transport === 'sse' ? 'chat/sse' : 'chat/stream';
+            const response = await fetch(`${this.config.apiBase}/${path}`, {
+                method: 'POST',
+                headers: this.headers({
+                    'Content-Type': 'application/json'
+                }),
+                signal,
+                body: JSON.stringify(body)
+            });
+            if (!response.ok) {
+                throw new Error('请求失败');
+            }
+            await this.consumeStream(response, onFrame, signal);
+        },
+
+        /**
+         * 读取 SSE 响应 (POST 请求无法使用 EventSource, 这里手动解析 data 行)
+         */
+        readSse: async function(response, onFrame) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                
+                buffer += decoder.decode(value, { stream: true });
+                const events = buffer.split('\n\n');
+                buffer = events.pop();
                 
+                for (const event of events) {
+                    // 以冒号开头的是保活注释, 忽略
+                    const data = event.split('\n')
+                        .filter(line => line.startsWith('data:'))
+                        .map(line => line.slice(5).trim())
+                        .join('\n');
+                    if (data) {
+                        try {
+                            onFrame(JSON.parse(data));
+                        } catch (e) {
+                            console.error('解析失败:', e);
+                        }
+                    }
+                }
+            }
+        },
+
+        /**
+         * 读取流式回答; 连接在结束标记前中断时, 用 stream_id + last_seq 续传 (不会重新调用模型)
+         */
+        consumeStream: async function(response, onFrame, signal) {
+            const sse = this.config.transport === 'sse';
+            const path = sse ? 'chat/sse' : 'chat/stream';
+            const read = (sse ? this.readSse : this.readNdjson).bind(this);
+            let streamId = null;
+            let lastSeq = -1;
+            let ended = false;
+            
+            for (let attempt = 0; ; attempt++) {
+                try {
+                    if (attempt > 0) {
+                        await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+                        response = await fetch(`${this.config.apiBase}/${path}/${streamId}?last_seq=${lastSeq}`, {
+                            headers: this.headers(),
+                            signal
+                        });
+                        if (!response.ok) throw new Error('续传失败');
+                    }
+                    await read(response, (data) => {
+                        if (data.stream_id) streamId = data.stream_id;
+                        if (typeof data.seq === 'number') lastSeq = data.seq;
+                        if (data.type === 'end' || data.type === 'error') ended = true;
+                        onFrame(data);
+                    });
+                    if (ended || !streamId) return;
+                } catch (error) {
+                    if (error.name === 'AbortError' || !streamId || attempt >= 3) throw error;
+                }
+                console.warn('连接中断, 尝试续传:', streamId, lastSeq);
+            }
+        },
+
+        /**
+         * 打开 (或复用) WebSocket 连接; 多次对话共用一个连接, 按 request_id 分发帧
+         */
+        openSocket: function() {
+            if (this.socket && this.socket.readyState <= WebSocket.OPEN) {
+                return this.socket.ready;
+            }
+            const url = new URL(`${this.config.apiBase}/chat/ws`, window.location.href);
+            url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:';
+            if (this.config.apiKey) {
+                // WebSocket 无法设置请求头, Key 放在查询参数中
+                url.searchParams.set('api_key', this.config.apiKey);
+            }
+            const socket = new WebSocket(url);
+            socket.ready = new Promise((resolve, reject) => {
+                socket.onopen = () => resolve(socket);
+                socket.onerror = () => reject(new Error('WebSocket 连接失败'));
+            });
+            socket.onmessage = (event) => {
+                const msg = JSON.parse(event.data);
+                const handler = this.socketHandlers[msg.request_id];
+                if (handler) handler(msg);
+            };
+            socket.onclose = () => {
+                // 连接断开: 通知所有进行中的对话, 由其决定是否续传
+                const handlers = Object.values(this.socketHandlers);
+                this.socketHandlers = {};
+                this.socket = null;
+                handlers.forEach(handler => handler({ type: 'close' }));
+            };
+            this.socket = socket;
+            return socket.ready;
+        },
+
+        /**
+         * 通过 WebSocket 进行流式对话; 连接中断时用 stream_id + last_seq 续传
+         */
+        streamChatWs: async function(body, onFrame, signal) {
+            const requestId = Math.random().toString(36).slice(2);
+            let streamId = null;
+            let lastSeq = -1;
+            
+            for (let attempt = 0; ; attempt++) {
+                if (attempt > 0) {
+                    await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+                }
+                const socket = await this.openSocket();
+                const closed = await new Promise((resolve, reject) => {
+                    const onAbort = () => {
+                        delete this.socketHandlers[requestId];
+                        reject(new DOMException('Aborted', 'AbortError'));
+                    };
+                    if (signal) signal.addEventListener('abort', onAbort, { once: true });
+                    this.socketHandlers[requestId] = (msg) => {
+                        if (msg.type === 'close' || msg.type === 'error') {
+                            if (signal) signal.removeEventListener('abort', onAbort);
+                            delete this.socketHandlers[requestId];
+                            if (msg.type === 'close') resolve(true);
+                            else reject(new Error(msg.message));
+                            return;
+                        }
+                        const data = msg.frame;
+                        if (data.stream_id) streamId = data.stream_id;
+                        if (typeof data.seq === 'number') lastSeq = data.seq;
+                        onFrame(data);
+                        if (data.type === 'end' || data.type === 'error') {
+                            if (signal) signal.removeEventListener('abort', onAbort);
+                            delete this.socketHandlers[requestId];
+                            resolve(false);
+                        }
+                    };
+                    socket.send(JSON.stringify(attempt === 0
+                        ? { type: 'chat', request_id: requestId, ...body }
+                        : { type: 'resume', request_id: requestId, stream_id: streamId, last_seq: lastSeq }));
+                });
+                if (!closed) return;
+                if (!streamId || attempt >= 3) throw new Error('连接中断');
+                console.warn('连接中断, 尝试续传:', streamId, lastSeq);
+            }
+        },
+
+        /**
+         * 停止生成: 通知后端中止模型调用, 请求失败时直接断开连接
+         */
+        stopGeneration: async function() {
+            const stream = this.currentStream;
+            if (!stream) return;
+            try {
+                const response = await fetch(`${this.config.apiBase}/chat/stop`, {
+                    method: 'POST',
+                    headers: this.headers({
+                        'Content-Type': 'application/json'
+                    }),
+                    body: JSON.stringify({ session_id: stream.sessionId })
+                });
+                const data = await response.json();
+                if (data.broadcast) {
+                    // 生成在其他 worker 中, 稍后收到 stopped 结束帧; 超时仍未结束时再中止连接
+                    setTimeout(() => {
+                        if (this.currentStream === stream) stream.controller.abort();
+                    }, 3000);
+                } else if (!data.stopped) {
+                    stream.controller.abort();
+                }
             } catch (error) {
-                console.error('发送消息失败:', error);
-                this.removeLoading();
-                this.addMessage('assistant', '抱歉,出现了错误,请稍后重试。');
-            } finally {
-                sendBtn.disabled = false;
+                console.error('停止生成失败:', error);
+                stream.controller.abort();
             }
         },
 